@@ -0,0 +1,66 @@
+# Summary statistics of the battery cell voltages and module temperatures.
+#
+# Values can be a NumPy array (when NumPy is installed, see signals.decode_array) or a list.
+# Cell numbers returned as out of range are 1-based, like dcBatteryCellNoMaxVoltage.
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def summarize(values, low=None, high=None):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return summarize_numpy(values, low, high)
+
+    count = len(values)
+    minimum = min(values)
+    maximum = max(values)
+    mean = sum(values) / count
+    stddev = math.sqrt(sum([(value - mean) ** 2 for value in values]) / count)
+    out_of_range = []
+    if low is not None or high is not None:
+        out_of_range = [i + 1 for i, value in enumerate(values)
+                        if (low is not None and value < low) or (high is not None and value > high)]
+    return {
+        'min':          minimum,
+        'max':          maximum,
+        'mean':         mean,
+        'stddev':       stddev,
+        'imbalance':    maximum - minimum,
+        'out_of_range': out_of_range
+    }
+
+def summarize_numpy(values, low=None, high=None):
+    minimum = float(values.min())
+    maximum = float(values.max())
+    out_of_range = []
+    if low is not None or high is not None:
+        mask = numpy.zeros(values.shape, dtype=bool)
+        if low is not None:
+            mask |= values < low
+        if high is not None:
+            mask |= values > high
+        out_of_range = (numpy.flatnonzero(mask) + 1).tolist()
+    return {
+        'min':          minimum,
+        'max':          maximum,
+        'mean':         float(values.mean()),
+        'stddev':       float(values.std()),
+        'imbalance':    maximum - minimum,
+        'out_of_range': out_of_range
+    }
+
+def to_list(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.tolist()
+    return list(values)
+
+def concatenate(arrays):
+    if numpy is not None and arrays and isinstance(arrays[0], numpy.ndarray):
+        return numpy.concatenate(arrays)
+    result = []
+    for array in arrays:
+        result.extend(array)
+    return result
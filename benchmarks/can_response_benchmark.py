@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# Micro-benchmark of the CAN response decoder: previous string based implementation
+# against the binary ISO-TP reassembly of isotp_decoder.
+#
+# Usage: python benchmarks/can_response_benchmark.py [iterations]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from isotp_decoder import CanError, reassemble
+
+# BMS 2101 response (9 frames, 61 bytes of data)
+BMS_2101_LINES = [
+    "7EC103D6101FFFFFFFF",
+    "7EC21A9264826480300",
+    "7EC22050EFA1F1F1F1F",
+    "7EC231F1F1F001DC714",
+    "7EC24C70A012A910001",
+    "7EC25547A000151B300",
+    "7EC26007AD100007718",
+    "7EC27005928B40D017F",
+    "7EC280000000003E800",
+]
+
+# The same response using 29-bit identifiers
+BMS_2101_LINES_29BIT = ["18DAF1EC" + line[3:] for line in BMS_2101_LINES]
+
+# Previous implementation, working on the text returned by raw()
+def legacy_can_response(raw_text):
+    data = None
+    data_len = 0
+    last_idx = 0
+    raw = raw_text.split('\n')
+    for line in raw:
+        if (len(line) != 19):
+            raise ValueError('Error parsing CAN response: {}. Invalid line length {}!=19. '.format(line,len(line)))
+
+        offset = 3
+        identifier = int(line[0:offset], 16)
+
+        frame_type = int(line[offset:offset+1], 16)
+
+        if frame_type == 0:     # Single frame
+            data_len = int(line[offset+1:offset+2], 16)
+            data = bytes.fromhex(line[offset+2:data_len*2+offset+2])
+            break
+
+        elif frame_type == 1:   # First frame
+            data_len = int(line[offset+1:offset+4], 16)
+            data = bytearray.fromhex(line[offset+4:])
+            last_idx = 0
+
+        elif frame_type == 2:   # Consecutive frame
+            idx = int(line[offset+1:offset+2], 16)
+            if (last_idx + 1) % 0x10 != idx:
+                raise CanError("Bad frame order: last_idx({}) idx({})".format(last_idx,idx))
+
+            frame_len = min(7, data_len - len(data))
+            data.extend(bytearray.fromhex(line[offset+2:frame_len*2+offset+2]))
+            last_idx = idx
+
+            if data_len == len(data):
+                break
+
+        else:                   # Unexpected frame
+            raise ValueError('Unexpected frame')
+    return data
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    raw_text = "\n".join(BMS_2101_LINES)
+
+    assert legacy_can_response(raw_text) == reassemble(BMS_2101_LINES)
+    assert reassemble(BMS_2101_LINES) == reassemble(BMS_2101_LINES_29BIT)
+
+    # raw() joins the frames in a string that the legacy implementation splits again
+    legacy = min(timeit.repeat(lambda: legacy_can_response(raw_text), number=iterations, repeat=5))
+    binary = min(timeit.repeat(lambda: reassemble(BMS_2101_LINES), number=iterations, repeat=5))
+    binary_29 = min(timeit.repeat(lambda: reassemble(BMS_2101_LINES_29BIT), number=iterations, repeat=5))
+
+    print("BMS 2101 response ({} frames), {} iterations".format(len(BMS_2101_LINES), iterations))
+    print("legacy string decoder:   {:8.2f} us/response".format(legacy / iterations * 1e6))
+    print("binary ISO-TP decoder:   {:8.2f} us/response ({:.1f}x)".format(binary / iterations * 1e6, legacy / binary))
+    print("binary ISO-TP (29-bit):  {:8.2f} us/response".format(binary_29 / iterations * 1e6))
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# Benchmark of obdii_data.py against the ELM327 simulator (no car, dongle or broker needed).
+#
+# Starts elm327_simulator.py on a local socket, connects with obdii_data.obd_connect and runs
+# query_all_information a number of times. Reports the connection time, the cycle time, the latency
+# of every command (adapter round-trip as seen by python-OBD) and the CPU time spent decoding the
+# responses (ISO-TP reassembly and signals decoding).
+#
+# Usage: python benchmarks/obdii_benchmark.py [--cycles N] [--no-expected-frames] [simulator options, i.e. --latency 0.05 --drop 0.01]
+#
+# Run the simulator with --timeout-wait to see the time the adapter waits after each response
+# without the number of frames expected (--no-expected-frames).
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+
+BASE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, BASE_PATH)
+
+import obd
+import obdii_data
+
+# Accumulated (count, total seconds) by name
+class Timings(object):
+    def __init__(self):
+        self.values = {}
+
+    def add(self, name, seconds):
+        count, total = self.values.get(name, (0, 0.0))
+        self.values[name] = (count + 1, total + seconds)
+
+    def report(self, title, unit=1e3, unit_name='ms'):
+        print(title)
+        for name in sorted(self.values):
+            count, total = self.values[name]
+            print("   {:24} {:6d} {:12.3f} {} avg".format(name, count, total / count * unit, unit_name))
+
+command_latency = Timings()
+decode_cpu = Timings()
+decode_depth = [0]
+
+# Time python-OBD queries by command
+def timed_query(query):
+    def wrapper(self, cmd, force=False):
+        start = time.perf_counter()
+        try:
+            return query(self, cmd, force=force)
+        finally:
+            command_latency.add(cmd.command.decode(), time.perf_counter() - start)
+    return wrapper
+
+# Time the CPU used by the outermost decode call
+def timed_decode(name, function):
+    def wrapper(*args, **kwargs):
+        decode_depth[0] += 1
+        start = time.process_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            decode_depth[0] -= 1
+            if decode_depth[0] == 0:
+                decode_cpu.add(name, time.process_time() - start)
+    return wrapper
+
+def instrument():
+    obd.OBD.query = timed_query(obd.OBD.query)
+    for name in ('decode_battery_information', 'decode_vmcu_information', 'decode_signals'):
+        setattr(obdii_data, name, timed_decode(name, getattr(obdii_data, name)))
+    # Response decoders are bound to the commands when they are created
+    for name in dir(obdii_data):
+        cmd = getattr(obdii_data, name)
+        if name.startswith('cmd_') and cmd.decode is obdii_data.can_response:
+            cmd.decode = timed_decode('can_response', cmd.decode)
+
+def start_simulator(simulator_args):
+    process = subprocess.Popen([sys.executable, os.path.join(BASE_PATH, 'elm327_simulator.py'), '--socket', '0'] + simulator_args,
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line.startswith('ELM327 simulator on '):
+        process.kill()
+        raise RuntimeError("Simulator did not start: {}".format(line))
+    return process, line.strip().split(' on ', 1)[1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='obdii_data.py benchmark with the ELM327 simulator')
+    parser.add_argument('--cycles', type=int, default=20, help='number of query cycles')
+    parser.add_argument('--fast-baudrate', type=int, default=None, help='baud rate to switch the adapter to with AT BRD (see simulator --max-baudrate)')
+    parser.add_argument('--no-expected-frames', action='store_true', help="don't send the number of frames expected after the extended commands")
+    args, simulator_args = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    obd.logger.setLevel(logging.ERROR)
+
+    simulator, port = start_simulator(simulator_args)
+    try:
+        obdii_data.config = {
+            'serial': {'port': port, 'baudrate': 38400, 'fast_baudrate': args.fast_baudrate, 'expected_frames': not args.no_expected_frames},
+            'vehicle': {'battery_capacity': 28},
+            'battery': {'min_cell_voltage': 3.0, 'max_cell_voltage': 4.2},
+            'mqtt': {}
+        }
+        obdii_data.topic_prefix = 'benchmark/'
+        instrument()
+
+        start = time.perf_counter()
+        obdii_data.connection = obdii_data.obd_connect()
+        connect_time = time.perf_counter() - start
+
+        cycle_times = []
+        messages = 0
+        cpu_start = time.process_time()
+        for cycle in range(args.cycles):
+            start = time.perf_counter()
+            messages += len(obdii_data.query_all_information())
+            cycle_times.append(time.perf_counter() - start)
+        cpu_time = time.process_time() - cpu_start
+        baudrate = obdii_data.connection.interface._ELM327__port.baudrate
+        obdii_data.connection.close()
+
+        print("Connection:    {:10.3f} s ({} bauds)".format(connect_time, baudrate))
+        print("Cycles:        {:10d} ({} messages)".format(args.cycles, messages))
+        print("Cycle time:    {:10.3f} ms avg, {:.3f} ms min, {:.3f} ms max".format(sum(cycle_times) / len(cycle_times) * 1e3, min(cycle_times) * 1e3, max(cycle_times) * 1e3))
+        print("CPU per cycle: {:10.3f} ms".format(cpu_time / args.cycles * 1e3))
+        command_latency.report("Command latency:")
+        decode_cpu.report("Decode CPU:", 1e6, 'us')
+    finally:
+        simulator.terminate()
+        simulator.wait()
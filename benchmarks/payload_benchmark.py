@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+# Payload size and encode time of the battery information with each encoding, with and without
+# key table and packed arrays (see payload_encoding.py). Encodings whose library is not installed
+# are skipped.
+#
+# Usage: python benchmarks/payload_benchmark.py [iterations]
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from payload_encoding import ENCODINGS, PayloadDecoder, PayloadEncoder, PayloadError, check_encoding, load_schemas
+
+SCHEMAS = load_schemas(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'payload_schemas.json'))
+
+# Battery information like the one returned by query_battery_information
+def battery_information(compact_arrays):
+    random.seed(1)
+    info = {}
+    for key in SCHEMAS['battery'][1].keys:
+        if key.startswith('dcBatteryCellVoltage') and key[-2:].isdigit():
+            if not compact_arrays:
+                info[key] = random.randint(185, 195) / 50.0
+        elif key.startswith('dcBatteryModuleTemp') and key[-2:].isdigit():
+            if not compact_arrays:
+                info[key] = float(random.randint(18, 24))
+        elif key == 'dcBatteryCellVoltages':
+            if compact_arrays:
+                info[key] = [random.randint(185, 195) / 50.0 for i in range(96)]
+        elif key == 'dcBatteryModuleTemps':
+            if compact_arrays:
+                info[key] = [float(random.randint(18, 24)) for i in range(12)]
+        elif key == 'dcBatteryCellsOutOfRange':
+            info[key] = []
+        elif key == 'timestamp':
+            info[key] = 1594794497
+        elif 'No' in key or key in ('charging', 'bmsIgnition', 'bmsMainRelay', 'fanStatus', 'socDisplay'):
+            info[key] = random.randint(0, 96)
+        else:
+            info[key] = round(random.uniform(0, 400), 1)
+    return info
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    decoder = PayloadDecoder(SCHEMAS)
+    print("{:8} {:7} {:7} {:6} {:>8} {:>12}".format('arrays', 'encode', 'keys', 'packed', 'bytes', 'us/encode'))
+    for compact_arrays in (False, True):
+        info = battery_information(compact_arrays)
+        for encoding in ENCODINGS:
+            try:
+                check_encoding(encoding)
+            except PayloadError as err:
+                print("{:8} {:7} skipped: {}".format('compact' if compact_arrays else 'keys', encoding, err))
+                continue
+            variants = [(False, False), (True, False)]
+            if encoding != 'json' and compact_arrays:
+                variants.append((True, True))
+            for schema, pack_arrays in variants:
+                encoder = PayloadEncoder({'battery': {'encoding': encoding, 'schema': schema, 'pack_arrays': pack_arrays}}, SCHEMAS)
+                payload = encoder.encode('battery', info)
+                decoded = decoder.decode(payload, encoding)
+                assert set(decoded) == set(info)
+                seconds = timeit.timeit(lambda: encoder.encode('battery', info), number=iterations)
+                print("{:8} {:7} {:7} {:6} {:8d} {:12.1f}".format('compact' if compact_arrays else 'keys', encoding,
+                                                                 'table' if schema else 'names', 'yes' if pack_arrays else 'no',
+                                                                 len(payload), seconds / iterations * 1e6))
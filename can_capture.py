@@ -0,0 +1,153 @@
+# Capture of the raw OBDII requests and responses, to be able to decode them again later.
+#
+# Every command sent through python-OBD (AT commands included, so the CAN header of each response
+# is known) is appended with its timestamp and the raw lines of the response to a capture file.
+# Records are binary to keep files small:
+#
+#   <d timestamp> <B command length> <B frame count> <command>
+#   and for each frame:
+#     <B 3 or 8> <I CAN identifier> <B data length> <data>      CAN frame (11-bit or 29-bit identifier)
+#     <B 0> <B text length> <text>                              Anything else (OK, NO DATA, ?...)
+#
+# Files start with MAGIC and are rotated like logging.handlers.RotatingFileHandler: when a file
+# reaches max_bytes it's renamed to <path>.1 (<path>.1 to <path>.2 and so on, up to backup_count).
+# A record cut by a crash at the end of a file is ignored when reading it.
+
+import os
+import struct
+import time
+from binascii import hexlify, unhexlify
+
+from isotp_decoder import header_width
+
+MAGIC = b'PIONIQ-CAN-CAPTURE 1\n'
+
+RECORD = struct.Struct('<dBB')
+CAN_FRAME = struct.Struct('<BIB')
+TEXT_FRAME = struct.Struct('<BB')
+
+TEXT = 0
+
+def is_frame(line):
+    return len(line) > 3 and all(c in '0123456789ABCDEFabcdef ' for c in line)
+
+def encode_frame(line):
+    if is_frame(line):
+        hl = header_width(line)
+        try:
+            data = unhexlify(line[hl:])
+            return CAN_FRAME.pack(hl, int(line[:hl], 16), len(data)) + data
+        except (ValueError, TypeError, struct.error):
+            pass
+    text = line.encode('latin-1')[:255]
+    return TEXT_FRAME.pack(TEXT, len(text)) + text
+
+def encode_record(timestamp, command, lines):
+    command = command[:255]
+    lines = lines[:255]
+    return RECORD.pack(timestamp, len(command), len(lines)) + command + b''.join(encode_frame(line) for line in lines)
+
+class CaptureWriter(object):
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=10):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.backup_count = int(backup_count)
+        self.records = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self.path, i)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    # Append a request (bytes) and the raw lines of its response
+    def write(self, command, lines, timestamp=None):
+        record = encode_record(time.time() if timestamp is None else timestamp, command, lines)
+        if self.max_bytes and self.file.tell() + len(record) > self.max_bytes and self.file.tell() > len(MAGIC):
+            self.rotate()
+        self.file.write(record)
+        self.file.flush()
+        self.records += 1
+
+    # Record every command sent through a python-OBD interface (ELM327 object of a connection).
+    # The lines are recorded as read from the adapter, before python-OBD parses them (it drops
+    # the responses with missing frames or wrong sequence numbers), by wrapping its private __send.
+    def attach(self, interface):
+        send = getattr(interface, '_ELM327__send', None)
+        if send is None:
+            raise ValueError("Unsupported python-OBD interface: {}".format(type(interface).__name__))
+        last_command = [b'']
+        def recording_send(cmd, *args, **kwargs):
+            lines = send(cmd, *args, **kwargs)
+            # An empty command repeats the last one (python-OBD fast mode)
+            if cmd:
+                last_command[0] = cmd
+            self.record(last_command[0], lines)
+            return lines
+        interface._ELM327__send = recording_send
+
+    # Record a command and the lines of its response as read from the adapter
+    def record(self, command, lines):
+        try:
+            self.write(command, [line.replace(' ', '') if is_frame(line) else line for line in lines if line])
+        except (OSError, ValueError):
+            pass        # Capture errors never stop the queries
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Existing files of a capture, oldest first
+def capture_files(path, backup_count=99):
+    files = ['{}.{}'.format(path, i) for i in range(backup_count, 0, -1)] + [path]
+    return [name for name in files if os.path.exists(name)]
+
+def decode_frame(data, pos):
+    kind = data[pos]
+    if kind == TEXT:
+        kind, length = TEXT_FRAME.unpack_from(data, pos)
+        pos += TEXT_FRAME.size
+        return data[pos:pos + length].decode('latin-1'), pos + length
+    kind, can_id, length = CAN_FRAME.unpack_from(data, pos)
+    pos += CAN_FRAME.size
+    if pos + length > len(data):
+        raise struct.error('Frame cut')
+    return ('{:0' + str(kind) + 'X}').format(can_id) + hexlify(data[pos:pos + length]).decode().upper(), pos + length
+
+# Read the records of a capture file as (timestamp, command, lines) tuples
+def read_capture(path):
+    with open(path, 'rb') as capture_file:
+        data = capture_file.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("{} is not a capture file".format(path))
+    pos = len(MAGIC)
+    while pos < len(data):
+        try:
+            timestamp, command_len, frame_count = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            command = data[pos:pos + command_len].decode('latin-1')
+            pos += command_len
+            lines = []
+            for i in range(frame_count):
+                line, pos = decode_frame(data, pos)
+                lines.append(line)
+        except (struct.error, IndexError):
+            return      # Record cut at the end of the file
+        yield timestamp, command, lines
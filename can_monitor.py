@@ -0,0 +1,145 @@
+# Passive CAN monitoring (ELM327 AT MA) of the frames the ECUs broadcast without being asked.
+#
+# Values like speed, pedal, gear or battery current are sent on the bus many times per second.
+# Instead of a request/response round-trip per value, the adapter is set to only let through the
+# wanted CAN IDs (ATCRA for a single ID, ATCF/ATCM filter and mask for several), with automatic
+# formatting off (ATCAF0, data bytes shown as sent) and AT MA prints every matching frame until a
+# character is sent. A monitor window lasts a few seconds, then the adapter is back to request/response.
+#
+# Lines are parsed with a fast parser: the frames of IDs that are not decoded (the filter and mask
+# of several IDs can let other IDs through) are dropped before any hex conversion, the data of the
+# others is converted once with unhexlify and decoded with the compiled signal decoder of their ID.
+#
+# The samples of each ID are published as one message per window, with the time of each sample:
+#   {"timestamp": start of the window, "samples": number of samples, "times": [seconds from timestamp],
+#    "<signal>": [value of each sample], ...}
+
+import time
+from binascii import unhexlify
+
+from isotp_decoder import header_width
+
+MONITOR_COMMAND = b'ATMA'
+
+# Sent by the adapter when it can't send the frames as fast as they're received (spaces removed)
+BUFFER_FULL = 'BUFFERFULL'
+
+# AT commands that make the adapter only show the frames of can_ids (list of hex strings)
+def filter_commands(can_ids):
+    ids = [int(can_id, 16) for can_id in can_ids]
+    if len(ids) == 1:
+        return ['ATCRA{:03X}'.format(ids[0]) if ids[0] <= 0x7FF else 'ATCRA{:08X}'.format(ids[0])]
+    extended = any(can_id > 0x7FF for can_id in ids)
+    all_bits = 0x1FFFFFFF if extended else 0x7FF
+    # Bits that are the same in all the IDs
+    mask = all_bits
+    for can_id in ids[1:]:
+        mask &= ~(can_id ^ ids[0]) & all_bits
+    width = 8 if extended else 3
+    return ['ATCF{:0{}X}'.format(ids[0] & mask, width), 'ATCM{:0{}X}'.format(mask, width)]
+
+class MonitorParser(object):
+    # decoders: signal decoder (signals.ResponseDecoder) by CAN ID (hex string)
+    def __init__(self, decoders, min_interval=0):
+        self.decoders = dict((can_id.upper(), decoder) for can_id, decoder in decoders.items())
+        self.min_interval = float(min_interval)
+        self.last_sample = {}
+        self.frames = 0
+        self.dropped = 0
+        self.errors = 0
+        self.overflows = 0
+
+    # (CAN ID, decoded values) of a frame line, None if it's not a frame of a decoded ID or it's
+    # less than min_interval seconds after the last sample of its ID
+    def parse(self, line, timestamp):
+        if ' ' in line:
+            line = line.replace(' ', '')
+        hl = header_width(line)
+        can_id = line[:hl]
+        decoder = self.decoders.get(can_id)
+        if decoder is None:
+            if line == BUFFER_FULL:
+                self.overflows += 1
+            else:
+                self.dropped += 1
+            return None
+        self.frames += 1
+        if self.min_interval and timestamp - self.last_sample.get(can_id, float('-inf')) < self.min_interval:
+            return None
+        try:
+            values = decoder.decode(unhexlify(line[hl:]))
+        except (ValueError, TypeError):
+            self.errors += 1
+            return None
+        self.last_sample[can_id] = timestamp
+        return can_id, values
+
+# Samples of a monitor window, stored by signal (columns) to publish them in one message
+class SampleBuffer(object):
+    def __init__(self, start):
+        self.start = start
+        self.times = []
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, timestamp, values):
+        index = len(self.times)
+        self.times.append(round(timestamp - int(self.start), 3))
+        for name, value in values.items():
+            # Signals missing in previous samples are None there
+            self.columns.setdefault(name, [None] * index).append(value)
+
+    def message(self):
+        message = {
+            'timestamp': int(self.start),
+            'samples': len(self.times),
+            'times': self.times
+        }
+        message.update(self.columns)
+        return message
+
+# Decode the lines ((timestamp, line) tuples) of a monitor window. Returns a SampleBuffer by CAN ID.
+def decode_lines(parser, lines, start):
+    buffers = {}
+    for timestamp, line in lines:
+        sample = parser.parse(line, timestamp)
+        if sample is not None:
+            can_id, values = sample
+            if can_id not in buffers:
+                buffers[can_id] = SampleBuffer(start)
+            buffers[can_id].add(timestamp, values)
+    return buffers
+
+# Send command (AT MA) to the adapter on a pyserial port, read the lines it streams during duration
+# seconds and stop it. Returns the lines as (timestamp, line) tuples.
+def monitor_port(port, duration, command=MONITOR_COMMAND):
+    previous_timeout = port.timeout
+    port.timeout = 0.01
+    lines = []
+    buffer = b''
+    try:
+        port.reset_input_buffer()
+        port.write(command + b'\r')
+        port.flush()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            data = port.read(max(1, port.in_waiting))
+            if not data:
+                continue
+            now = time.time()
+            buffer += data
+            *complete, buffer = buffer.split(b'\r')
+            lines.extend((now, line.strip().decode('latin-1')) for line in complete if line.strip())
+        # Any character stops the monitoring, the adapter answers with its prompt
+        port.write(b'\r')
+        port.flush()
+        deadline = time.monotonic() + 1.0
+        while b'>' not in buffer and time.monotonic() < deadline:
+            buffer += port.read(max(1, port.in_waiting))
+    finally:
+        port.timeout = previous_timeout
+    now = time.time()
+    lines.extend((now, line.strip().decode('latin-1')) for line in buffer.replace(b'>', b'').split(b'\r') if line.strip())
+    return lines
@@ -0,0 +1,86 @@
+# Change detection of the published information, to cut the uplink volume and broker writes.
+#
+# Each topic can be configured with:
+#   heartbeat   Seconds after which the information is published even if it has not changed
+#   deadbands   Min change of a value to be published, by key. Keys can be fnmatch patterns
+#               (i.e. "dcBatteryCellVoltage*"). Values without a deadband are published on any change
+#   ignore      Keys not compared (by default timestamp and last_update, as they change every time)
+#
+# The information is compared with the last published one (not with the last one received), so a
+# value that drifts slowly is published once it has moved more than its deadband. Topics that are
+# not configured are always published.
+
+import fnmatch
+import numbers
+import time
+
+DEFAULT_IGNORED_KEYS = ('timestamp', 'last_update')
+
+class TopicFilter(object):
+    def __init__(self, heartbeat=None, deadbands=None, ignore=DEFAULT_IGNORED_KEYS, clock=time.time):
+        self.heartbeat = float(heartbeat) if heartbeat else None
+        self.deadbands = dict(deadbands or {})
+        self.ignore = set(ignore)
+        self.clock = clock
+        self.deadband_cache = {}
+        self.last_data = None
+        self.last_time = None
+        self.published = 0
+        self.suppressed = 0
+
+    # Deadband of a key: the exact key first, then the first pattern matching it
+    def deadband(self, key):
+        if key not in self.deadband_cache:
+            deadband = self.deadbands.get(key)
+            if deadband is None:
+                for pattern, value in self.deadbands.items():
+                    if fnmatch.fnmatchcase(key, pattern):
+                        deadband = value
+                        break
+            self.deadband_cache[key] = float(deadband or 0)
+        return self.deadband_cache[key]
+
+    def value_changed(self, old, new, deadband):
+        if isinstance(old, numbers.Real) and isinstance(new, numbers.Real) and not isinstance(old, bool) and not isinstance(new, bool):
+            return abs(new - old) > deadband
+        if isinstance(old, list) and isinstance(new, list):
+            return len(old) != len(new) or any(self.value_changed(o, n, deadband) for o, n in zip(old, new))
+        return old != new
+
+    def changed(self, data):
+        if self.last_data is None:
+            return True
+        last = self.last_data
+        if set(data) - self.ignore != set(last) - self.ignore:
+            return True
+        for key, value in data.items():
+            if key not in self.ignore and self.value_changed(last[key], value, self.deadband(key)):
+                return True
+        return False
+
+    def should_publish(self, data):
+        now = self.clock()
+        if self.changed(data) or (self.heartbeat is not None and now - self.last_time >= self.heartbeat):
+            self.last_data = dict(data)
+            self.last_time = now
+            self.published += 1
+            return True
+        self.suppressed += 1
+        return False
+
+class ChangeFilter(object):
+    # config: {topic: {"heartbeat": seconds, "deadbands": {key: deadband}, "ignore": [keys]}}
+    def __init__(self, config, clock=time.time):
+        self.topics = {}
+        for topic, topic_config in config.items():
+            self.topics[topic] = TopicFilter(heartbeat=topic_config.get('heartbeat'),
+                                             deadbands=topic_config.get('deadbands'),
+                                             ignore=topic_config.get('ignore', DEFAULT_IGNORED_KEYS),
+                                             clock=clock)
+
+    # Whether the information of a topic has to be published. If it is, it becomes the last published one.
+    def should_publish(self, topic, data):
+        topic_filter = self.topics.get(topic)
+        if topic_filter is None:
+            return True
+        return topic_filter.should_publish(data)
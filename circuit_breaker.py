@@ -0,0 +1,66 @@
+# Circuit breaker used to stop querying an ECU that keeps failing (i.e. asleep with the car off).
+#
+# After failure_threshold consecutive failures the circuit of the ECU opens: its queries are skipped
+# for cooldown seconds. Then one query is allowed (half open): if it succeeds the circuit closes,
+# if it fails the circuit opens again for another cooldown.
+
+import logging
+import time
+
+logger = logging.getLogger('obdii.breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half open'
+
+class Circuit(object):
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.skipped = 0
+
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=3, cooldown=300, clock=time.monotonic):
+        self.failure_threshold = int(failure_threshold)
+        self.cooldown = float(cooldown)
+        self.clock = clock
+        self.circuits = {}
+
+    def circuit(self, key):
+        if key not in self.circuits:
+            self.circuits[key] = Circuit()
+        return self.circuits[key]
+
+    # Whether key can be queried now
+    def allow(self, key):
+        circuit = self.circuit(key)
+        if circuit.state == OPEN:
+            if self.clock() - circuit.opened_at < self.cooldown:
+                circuit.skipped += 1
+                return False
+            circuit.state = HALF_OPEN
+            logger.info("Trying %s again after %s second(s)", key, self.cooldown)
+        return True
+
+    def record_success(self, key):
+        circuit = self.circuit(key)
+        if circuit.state != CLOSED:
+            logger.info("%s is responding again", key)
+        circuit.state = CLOSED
+        circuit.failures = 0
+
+    def record_failure(self, key):
+        circuit = self.circuit(key)
+        circuit.failures += 1
+        if circuit.state == HALF_OPEN or (circuit.state == CLOSED and self.failure_threshold > 0 and circuit.failures >= self.failure_threshold):
+            circuit.state = OPEN
+            circuit.opened_at = self.clock()
+            logger.warning("%s failed %s time(s) in a row, not queried for %s second(s)", key, circuit.failures, self.cooldown)
+
+    # Seconds until key can be queried again (0 if it can be queried now)
+    def remaining_cooldown(self, key):
+        circuit = self.circuit(key)
+        if circuit.state != OPEN:
+            return 0.0
+        return max(0.0, self.cooldown - (self.clock() - circuit.opened_at))
@@ -0,0 +1,187 @@
+#! /usr/bin/python
+
+# Single process collector: queries the car (obdii_data.py daemon mode) and reads gpsd (gps_data.py)
+# at the same time, with one MQTT connection and one message queue for both.
+#
+# Every OBDII information published gets the GPS fix nearest in time attached as "location":
+#   {"latitude", "longitude", "speed" (m/s), "gps_accuracy" (m), "fix_age" (seconds between the fix and the information)}
+# It's left out when there is no accurate fix closer than collector.max_fix_age seconds.
+#
+# Everything runs in one asyncio event loop: the ELM327 serial port (elm327_transport.py), the gpsd
+# socket (gps_client.watch_async) and the MQTT connection (mqtt_asyncio.py) are read when they have
+# data, so a slow broker or GPS never delays the CAN polling. The polling tasks of obdii_data (and
+# the decoding of the responses) run in a single worker thread, their commands go through the event loop.
+#
+# It uses obdii_data.config.json (MQTT, OBDII, polling and queue settings) and gps_data.config.json
+# (gpsd, service, publishing and track settings, only the topic prefix of its mqtt section is used).
+# When the store of obdii_data.config.json is enabled, the locations go to the same time-series database.
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import gps_data
+import obdii_data
+from elm327_transport import Elm327Transport
+from gps_client import is_number, watch_async
+from log_setup import setup_logging, stop_logging
+from message_queue import AsyncQueueSender
+from mqtt_asyncio import AsyncMqttLoop
+
+logger = logging.getLogger('collector')
+
+# Accurate fixes of the last max_age seconds, to find the one nearest to an OBDII information.
+# Fixes are added by the event loop and looked up from the polling thread.
+class LocationHistory(object):
+    def __init__(self, max_error=30, max_age=5, clock=time.time):
+        self.max_error = float(max_error)
+        self.max_age = float(max_age)
+        self.clock = clock
+        self.fixes = deque()    # (time, location)
+        self.lock = threading.Lock()
+
+    # Called by the GPS client with every location read
+    def add(self, location):
+        if not is_number(location['latitude']) or not is_number(location['longitude']) \
+                or not is_number(location['gps_accuracy']) or location['gps_accuracy'] >= self.max_error:
+            return
+        now = self.clock()
+        with self.lock:
+            self.fixes.append((now, location))
+            while self.fixes and self.fixes[0][0] < now - self.max_age:
+                self.fixes.popleft()
+
+    # Location of the fix nearest to timestamp, None if there is none within max_age seconds
+    def nearest(self, timestamp):
+        with self.lock:
+            if not self.fixes:
+                return None
+            fix_time, location = min(self.fixes, key=lambda fix: abs(fix[0] - timestamp))
+        fix_age = timestamp - fix_time
+        if abs(fix_age) > self.max_age:
+            return None
+        return {
+            'latitude': location['latitude'],
+            'longitude': location['longitude'],
+            'speed': location['speed'] if is_number(location['speed']) else None,
+            'gps_accuracy': location['gps_accuracy'],
+            'fix_age': round(fix_age, 1)
+        }
+
+def load_config(name):
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/' + name) as config_file:
+        return json.loads(config_file.read())
+
+# Poll the car until stop is set: each step runs in the worker thread, the waits in the event loop
+async def poll_car(loop, worker, stop):
+    scheduler = obdii_data.create_scheduler()
+    status = {'cycles': 0, 'profile_state': None}
+    try:
+        while not stop.is_set():
+            wait = await loop.run_in_executor(worker, obdii_data.poll_car, scheduler, status)
+            if wait is None:
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        obdii_data.log_polling_summary(scheduler, status)
+        await loop.run_in_executor(worker, obdii_data.close_connection)
+
+async def collect():
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    # One message queue for the OBDII and GPS messages, sent by the event loop
+    queue_config = obdii_data.config.get('queue', {})
+    message_queue = obdii_data.open_message_queue()
+    gps_data.message_queue = message_queue
+    mqtt_client = obdii_data.mqtt_create_client()
+    obdii_data.mqtt_client = mqtt_client
+    mqtt_loop = AsyncMqttLoop(mqtt_client, loop, logger_name='collector.mqtt')
+    queue_sender = AsyncQueueSender(message_queue, mqtt_client, loop,
+                                    batch_size=queue_config.get('batch_size', 50),
+                                    publish_timeout=queue_config.get('publish_timeout', 10))
+    queue_sender.metrics = obdii_data.metrics
+
+    # Commands are sent through the event loop once python-OBD is connected
+    obdii_data.transport = Elm327Transport(loop)
+    worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='obdii')
+
+    mqtt_task = loop.create_task(mqtt_loop.run())
+    sender_task = loop.create_task(queue_sender.run())
+    gps_task = loop.create_task(watch_async(gps_data.gps_client, gps_data.on_location, gps_data.on_timeout,
+                                            timeout=gps_data.no_fix_timeout, reconnect_delay=gps_data.reconnect_delay))
+    metrics_server = obdii_data.start_metrics_server()
+    try:
+        await poll_car(loop, worker, stop)
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        gps_task.cancel()
+        await asyncio.gather(gps_task, return_exceptions=True)
+        if gps_data.track_compressor is not None:
+            gps_data.queue_track(gps_data.track_compressor.flush())
+        # Give the sender a last chance to send what's queued
+        deadline = loop.time() + float(obdii_data.config['mqtt'].get('publish_timeout', 5))
+        while mqtt_client.connected_flag and len(message_queue) and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        queue_sender.stop()
+        await sender_task
+        logger.info("%s message(s) sent to MQTT", queue_sender.sent)
+        await mqtt_loop.stop()
+        mqtt_task.cancel()
+        await asyncio.gather(mqtt_task, return_exceptions=True)
+        message_queue.close()
+        worker.shutdown()
+
+if __name__ == '__main__':
+    obd_config = load_config('obdii_data.config.json')
+    obd_config['mqtt'].setdefault('client_id', "pioniq-collector")
+    gps_config = load_config('gps_data.config.json')
+
+    # Logs of both scripts and python-OBD written to collector.log by a background thread (logging section of obdii_data.config.json)
+    log_listener = setup_logging(os.path.dirname(os.path.realpath(__file__)) + '/collector.log',
+                                 ['collector', 'obdii', 'gps', 'obd'], obd_config.get('logging'))
+    obdii_data.configure(obd_config)
+    gps_data.configure(gps_config)
+    if obdii_data.store is not None:
+        # One time-series database for both (store section of obdii_data.config.json)
+        if gps_data.store is not None:
+            gps_data.store.close()
+        gps_data.store = obdii_data.store
+
+    collector_config = obd_config.get('collector', {})
+    history = LocationHistory(max_error=gps_config['service']['min_accuracy'],
+                              max_age=collector_config.get('max_fix_age', 5))
+    obdii_data.location_provider = history.nearest
+    gps_data.gps_client.fix_listener = history.add
+
+    try:
+        logger.info("=== Collector start ===")
+
+        asyncio.run(collect())
+    except (KeyboardInterrupt, SystemExit):
+        # when you press ctrl+c
+        pass
+    finally:
+        gps_data.gps_client.close()
+        logger.info("%s GPS report(s) read, %s location(s) filtered", gps_data.gps_client.reports, gps_data.gps_client.fix_filter.rejected)
+        if obdii_data.capture_writer is not None:
+            obdii_data.capture_writer.close()
+        if gps_data.store is not None and gps_data.store is not obdii_data.store:
+            gps_data.store.close()
+        if obdii_data.store is not None:
+            logger.info("%s sample(s) stored", obdii_data.store.samples)
+            obdii_data.store.close()
+        logger.info("=== Collector end ===")
+        stop_logging(log_listener)
@@ -0,0 +1,50 @@
+# Cache of the OBDII connection settings that worked, by serial port: OBDII protocol, baud rate and
+# ELM327 timing (ATAT adaptive timing and ATST timeout). They are reused on the next connection to
+# skip the protocol detection.
+#
+# The cache is a JSON file: {"<port>": {"protocol": "6", "baudrate": 38400, "adaptive_timing": 1, "timeout": 50,
+#                                       "response_frames": {"7E4 2101": 9}, "updated": 1600000000}}
+# It's written to a temporary file first so a crash never leaves a broken cache.
+
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('obdii.cache')
+
+class ConnectionCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self.entries = json.loads(cache_file.read())
+            except (OSError, ValueError) as err:
+                logger.warning("Ignoring connection cache %s: %s", path, err)
+                self.entries = {}
+
+    # Cached settings of a port (empty if there are none)
+    def get(self, port):
+        return dict(self.entries.get(port, {}))
+
+    # Store settings of a port, None values are removed
+    def update(self, port, **values):
+        entry = self.entries.setdefault(port, {})
+        for key, value in values.items():
+            if value is None:
+                entry.pop(key, None)
+            else:
+                entry[key] = value
+        entry['updated'] = int(round(time.time()))
+        self.save()
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as cache_file:
+                cache_file.write(json.dumps(self.entries, indent=4, sort_keys=True))
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            logger.warning("Could not save connection cache %s: %s", self.path, err)
@@ -0,0 +1,116 @@
+# Negotiation of a higher UART baud rate with the ELM327 (AT BRD), for wired adapters where the serial
+# link limits the number of responses per second (a 61 bytes BMS response is about 250 characters).
+#
+# AT BRD hh asks the adapter to switch to 4000000 / hh bauds. Supporting adapters answer OK, switch,
+# send their ID string at the new rate and wait for a carriage return from the host (AT BRT timeout).
+# If it doesn't arrive in time (the host could not read the ID, i.e. a Bluetooth module with a fixed
+# UART) the adapter goes back to the previous rate by itself. Adapters that don't support it answer ?.
+#
+# Once switched, the link is checked with AT I. If the check fails the adapter is reset (AT Z also
+# restores its default baud rate) and the caller must connect again.
+#
+# The adapter keeps the new rate until it's reset or powered off, so it may still use it when the
+# script connects again: reset_baudrate sends it AT Z at that rate.
+
+import logging
+import time
+
+import serial
+
+logger = logging.getLogger('obdii.baudrate')
+
+# The link doesn't work at the new baud rate, the adapter has been reset
+class BaudrateError(Exception): pass
+
+# Time the adapter waits for the carriage return after sending its ID string at the new rate, set
+# with AT BRT hh to hh * 5 ms. The adapter's default is 75 ms; 0x40 (320 ms) leaves the host time to
+# reopen its port at the new rate, read the ID string and answer through a USB or Bluetooth serial link.
+BRT_TIMEOUT = 0x40
+
+# Divisor of AT BRD for a baud rate
+def brd_divisor(baudrate):
+    divisor = int(round(4000000.0 / baudrate))
+    if divisor < 8 or divisor > 255:
+        raise ValueError("Unsupported baud rate for AT BRD: {} (15686 to 500000)".format(baudrate))
+    return divisor
+
+# Read from the serial port until one of the terminators is received or timeout seconds have passed
+def read_until(port, terminators, timeout):
+    previous_timeout = port.timeout
+    port.timeout = 0.01
+    data = b''
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline and not any(terminator in data for terminator in terminators):
+            data += port.read(max(1, port.in_waiting))
+    finally:
+        port.timeout = previous_timeout
+    return data
+
+# Send a command and return its answer up to the prompt
+def send(port, command, timeout=1.0):
+    port.reset_input_buffer()
+    port.write(command + b'\r')
+    port.flush()
+    return read_until(port, (b'>',), timeout)
+
+# Reset an adapter that could still be at baudrate (i.e. the script was restarted without powering
+# it off) so it goes back to its default baud rate
+def reset_baudrate(port_name, baudrate):
+    logger.info("Resetting the adapter at %s bauds", baudrate)
+    port = serial.serial_for_url(port_name, baudrate=baudrate, timeout=1)
+    try:
+        port.write(b'\rATZ\r')
+        port.flush()
+        time.sleep(1)
+    finally:
+        port.close()
+
+# Switch the adapter and the serial port of a python-OBD interface (ELM327 object of a connection) to
+# baudrate. Returns the new baud rate, or None if the adapter doesn't support it (the link is left as it was).
+# Raises BaudrateError if the link doesn't work at the new rate and the adapter had to be reset.
+def negotiate_baudrate(interface, baudrate):
+    port = interface._ELM327__port
+    previous = port.baudrate
+    divisor = brd_divisor(baudrate)
+    actual = int(round(4000000.0 / divisor))
+    if actual == previous:
+        return actual
+
+    # Give the host more time than the default 75 ms to answer the ID string (ignored if not supported)
+    send(port, 'ATBRT{:02X}'.format(BRT_TIMEOUT).encode())
+
+    port.reset_input_buffer()
+    port.write('ATBRD{:02X}\r'.format(divisor).encode())
+    port.flush()
+    answer = read_until(port, (b'OK\r', b'?', b'>'), 1.0)
+    if b'OK' not in answer:
+        read_until(port, (b'>',), 0.5)
+        logger.info("Adapter does not support %s bauds: %s", actual, answer.decode('latin-1').strip())
+        return None
+
+    port.baudrate = actual
+    elm_id = read_until(port, (b'\r',), BRT_TIMEOUT * 0.005)
+    if b'ELM' not in elm_id.upper():
+        # The adapter goes back to the previous baud rate when it doesn't get the carriage return
+        port.baudrate = previous
+        time.sleep(BRT_TIMEOUT * 0.005)
+        read_until(port, (b'>',), 0.5)
+        logger.info("No ID string at %s bauds (%s), staying at %s bauds", actual, elm_id, previous)
+        return None
+    port.write(b'\r')
+    port.flush()
+    answer = read_until(port, (b'>',), 1.0)
+
+    # Check the new baud rate with a test command
+    if b'OK' not in answer or b'ELM' not in send(port, b'ATI').upper():
+        logger.warning("Link not working at %s bauds, resetting the adapter", actual)
+        port.write(b'ATZ\r')
+        port.flush()
+        port.baudrate = previous
+        time.sleep(1)
+        port.reset_input_buffer()
+        raise BaudrateError("Baud rate {} check failed".format(actual))
+
+    logger.info("Switched from %s to %s bauds", previous, actual)
+    return actual
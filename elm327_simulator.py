@@ -0,0 +1,444 @@
+#! /usr/bin/python
+
+# ELM327 simulator to run obdii_data.py without a car, for offline benchmarks and regression tests.
+#
+# It answers the AT commands used by python-OBD and by obdii_data.py (ATZ, ATE, ATH, ATL, ATS, AT RV,
+# ATSP, ATTP, ATDPN, ATSH, ATCRA, ATCF, ATCM, ATAR, ATST, ATAT...) and the extended commands of the
+# Ioniq (2101 - 2105, 22B002, 1A80, 22C00B and 2180) with multiple frame ISO-TP responses.
+# The ECU answering a request is the one of the current CAN header (ATSH), its responses use the
+# header + 8 as CAN identifier (i.e. 7E4 -> 7EC) and are only shown if they pass the receive
+# filter (ATCRA/ATCF/ATCM), like the real adapter.
+#
+# Faults can be injected to test error handling: latency (fixed plus random jitter) per command and
+# per frame, dropped consecutive frames and wrong sequence numbers.
+#
+# AT BRD (baud rate switch) is supported up to --max-baudrate with the same handshake as the real
+# adapter: OK, ID string at the new rate and back to the previous rate if the host doesn't answer
+# with a carriage return within the AT BRT timeout. The rate itself is only recorded.
+#
+# Extended commands can end with the number of frames expected (one hex digit, i.e. 21019): the
+# frames after it are not shown. With --timeout-wait the simulator waits for the ATST timeout after the
+# last frame of a response when its expected number of frames was not given or not reached, as the real
+# adapter does when it doesn't know whether more frames are coming.
+#
+# AT MA (monitor all) streams the --broadcast frames that pass the receive filter, each one at its
+# own rate, until a character is received, like the broadcast frames on the bus of a real car.
+#
+# The simulator is served over a pseudo terminal (default, the slave name is printed and can be used
+# as serial port in obdii_data.config.json) or a TCP socket (port "socket://127.0.0.1:<port>").
+#
+# Usage: python elm327_simulator.py [--socket PORT] [--latency S] [--jitter S] [--frame-delay S]
+#                                   [--drop RATE] [--bad-sequence RATE] [--responses FILE] [--seed N]
+#                                   [--max-baudrate BAUDS] [--broadcast ID=DATA@HZ ...] [--timeout-wait]
+#
+# Responses can be replaced with a JSON file: {"<CAN header>": {"<command>": "<response data in hex>"}}
+
+import argparse
+import json
+import logging
+import os
+import random
+import select
+import socket
+import sys
+import time
+import tty
+
+logger = logging.getLogger('elm327_simulator')
+
+ELM_VERSION = 'ELM327 v1.5'
+ELM_PROMPT = b'>'
+
+# Sample responses data (without ISO-TP framing) by CAN header and command.
+# BMS 2101 is the response shown in obdii_data.py can_response comments.
+SAMPLE_RESPONSES = {
+    '7E4': {        # BMS
+        '2101': '6101FFFFFFFFA9264826480300050EFA1F1F1F1F1F1F1F001DC714C70A012A910001547A000151B300007AD100007718005928B40D017F0000000003E8',
+        '2102': '6102FFFFFFFFBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBE',
+        '2103': '6103FFFFFFFFBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBE',
+        '2104': '6104FFFFFFFFBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBEBEBFBEBEBFBEBDBE',
+        '2105': '6105FFFFFFFF00141414141415141314141514140000020000131303E80B03E8015B0000000000000000000000',
+    },
+    '7E2': {        # VMCU
+        '2101': '6101FFF8000000010100000000000000000000000000',
+        '1A80': '5A8000000000000000000000000000004B4D48433735314846485530303030303000000000000000000000000000000000'
+                '00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000',
+    },
+    '7C6': {        # Cluster (odometer)
+        '22B002': '62B002E0000000FF0000A112000000',
+    },
+    '7A0': {        # TPMS
+        '22C00B': '62C00BFFFF0000A64B0000A64C0000A44B0000A54A0000',
+    },
+    '7E6': {        # External temperature
+        '2180': '61800000000000000000000000007800000000000000000000',
+    },
+}
+
+# Supported PIDs [01-20]: only the ones needed by python-OBD to connect
+PIDS_0100 = '4100BE1FA812'
+
+DEFAULT_BAUDRATE = 38400
+
+class Elm327Simulator(object):
+    def __init__(self, responses=None, latency=0.0, jitter=0.0, frame_delay=0.0, drop_rate=0.0, bad_sequence_rate=0.0, voltage=12.6, seed=None, max_baudrate=None, broadcasts=None, timeout_wait=False):
+        self.responses = dict((header.upper(), dict((command.upper(), bytes.fromhex(data)) for command, data in commands.items()))
+                              for header, commands in (responses or SAMPLE_RESPONSES).items())
+        self.latency = latency
+        self.jitter = jitter
+        self.frame_delay = frame_delay
+        self.drop_rate = drop_rate
+        self.bad_sequence_rate = bad_sequence_rate
+        self.voltage = voltage
+        self.max_baudrate = max_baudrate
+        self.timeout_wait = timeout_wait
+        # Frames sent in monitor mode: (frames per second, data) by CAN ID
+        self.broadcasts = dict((int(can_id, 16), (float(rate), bytes.fromhex(data))) for can_id, (rate, data) in (broadcasts or {}).items())
+        self.broadcast_frames = 0
+        self.baudrate = DEFAULT_BAUDRATE
+        self.random = random.Random(seed)
+        self.commands = 0
+        self.dropped_frames = 0
+        self.bad_sequences = 0
+        self.reset()
+
+    def reset(self):
+        self.echo = True
+        self.headers = False
+        self.linefeeds = True
+        self.spaces = True
+        self.protocol = 'A6'
+        self.header = '7DF'
+        self.receive_filter = None
+        self.receive_mask = 0x7FF
+        self.timeout = 0x32
+        self.adaptive_timing = 1
+        self.baudrate_timeout = 0x0F
+        self.pending_baudrate = None
+        self.monitoring = False
+        self.last_command = ''
+
+    # Process a command line and return the full answer of the adapter, prompt included
+    def process(self, line):
+        if self.pending_baudrate is not None:
+            return self.confirm_baudrate(line)
+        command = line.strip().upper()
+        if not command:
+            command = self.last_command         # Empty command repeats the last one
+        else:
+            self.last_command = command
+        self.commands += 1
+        output = self.handle(command.replace(' ', ''))
+        answer = ''
+        if self.echo:
+            answer += line.strip() + '\r'
+        eol = '\r\n' if self.linefeeds else '\r'
+        answer += ''.join(response_line + eol for response_line in output)
+        if self.pending_baudrate is not None or self.monitoring:
+            # ID string sent at the new baud rate, waiting for the host carriage return (no prompt)
+            # or frames streamed until the host sends a character
+            return answer.encode('latin-1')
+        return (answer + eol + '>').encode('latin-1')
+
+    # Line received after an AT BRD switch: an empty line in time confirms the new baud rate
+    def confirm_baudrate(self, line):
+        baudrate, deadline = self.pending_baudrate
+        self.pending_baudrate = None
+        eol = '\r\n' if self.linefeeds else '\r'
+        if not line.strip() and time.monotonic() <= deadline:
+            self.baudrate = baudrate
+            return ('OK' + eol + eol + '>').encode('latin-1')
+        # Back to the previous rate, the line is handled as a command
+        return (eol + '>').encode('latin-1') + (self.process(line) if line.strip() else b'')
+
+    def delay(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    # Answer of a command as a list of lines
+    def handle(self, command):
+        if command.startswith('AT'):
+            return self.handle_at(command[2:])
+        self.delay(self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0))
+        if not all(c in '0123456789ABCDEF' for c in command) or len(command) < 2:
+            return ['?']
+        expected_frames = None
+        if len(command) & 1:
+            # Number of frames expected after the command
+            expected_frames = int(command[-1], 16)
+            command = command[:-1]
+            if not expected_frames:
+                return ['?']
+        if command.startswith('01'):
+            # Standard OBDII PIDs (only needed to connect)
+            if command == '0100':
+                return self.format_frames(0x7E8, self.receive_frames(self.isotp_frames(bytes.fromhex(PIDS_0100)), expected_frames))
+            return self.receive_frames([], expected_frames) or ['NO DATA']
+        data = self.responses.get(self.header, {}).get(command)
+        rx_id = int(self.header, 16) + 8
+        if data is None or (self.receive_filter is not None and (rx_id & self.receive_mask) != (self.receive_filter & self.receive_mask)):
+            return self.receive_frames([], expected_frames) or ['NO DATA']
+        return self.format_frames(rx_id, self.receive_frames(self.inject_faults(self.isotp_frames(data)), expected_frames))
+
+    # Frames shown of a response: the expected number of them at most. Waits for the ATST timeout
+    # after the last one if it's not the last frame expected (with timeout_wait).
+    def receive_frames(self, frames, expected_frames):
+        if expected_frames is not None and len(frames) >= expected_frames:
+            return frames[:expected_frames]
+        if self.timeout_wait:
+            self.delay(self.timeout * 0.004)
+        return frames
+
+    def handle_at(self, at):
+        if at in ('Z', 'WS'):
+            if at == 'Z':
+                self.baudrate = DEFAULT_BAUDRATE
+            self.reset()
+            self.delay(0.1)
+            return ['', ELM_VERSION]
+        if at == 'D':
+            self.reset()
+            return ['OK']
+        if at == 'I':
+            return [ELM_VERSION]
+        if at == '@1':
+            return ['OBDII to RS232 Interpreter (simulator)']
+        if at == 'MA':
+            self.monitoring = True
+            return []
+        if at == 'RV':
+            return ['{:.1f}V'.format(self.voltage)]
+        if at == 'DPN':
+            return [self.protocol]
+        if at == 'DP':
+            return ['AUTO, ISO 15765-4 (CAN 11/500)' if self.protocol.startswith('A') else 'ISO 15765-4 (CAN 11/500)']
+        if at in ('PC', 'LP', 'CAF1', 'CAF0', 'AR') or at.startswith('CEA'):
+            if at == 'AR':
+                self.receive_filter = None
+                self.receive_mask = 0x7FF
+            return ['OK']
+        flag = at[:-1]
+        value = at[-1:]
+        if flag in ('E', 'H', 'L', 'S') and value in ('0', '1'):
+            setattr(self, {'E': 'echo', 'H': 'headers', 'L': 'linefeeds', 'S': 'spaces'}[flag], value == '1')
+            return ['OK']
+        if at.startswith('SP') or at.startswith('TP'):
+            protocol = at[2:]
+            automatic = protocol.startswith('A') or protocol == '0'
+            protocol = protocol.lstrip('A')
+            if protocol not in ('0', '6'):
+                return ['?']
+            # Automatic search always finds ISO 15765-4 (CAN 11/500)
+            self.protocol = 'A6' if automatic else '6'
+            return ['OK']
+        if at.startswith('SH') and len(at) in (5, 8):
+            self.header = at[-3:] if len(at) == 5 else at[2:]
+            return ['OK']
+        if at.startswith('CRA'):
+            if len(at) == 3:
+                self.receive_filter = None
+                self.receive_mask = 0x7FF
+            else:
+                self.receive_filter = int(at[3:], 16)
+                self.receive_mask = 0x7FF
+            return ['OK']
+        if at.startswith('CF') and len(at) > 2:
+            self.receive_filter = int(at[2:], 16)
+            return ['OK']
+        if at.startswith('CM') and len(at) > 2:
+            self.receive_mask = int(at[2:], 16)
+            return ['OK']
+        if at.startswith('ST') and len(at) == 4:
+            self.timeout = int(at[2:], 16)
+            return ['OK']
+        if at.startswith('BRT') and len(at) == 5:
+            self.baudrate_timeout = int(at[3:], 16)
+            return ['OK']
+        if at.startswith('BRD') and len(at) == 5:
+            divisor = int(at[3:], 16)
+            if not self.max_baudrate or divisor < 8 or 4000000.0 / divisor > self.max_baudrate:
+                return ['?']
+            self.pending_baudrate = (int(round(4000000.0 / divisor)), time.monotonic() + max(1, self.baudrate_timeout) * 0.005)
+            return ['OK', ELM_VERSION]
+        if at.startswith('AT') and at[2:] in ('0', '1', '2'):
+            self.adaptive_timing = int(at[2:])
+            return ['OK']
+        return ['?']
+
+    # ISO-TP frames (8 bytes each, padded) of a response
+    def isotp_frames(self, data):
+        if len(data) <= 7:
+            return [bytes([len(data)]) + data + bytes(7 - len(data))]
+        frames = [bytes([0x10 | (len(data) >> 8), len(data) & 0xFF]) + data[:6]]
+        index = 1
+        for pos in range(6, len(data), 7):
+            chunk = data[pos:pos + 7]
+            frames.append(bytes([0x20 | index]) + chunk + bytes(7 - len(chunk)))
+            index = (index + 1) & 0x0F
+        return frames
+
+    def inject_faults(self, frames):
+        result = [frames[0]]
+        for frame in frames[1:]:
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.dropped_frames += 1
+                continue
+            if self.bad_sequence_rate and self.random.random() < self.bad_sequence_rate:
+                self.bad_sequences += 1
+                frame = bytes([0x20 | ((frame[0] + 1) & 0x0F)]) + frame[1:]
+            result.append(frame)
+        return result
+
+    def format_frames(self, rx_id, frames):
+        self.delay(self.frame_delay * len(frames))
+        separator = ' ' if self.spaces else ''
+        lines = []
+        if self.headers:
+            for frame in frames:
+                lines.append(separator.join(['{:03X}'.format(rx_id)] + ['{:02X}'.format(b) for b in frame]))
+        elif len(frames) == 1:
+            lines.append(separator.join('{:02X}'.format(b) for b in frames[0][1:1 + frames[0][0]]))
+        else:
+            # Without headers the adapter shows the data length and numbered frames without PCI
+            lines.append('{:03X}'.format(((frames[0][0] & 0x0F) << 8) | frames[0][1]))
+            lines.append('0:' + separator + separator.join('{:02X}'.format(b) for b in frames[0][2:]))
+            for frame in frames[1:]:
+                lines.append('{:X}:'.format(frame[0] & 0x0F) + separator + separator.join('{:02X}'.format(b) for b in frame[1:]))
+        return lines
+
+    # Line of a broadcast frame as shown in monitor mode
+    def format_broadcast(self, can_id, data):
+        separator = ' ' if self.spaces else ''
+        items = ['{:02X}'.format(b) for b in data]
+        if self.headers:
+            items.insert(0, '{:03X}'.format(can_id) if can_id <= 0x7FF else '{:08X}'.format(can_id))
+        return separator.join(items)
+
+    # Send the broadcast frames that pass the receive filter until readable(timeout) tells the host sent something
+    def monitor(self, write, readable):
+        eol = '\r\n' if self.linefeeds else '\r'
+        now = time.monotonic()
+        due = dict((can_id, now) for can_id in self.broadcasts
+                   if self.receive_filter is None or (can_id & self.receive_mask) == (self.receive_filter & self.receive_mask))
+        while True:
+            wait = max(0.0, min(due.values()) - time.monotonic()) if due else 1.0
+            if readable(wait):
+                break
+            now = time.monotonic()
+            for can_id, next_due in due.items():
+                if next_due <= now:
+                    rate, data = self.broadcasts[can_id]
+                    write((self.format_broadcast(can_id, data) + eol).encode('latin-1'))
+                    self.broadcast_frames += 1
+                    due[can_id] = next_due + 1.0 / rate
+
+    # Serve the simulator on a file descriptor (pty master or socket) until it's closed.
+    # readable(timeout) tells whether there is data to read, needed for the monitor mode.
+    def serve_fd(self, read, write, readable=None):
+        buffer = b''
+        while True:
+            data = read()
+            if not data:
+                return
+            buffer += data
+            if self.monitoring:
+                # The character received stops the monitoring
+                self.monitoring = False
+                write(('\r\n' if self.linefeeds else '\r').encode('latin-1') + ELM_PROMPT)
+                buffer = b''
+                continue
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                line = line.replace(b'\n', b'').decode('latin-1')
+                write(self.process(line))
+                if self.monitoring:
+                    if readable is not None:
+                        self.monitor(write, readable)
+                    buffer = b''
+                    break
+
+# Serve on a pseudo terminal. Calls ready with the slave device name once it can be opened.
+def serve_pty(simulator, ready=None):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    if ready:
+        ready(name)
+    # The slave is kept open so reading the master blocks (instead of failing) while no client has it open
+    simulator.serve_fd(lambda: os.read(master, 1024), lambda data: os.write(master, data),
+                       lambda timeout: bool(select.select([master], [], [], timeout)[0]))
+
+# Serve on a TCP socket, one client at a time. Calls ready with the pyserial URL of the simulator.
+def serve_socket(simulator, port=0, host='127.0.0.1', ready=None):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    if ready:
+        ready('socket://{}:{}'.format(host, server.getsockname()[1]))
+    while True:
+        client, address = server.accept()
+        logger.info("Client connected from %s", address)
+        simulator.reset()
+        try:
+            simulator.serve_fd(lambda: client.recv(1024), client.sendall,
+                               lambda timeout: bool(select.select([client], [], [], timeout)[0]))
+        except (ConnectionError, OSError) as err:
+            logger.info("Client disconnected: %s", err)
+        finally:
+            client.close()
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description='ELM327 simulator')
+    parser.add_argument('--socket', type=int, default=None, metavar='PORT', help='serve on a TCP port (0 = any free port) instead of a pseudo terminal')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to answer each OBDII command')
+    parser.add_argument('--jitter', type=float, default=0.0, help='max random seconds added to the latency')
+    parser.add_argument('--frame-delay', type=float, default=0.0, help='seconds to send each CAN frame')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of dropping each consecutive frame')
+    parser.add_argument('--bad-sequence', type=float, default=0.0, help='probability of a wrong sequence number in each consecutive frame')
+    parser.add_argument('--responses', default=None, help='JSON file with the responses data by CAN header and command')
+    parser.add_argument('--seed', type=int, default=None, help='random seed of the injected faults')
+    parser.add_argument('--max-baudrate', type=int, default=None, help='max baud rate accepted by AT BRD (not supported by default)')
+    parser.add_argument('--timeout-wait', action='store_true', help='wait for the ATST timeout after each response without the expected number of frames')
+    parser.add_argument('--broadcast', action='append', default=[], metavar='ID=DATA@HZ', help='frame broadcast in monitor mode (AT MA), i.e. 5F0=0102030405060708@50')
+    return parser.parse_args(args)
+
+# Broadcast frames of the command line: {"<ID>": (rate, "<data>")}
+def parse_broadcasts(values):
+    broadcasts = {}
+    for value in values:
+        can_id, frame = value.split('=', 1)
+        data, rate = frame.split('@', 1) if '@' in frame else (frame, 10)
+        broadcasts[can_id] = (float(rate), data)
+    return broadcasts
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)-10s %(levelname)-8s %(message)s")
+    args = parse_arguments()
+    responses = None
+    if args.responses:
+        with open(args.responses) as responses_file:
+            responses = json.loads(responses_file.read())
+    simulator = Elm327Simulator(responses,
+                                latency=args.latency,
+                                jitter=args.jitter,
+                                frame_delay=args.frame_delay,
+                                drop_rate=args.drop,
+                                bad_sequence_rate=args.bad_sequence,
+                                seed=args.seed,
+                                max_baudrate=args.max_baudrate,
+                                broadcasts=parse_broadcasts(args.broadcast),
+                                timeout_wait=args.timeout_wait)
+    def ready(port):
+        # First line of the output, used by the benchmarks to find the port
+        print("ELM327 simulator on {}".format(port))
+        sys.stdout.flush()
+    try:
+        if args.socket is not None:
+            serve_socket(simulator, args.socket, ready=ready)
+        else:
+            serve_pty(simulator, ready=ready)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("%s command(s) processed, %s frame(s) dropped, %s bad sequence number(s), %s bauds, %s broadcast frame(s)", simulator.commands, simulator.dropped_frames, simulator.bad_sequences, simulator.baudrate, simulator.broadcast_frames)
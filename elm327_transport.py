@@ -0,0 +1,210 @@
+# Non-blocking ELM327 transport for an asyncio event loop.
+#
+# python-OBD is still used to connect (baud rate, protocol detection...), then the serial port of the
+# connection is read with loop.add_reader: waiting for a response never blocks the event loop, so gpsd
+# reports and MQTT traffic are handled while the car answers.
+#
+# Commands are queued and each one is written as soon as the prompt (>) of the previous one is read,
+# from the reader callback itself. The ELM327 stops the command in progress when it receives any
+# character, so there is never more than one command in flight: the pipelining is done on the host
+# side, removing the round-trip through the caller between a prompt and the next write.
+#
+# Monitoring commands (AT MA) stream lines without a prompt: monitor() collects them for a while and
+# then stops the adapter, like can_monitor.monitor_port does on a plain serial port.
+#
+# Responses are parsed with the protocol of the python-OBD connection and decoded by the OBDCommand,
+# as connection.query does, except that the command is always sent (force) and the header is not set.
+#
+# The decoding code of obdii_data is synchronous: it runs in a worker thread and calls query(), which
+# waits for the coroutine running in the event loop.
+
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+
+import serial
+from obd import OBDResponse
+
+logger = logging.getLogger('obdii.transport')
+
+PROMPT = b'>'
+
+# Lines of an ELM327 response, as python-OBD splits them
+def response_lines(data):
+    data = data.replace(b'\x00', b'')
+    if data.endswith(PROMPT):
+        data = data[:-1]
+    return [line.strip() for line in re.split('[\r\n]', data.decode('utf-8', 'ignore')) if line]
+
+class Elm327Transport(object):
+    def __init__(self, loop, timeout=None):
+        self.loop = loop
+        self.timeout = timeout  # Seconds to wait for a prompt (the serial port timeout by default)
+        self.port = None
+        self.protocol = None
+        self.capture_writer = None
+        self.pending = deque()  # (command, future) waiting to be written
+        self.current = None     # (command, future) written, waiting for its prompt
+        self.buffer = bytearray()
+        self.stream = None      # (timestamp, line) read while monitoring
+        self.commands = 0
+        self.timeouts = 0
+
+    @property
+    def attached(self):
+        return self.port is not None
+
+    # Run function in the event loop and wait for its result (from any thread)
+    def call(self, function, *args):
+        async def run():
+            return function(*args)
+        if self.in_loop():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    # Read the responses from the serial port of a connected python-OBD interface (ELM327 object)
+    def attach(self, interface, capture_writer=None):
+        self.call(self.add_port, interface._ELM327__port, interface._ELM327__protocol, capture_writer)
+
+    def add_port(self, port, protocol, capture_writer):
+        self.remove_port()
+        self.port = port
+        self.protocol = protocol
+        self.capture_writer = capture_writer
+        self.buffer = bytearray()
+        self.loop.add_reader(port.fileno(), self.on_readable)
+        logger.debug("Transport attached to %s", port.name)
+
+    # Stop reading the serial port (before python-OBD closes it). Pending commands fail.
+    def detach(self):
+        self.call(self.remove_port)
+
+    def remove_port(self):
+        if self.port is None:
+            return
+        self.loop.remove_reader(self.port.fileno())
+        self.port = None
+        self.fail_all(ConnectionError("Transport detached"))
+
+    def fail_all(self, error):
+        waiting = ([self.current] if self.current is not None else []) + list(self.pending)
+        self.current = None
+        self.pending.clear()
+        for command, future in waiting:
+            if not future.done():
+                future.set_exception(error)
+
+    def on_readable(self):
+        try:
+            data = self.port.read(self.port.in_waiting or 1)
+        except (serial.SerialException, OSError) as err:
+            logger.error("Error reading the OBDII adapter: %s", err)
+            self.remove_port()
+            return
+        if self.stream is not None:
+            self.buffer.extend(data)
+            *complete, rest = self.buffer.split(b'\r')
+            self.buffer = bytearray(rest)
+            now = time.time()
+            self.stream.extend((now, line.strip().decode('latin-1')) for line in complete if line.strip())
+            return
+        if self.current is None:
+            return      # Late data of a command that timed out
+        self.buffer.extend(data)
+        if PROMPT in self.buffer:
+            command, future = self.current
+            self.current = None
+            lines = response_lines(bytes(self.buffer))
+            self.buffer = bytearray()
+            if not future.done():
+                future.set_result(lines)
+            self.write_next()
+
+    # Write the next queued command if the adapter is waiting for one
+    def write_next(self):
+        while self.current is None and self.pending:
+            command, future = self.pending.popleft()
+            if future.done():
+                continue    # Cancelled or timed out while waiting
+            try:
+                self.port.reset_input_buffer()
+                self.port.write(command + b'\r')
+            except (serial.SerialException, OSError) as err:
+                future.set_exception(ConnectionError("Error writing to the OBDII adapter: {}".format(err)))
+                continue
+            self.current = (command, future)
+            self.commands += 1
+
+    # Send a command (bytes) and return the lines of its response
+    async def send(self, command):
+        lines = await self.send_raw(command)
+        if self.capture_writer is not None:
+            self.capture_writer.record(command, lines)
+        return lines
+
+    async def send_raw(self, command):
+        if self.port is None:
+            raise ConnectionError("Transport not attached")
+        future = self.loop.create_future()
+        self.pending.append((command, future))
+        self.write_next()
+        timeout = self.timeout if self.timeout is not None else (self.port.timeout or 10)
+        try:
+            lines = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            lines = response_lines(bytes(self.buffer)) if self.current is not None and self.current[1] is future else []
+            if self.current is not None and self.current[1] is future:
+                # Give up waiting for the prompt, the next command is written at once
+                self.current = None
+                self.buffer = bytearray()
+                self.write_next()
+            future.cancel()
+            logger.warning("No prompt after %s second(s) for %s", timeout, command)
+        return lines
+
+    # OBDResponse of an OBDCommand, as python-OBD connection.query(command, force=True)
+    async def query_async(self, command):
+        lines = await self.send(command.command)
+        messages = self.protocol(lines) if self.protocol is not None else []
+        if not messages:
+            return OBDResponse()
+        return command(messages)
+
+    # Same as query_async, to be called from a thread other than the event loop one
+    def query(self, command):
+        return asyncio.run_coroutine_threadsafe(self.query_async(command), self.loop).result()
+
+    # Send a monitoring command, collect the lines streamed during duration seconds and stop it.
+    # Returns the lines as (timestamp, line) tuples.
+    async def monitor_async(self, command, duration):
+        if self.port is None:
+            raise ConnectionError("Transport not attached")
+        if self.current is not None or self.pending:
+            raise RuntimeError("Transport busy, can't start monitoring")
+        self.stream = lines = []
+        self.buffer = bytearray()
+        try:
+            self.port.reset_input_buffer()
+            self.port.write(command + b'\r')
+            await asyncio.sleep(duration)
+        finally:
+            self.stream = None
+        # Any character stops the monitoring, the rest of the stream comes with the prompt
+        now = time.time()
+        lines.extend((now, line) for line in await self.send_raw(b''))
+        if self.capture_writer is not None:
+            self.capture_writer.record(command, [line for timestamp, line in lines])
+        return lines
+
+    # Same as monitor_async, to be called from a thread other than the event loop one
+    def monitor(self, command, duration):
+        return asyncio.run_coroutine_threadsafe(self.monitor_async(command, duration), self.loop).result()
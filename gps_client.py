@@ -0,0 +1,229 @@
+# Event driven gpsd client: reads the reports of gpsd only when its socket has data (selectors) and
+# turns its TPV (time-position-velocity) reports into locations.
+#
+# It speaks the gpsd JSON protocol directly (?WATCH={"enable":true,"json":true}, one JSON report per
+# line) instead of using the gps module, whose session object parses one line per read call.
+#
+# A fix is only accepted when it's accurate enough (max of the latitude and longitude errors below
+# max_error meters), the car moved at least min_distance meters since the last accepted fix and at
+# least min_time seconds passed. A fix is also accepted every max_time seconds while standing still.
+# The watchers time out when there is no accurate fix, accepted or not: a parked car still has one.
+
+import asyncio
+import json
+import logging
+import math
+import selectors
+import socket
+import time
+
+logger = logging.getLogger('gps.client')
+
+GPSD_PORT = 2947
+WATCH_COMMAND = b'?WATCH={"enable":true,"json":true};\n'
+
+EARTH_RADIUS = 6371008.8 # m
+
+# Distance in meters between two points (haversine formula)
+def distance(latitude1, longitude1, latitude2, longitude2):
+    phi1 = math.radians(latitude1)
+    phi2 = math.radians(latitude2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not math.isnan(value)
+
+class FixFilter(object):
+    def __init__(self, max_error=30, min_distance=0, min_time=0, max_time=None, clock=time.monotonic):
+        self.max_error = float(max_error)
+        self.min_distance = float(min_distance)
+        self.min_time = float(min_time)
+        self.max_time = float(max_time) if max_time else None
+        self.clock = clock
+        self.last = None        # (latitude, longitude, time) of the last accepted fix
+        self.rejected = 0
+        self.accurate = 0       # Fixes accurate enough, accepted or filtered by distance and time
+
+    # Whether a location has a position with an error below max_error
+    def is_accurate(self, location):
+        if not is_number(location.get('latitude')) or not is_number(location.get('longitude')) or not is_number(location.get('gps_accuracy')):
+            return False
+        if location['gps_accuracy'] >= self.max_error:
+            logger.debug("Location not accurate enough: it's +/- %s m but +/- %s m required", location['gps_accuracy'], self.max_error)
+            return False
+        return True
+
+    # Whether a location (see location_from_fix) must be published
+    def accept(self, location):
+        now = self.clock()
+        if not self.is_accurate(location):
+            self.rejected += 1
+            return False
+        self.accurate += 1
+        if self.last is not None:
+            latitude, longitude, last_time = self.last
+            elapsed = now - last_time
+            moved = distance(latitude, longitude, location['latitude'], location['longitude'])
+            if elapsed < self.min_time or (moved < self.min_distance and (self.max_time is None or elapsed < self.max_time)):
+                self.rejected += 1
+                return False
+        self.last = (location['latitude'], location['longitude'], now)
+        return True
+
+# Location information of a TPV report (values not reported are NaN)
+def location_from_tpv(tpv):
+    value = lambda key: tpv.get(key, float('nan'))
+    return {
+        'latitude': value('lat'),
+        'longitude': value('lon'),
+        'gps_accuracy': max(value('epy'), value('epx')),
+        'eps': value('eps'), # Estimated Speed error
+        'epx': value('epx'), # Estimated longitude error
+        'epy': value('epy'), # Estimated latitude error
+        'epv': value('epv'), # Estimated altitude error
+        'ept': value('ept'), # Estimated time error
+        'speed': value('speed'), # m/s
+        'climb': value('climb'),
+        'track': value('track'),
+        'mode': tpv.get('mode', 0)
+    }
+
+class GpsClient(object):
+    def __init__(self, host='127.0.0.1', port=GPSD_PORT, fix_filter=None):
+        self.host = host
+        self.port = port
+        self.fix_filter = fix_filter if fix_filter is not None else FixFilter()
+        self.fix_listener = None    # Called with every location read, before filtering
+        self.sock = None
+        self.buffer = b''
+        self.reports = 0
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=10)
+        self.sock.sendall(WATCH_COMMAND)
+        self.sock.setblocking(False)
+        self.buffer = b''
+        logger.info("Connected to gpsd at %s:%s", self.host, self.port)
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # Locations of the complete TPV reports in data, the rest is kept until the end of its line is received
+    def feed(self, data):
+        locations = []
+        self.buffer += data
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if b'"TPV"' not in line:
+                continue    # Other reports (SKY, VERSION, DEVICES...) are not used
+            try:
+                report = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logger.warning("Invalid gpsd report: %s", line)
+                continue
+            if report.get('class') != 'TPV':
+                continue
+            self.reports += 1
+            location = location_from_tpv(report)
+            if self.fix_listener is not None:
+                self.fix_listener(location)
+            if self.fix_filter.accept(location):
+                locations.append(location)
+        return locations
+
+    # Read the reports already received (call it when the socket is readable).
+    # Returns the accepted locations. Raises ConnectionError if gpsd closed the connection.
+    def read_locations(self):
+        try:
+            data = self.sock.recv(8192)
+        except BlockingIOError:
+            return []
+        if not data:
+            raise ConnectionError("gpsd closed the connection")
+        return self.feed(data)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+# Wait for the locations of a client. Calls on_location with each accepted location as soon as its TPV
+# report is read and on_timeout when there has been no accurate fix (accepted or not) for timeout seconds.
+# Reconnects to gpsd (every reconnect_delay seconds) when the connection is lost. Runs until running() is False.
+def watch(client, on_location, on_timeout=None, timeout=None, reconnect_delay=10, running=lambda: True):
+    selector = selectors.DefaultSelector()
+    last_fix = time.monotonic()
+    while running():
+        if not client.connected:
+            try:
+                client.connect()
+                selector.register(client, selectors.EVENT_READ)
+            except OSError as err:
+                logger.error("Could not connect to gpsd: %s. Retrying in %s second(s)...", err, reconnect_delay)
+                client.close()
+                time.sleep(reconnect_delay)
+                continue
+        wait = None if timeout is None else max(0.0, last_fix + timeout - time.monotonic())
+        if selector.select(wait):
+            accurate = client.fix_filter.accurate
+            try:
+                for location in client.read_locations():
+                    on_location(location)
+            except OSError as err:
+                logger.warning("gpsd connection lost: %s. Reconnecting...", err)
+                selector.unregister(client)
+                client.close()
+                continue
+            if client.fix_filter.accurate != accurate:
+                last_fix = time.monotonic()
+        if timeout is not None and time.monotonic() - last_fix >= timeout:
+            last_fix = time.monotonic()
+            if on_timeout is not None:
+                on_timeout()
+    selector.close()
+
+# Same as watch as a coroutine of an asyncio event loop: the gpsd socket is read with loop.add_reader
+# and connecting is done in the default executor. Runs until it's cancelled.
+async def watch_async(client, on_location, on_timeout=None, timeout=None, reconnect_delay=10):
+    loop = asyncio.get_running_loop()
+    activity = asyncio.Event()      # Set when an accurate fix is read or the connection is lost
+
+    def on_readable():
+        accurate = client.fix_filter.accurate
+        try:
+            for location in client.read_locations():
+                on_location(location)
+            if client.fix_filter.accurate != accurate:
+                activity.set()
+        except OSError as err:
+            logger.warning("gpsd connection lost: %s. Reconnecting...", err)
+            loop.remove_reader(client.fileno())
+            client.close()
+            activity.set()
+
+    try:
+        while True:
+            if not client.connected:
+                try:
+                    await loop.run_in_executor(None, client.connect)
+                except OSError as err:
+                    logger.error("Could not connect to gpsd: %s. Retrying in %s second(s)...", err, reconnect_delay)
+                    client.close()
+                    await asyncio.sleep(reconnect_delay)
+                    continue
+                loop.add_reader(client.fileno(), on_readable)
+            activity.clear()
+            try:
+                await asyncio.wait_for(activity.wait(), timeout)
+            except asyncio.TimeoutError:
+                if on_timeout is not None:
+                    on_timeout()
+    finally:
+        if client.connected:
+            loop.remove_reader(client.fileno())
@@ -8,18 +8,27 @@ import paho.mqtt.client as mqtt
 import ssl
 import json
 import logging
-import logging.handlers
 import os
 
-import gps
-import threading
 import time
 
-gpsd = None # setting the global variable
+from message_queue import MessageQueue, QueueSender
+from change_filter import ChangeFilter
+from payload_encoding import PayloadEncoder, load_schemas
+from gps_client import FixFilter, GpsClient, is_number, watch
+from track_compression import TrackCompressor
+from log_setup import setup_logging, stop_logging
+from timeseries import TimeSeriesStore
+
+logger = logging.getLogger('gps')
+
+# Last published location and number of messages queued
+previous_location = None
+published_messages = 0
 
 #MQTT function for on_publish callback
 def on_publish(client, userdata, mid):
-    logger.debug("Publish message id: {}".format(mid))
+    logger.debug("Publish message id: %s", mid)
     pass
 
 def on_connect(client, userdata, flags, rc):
@@ -27,157 +36,190 @@ def on_connect(client, userdata, flags, rc):
         client.connected_flag=True #set flag
         logger.info("Successfully connected to MQTT")
     else:
-        logger.error("Not connected to MQTT. Bad connection Returned code=",rc)
-
-class GpsPoller(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        global gpsd # bring it in scope
-        gpsd = gps.gps(mode=gps.WATCH_ENABLE) # starting the stream of info
-        self.current_value = None
-        self.running = True
-
-    def run(self):
-        global gpsd
-        while gpsp.running:
-            # this will continue to loop and grab EACH set of
-            # gpsd info to clear the buffer
-            next(gpsd)
+        logger.error("Not connected to MQTT. Bad connection Returned code=%s", rc)
 
-if __name__ == '__main__':
-    logger = logging.getLogger('gps')
-    
-    console_handler = logging.StreamHandler() # sends output to stderr
-    console_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-3s %(levelname)-8s %(message)s"))
-    console_handler.setLevel(logging.DEBUG)
-    logger.addHandler(console_handler)
-    
-    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + '/gps_data.log',
-                                                    when='midnight',
-                                                    backupCount=15) # sends output to gps_data.log file rotating it at midnight and storing latest 15 days
-
-    file_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-3s %(levelname)-8s %(message)s"))
-    file_handler.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
+def on_disconnect(client, userdata, rc):
+    client.connected_flag=False #clear flag
+    if rc != 0:
+        logger.warning("Unexpectedly disconnected from MQTT. Returned code=%s. Reconnecting...", rc)
 
-    logger.setLevel(logging.DEBUG)
-    
-    with open(os.path.dirname(os.path.realpath(__file__)) + '/gps_data.config.json') as config_file:
-        config = json.loads(config_file.read())
-    
+# Queue the location to be published if it changed
+def queue_location(location):
+    global published_messages
+    try:
+        if change_filter.should_publish("location", location):
+            message_queue.put([{'topic':topic_prefix + "location", 'payload':payload_encoder.encode("location", location), 'qos':0, 'retain':True}])
+            logger.info("Message queued to be published")
+            published_messages += 1
+        else:
+            logger.info("Location not changed, not published")
+    except Exception as err:
+        logger.error("Error queuing message: %s", err)
+
+# Queue a batch of compressed track points to be published
+def queue_track(batch):
+    global published_messages
+    if batch is None:
+        return
+    try:
+        message_queue.put([{'topic':topic_prefix + "track", 'payload':payload_encoder.encode("track", batch), 'qos':0, 'retain':False}])
+        logger.info("Track of %s point(s) queued to be published", batch['points'])
+        published_messages += 1
+    except Exception as err:
+        logger.error("Error queuing message: %s", err)
+
+# New accurate location read from gpsd
+def on_location(location):
+    global previous_location
+    location.update({
+        'last_update': int(round(time.time())),
+        'state': 'running'
+    })
+    logger.debug("GPS position fixed with +/- %s m", location['gps_accuracy'])
+    if store is not None:
+        # Every accurate fix is kept locally, published or not
+        store.add("location", location)
+    if track_compressor is not None:
+        track_compressor.add(location['latitude'], location['longitude'], time.time(), location['speed'] if is_number(location['speed']) else None)
+        if not track_compressor.due():
+            return  # The location is published with the next track batch
+        queue_track(track_compressor.flush())
+    if previous_location is not None:
+        # Previous latitude and longitude data is useful to measure distance travelled between updates.
+        location.update({
+            'platitude': previous_location[0], # Latitude of the previous published location
+            'plongitude': previous_location[1] # Longitude of the previous published location
+        })
+    previous_location = (location['latitude'], location['longitude'])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", json.dumps(location))
+    queue_location(location)
+
+# No accurate location for a while: only the state is published
+def on_timeout():
+    logger.warning("No location accurate enough in the last %s second(s)", no_fix_timeout)
+    if track_compressor is not None:
+        # Probably stopped: the pending track points are not kept waiting
+        queue_track(track_compressor.flush())
+    queue_location({
+        'last_update': int(round(time.time())),
+        'state': 'running'
+    })
+
+# Set the module settings from a config (gps_data.config.json contents)
+def configure(new_config):
+    global config, broker_address, port, user, password, topic_prefix, change_filter, payload_encoder, gps_client, no_fix_timeout, reconnect_delay, track_compressor, store
+    config = new_config
     broker_address = config['mqtt']['broker']
     port = int(config['mqtt']['port'])
     user = config['mqtt']['user']
     password = config['mqtt']['password']
     topic_prefix = config['mqtt']['topic_prefix']
 
-    gpsp = GpsPoller()   # create the GPS thread
+    # Publish the location only when it changed (or every heartbeat seconds)
+    change_filter = ChangeFilter(config.get('publishing', {}))
+
+    # Payload encoding of the location (JSON by default)
+    payload_encoder = PayloadEncoder(config.get('payloads', {}), load_schemas(os.path.dirname(os.path.realpath(__file__)) + '/payload_schemas.json'))
+
+    # Locations are read from gpsd as soon as they are reported
+    service_config = config['service']
+    gpsd_config = config.get('gpsd', {})
+    gps_client = GpsClient(gpsd_config.get('host', '127.0.0.1'), gpsd_config.get('port', 2947),
+                           FixFilter(max_error=service_config['min_accuracy'],
+                                     min_distance=service_config.get('min_distance', 0),
+                                     min_time=service_config.get('min_time', 0),
+                                     max_time=service_config.get('max_time')))
+    no_fix_timeout = int(service_config['sleep'])
+    reconnect_delay = gpsd_config.get('reconnect_delay', 10)
+
+    # Track compressed and published in batches instead of a location per fix
+    track_config = config.get('track', {})
+    track_compressor = None
+    if track_config.get('enabled', False):
+        track_compressor = TrackCompressor(tolerance=track_config.get('tolerance', 5),
+                                           min_distance=track_config.get('min_distance', 5),
+                                           speed_deadband=track_config.get('speed_deadband'),
+                                           max_points=track_config.get('max_points', 200),
+                                           max_latency=track_config.get('max_latency', 60))
+
+    # Keep the history of the locations in the local time-series database (see timeseries.py)
+    store_config = config.get('store', {})
+    store = None
+    if store_config.get('enabled', False):
+        store = TimeSeriesStore(store_config.get('path', os.path.dirname(os.path.realpath(__file__)) + '/timeseries.db'),
+                                topics=["location"],
+                                retention=store_config.get('retention'),
+                                max_mb=store_config.get('max_mb', 500),
+                                logger_name='gps.store')
+
+if __name__ == '__main__':
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/gps_data.config.json') as config_file:
+        config = json.loads(config_file.read())
+
+    # Logs written to gps_data.log by a background thread
+    log_listener = setup_logging(os.path.dirname(os.path.realpath(__file__)) + '/gps_data.log', ['gps'], config.get('logging'))
+
+    configure(config)
+    queue_sender = None
     
     try:
         logger.info("=== Script start ===")
         
-        # Start GPS Poller thread
-        gpsp.start()
-        
         mqtt.Client.connected_flag = False
         # Create MQTT client
         mqtt_client= mqtt.Client(client_id="gps-data-script", protocol=mqtt.MQTTv311, transport="tcp")
         # Assign callback functions
         mqtt_client.on_publish = on_publish 
         mqtt_client.on_connect = on_connect
+        mqtt_client.on_disconnect = on_disconnect
         # Set tls
         mqtt_client.tls_set()
         # Set user and password
         mqtt_client.username_pw_set(user,password)
         # Enable MQTT logger
         mqtt_client.enable_logger(logger)
+        # Backoff between reconnection attempts
+        mqtt_client.reconnect_delay_set(min_delay=1, max_delay=120)
+        # Conect to MQTT server in background, the network loop keeps retrying until it succeeds
+        logger.debug("Connecting to MQTT server")
+        mqtt_client.connect_async(broker_address, port)
         # Start loop to process callbacks
         mqtt_client.loop_start()
-        # Conect to MQTT server
-        while not mqtt_client.connected_flag:
-            try:
-                logger.debug("Trying to connect to MQTT server")
-                mqtt_client.connect(broker_address,port)
-            except Exception as err:
-                logger.error("MQTT connection could not be established: {}, retrying... ".format(err), exc_info=False)
-            time.sleep(5)
-
-        previous_latitude = 0
-        previous_logitude = 0
-        max_accuracy = int(config['service']['min_accuracy'])
-
-        sleep_time = int(config['service']['sleep'])
-        
-        published_messages = 0
-        while True:
-            try:
-                location = {
-                    'last_update': int(round(time.time())),
-                    'state': 'running'
-                }
-
-                # It may take some seconds to get good data
-                logger.debug("Latitude error (EPY): +/- {} m".format(gpsd.fix.epy))
-                logger.debug("Longitude error (EPX): +/- {} m".format(gpsd.fix.epx))
-                fix_accuracy = max(gpsd.fix.epy, gpsd.fix.epx)
-                logger.info("Location accuracy: +/- {} m".format(fix_accuracy))
-                if fix_accuracy < max_accuracy:
-                    logger.debug("GPS position fixed with +/- {} m".format(fix_accuracy))
-                    location.update({'latitude': gpsd.fix.latitude,
-                                'longitude': gpsd.fix.longitude,
-                                'gps_accuracy': fix_accuracy,
-                                'eps': gpsd.fix.eps, # Estimated Speed error
-                                'epx': gpsd.fix.epx, # Estimated longitude error
-                                'epy': gpsd.fix.epy, # Estimated latitude error
-                                'epv': gpsd.fix.epv, # Estimated altitude error
-                                'ept': gpsd.fix.ept, # Estimated time error
-                                'speed': gpsd.fix.speed, # m/s
-                                'climb': gpsd.fix.climb, 
-                                'track': gpsd.fix.track,
-                                'mode': gpsd.fix.mode
-                            })
-                    if previous_latitude != 0 and previous_logitude != 0:
-                        # Previous latitude and longitude data is useful to measure distance travelled between updates.
-                        location.update({
-                            'platitude': previous_latitude, # Latitude got from previous read
-                            'plongitude': previous_logitude # Longitude got from previous read
-                        })
-                    previous_latitude = gpsd.fix.latitude
-                    previous_logitude = gpsd.fix.longitude
-    
-                    # Publish to MQTT
-                    logger.debug("Publishing positon to MQTT...")
-                    logger.debug("{}".format(json.dumps(location)))
-    
-    #                logger.debug("%s satellites in view" % len(gpsd.satellites))
-    #                for sat in gpsd.satellites:
-    #                    logger.debug("    %r" % sat)
-                else:
-                    logger.warning("Location not accurate enought: it's +/- {} m but +/- {} m required".format(fix_accuracy, max_accuracy))
-            except Exception as ex:
-                logger.exception("Unexpected error: {}".format(ex))
-            finally:
-                result = mqtt_client.publish(topic=topic_prefix + "location", payload=json.dumps(location), qos=0, retain=True)
-                result.wait_for_publish()
-                if (result.rc == 0): 
-                    logger.info("Message successfully published: " + str(result))
-                    published_messages += 1
-                else:
-                    logger.error("Error publishing message: " + str(result))
-
-                logger.debug("Waiting {} seconds...".format(sleep_time))
-                time.sleep(sleep_time)
+
+        # Locations are stored on disk and sent in background when the broker is reachable
+        queue_config = config.get('queue', {})
+        message_queue = MessageQueue(queue_config.get('path', os.path.dirname(os.path.realpath(__file__)) + '/gps_data.queue.db'),
+                                     max_messages=queue_config.get('max_messages', 10000),
+                                     max_age=queue_config.get('max_age', 7 * 24 * 3600),
+                                     logger_name='gps.queue')
+        queue_sender = QueueSender(message_queue, mqtt_client,
+                                   batch_size=queue_config.get('batch_size', 50),
+                                   publish_timeout=queue_config.get('publish_timeout', 10))
+        queue_sender.start()
+
+        watch(gps_client, on_location, on_timeout, timeout=no_fix_timeout, reconnect_delay=reconnect_delay)
 
     except (KeyboardInterrupt, SystemExit):
         # when you press ctrl+c
         pass
     except Exception as ex:
-        logger.exception("Unexpected error: {}".format(ex))
+        logger.exception("Unexpected error: %s", ex)
     finally:
         logger.info("Killing threads...")
-        mqtt_client.loop_stop()
+        if track_compressor is not None and queue_sender is not None:
+            queue_track(track_compressor.flush())
+            logger.info("%s track point(s) read, %s kept", track_compressor.received, track_compressor.kept)
+        if queue_sender is not None:
+            queue_sender.stop()
+            logger.info("%s location points sent to MQTT", queue_sender.sent)
+            message_queue.close()
         mqtt_client.disconnect()
-        gpsp.running = False
-        gpsp.join()   # wait for the thread to finish what it's doing
-        logger.info("{} location points published".format(published_messages))
+        mqtt_client.loop_stop()
+        gps_client.close()
+        if store is not None:
+            store.close()
+        logger.info("%s GPS report(s) read, %s location(s) filtered", gps_client.reports, gps_client.fix_filter.rejected)
+        logger.info("%s location points queued", published_messages)
         logger.info("=== Script end ===")
+        stop_logging(log_listener)
@@ -0,0 +1,83 @@
+# ISO-TP (ISO 15765-2) reassembly of the CAN frames returned by the ELM327.
+#
+# Every line returned by the adapter (headers on, spaces off) is a CAN identifier followed by
+# up to 8 data bytes in hex. The identifier is 3 hex digits for 11-bit IDs (i.e. 7EC) and 8 hex
+# digits for 29-bit IDs (i.e. 18DAF1EC). As data is always an even number of hex digits, the
+# identifier width can be guessed from the line length when it's not given.
+#
+# The first data byte is the PCI (Protocol Control Information):
+#   0x0L       Single frame, L = data length (up to 7 bytes)
+#   0x1L LL    First frame, LLL = total data length (up to 4095 bytes), followed by 6 data bytes
+#   0x2N       Consecutive frame, N = sequence number (1, 2, ... F, 0, 1...), followed by 7 data bytes
+#
+# Frames are decoded to bytes once with binascii and copied into a buffer preallocated from the
+# first frame length, so no intermediate strings are built.
+
+from binascii import unhexlify
+
+class CanError(Exception): pass
+
+SINGLE_FRAME = 0
+FIRST_FRAME = 1
+CONSECUTIVE_FRAME = 2
+
+# Width in hex digits of the CAN identifier of a line (3 for 11-bit IDs, 8 for 29-bit IDs)
+def header_width(line):
+    return 3 if len(line) & 1 else 8
+
+# Reassemble the data of an ISO-TP message from the raw lines returned by the adapter.
+# Returns bytes for a single frame response and a bytearray for a multiple frames response.
+# Raises CanError for any malformed, missing or incomplete frame.
+def reassemble(lines, header_len=None):
+    data = None
+    data_len = 0
+    pos = 0
+    next_idx = 1
+    for line in lines:
+        hl = header_len or header_width(line)
+        try:
+            frame = unhexlify(line[hl:])
+        except (ValueError, TypeError):
+            raise CanError('Error parsing CAN response: {}. Invalid frame.'.format(line))
+        if not frame:
+            raise CanError('Error parsing CAN response: {}. Empty frame.'.format(line))
+
+        pci = frame[0]
+        frame_type = pci >> 4
+
+        if frame_type == SINGLE_FRAME:
+            data_len = pci & 0x0F
+            if data_len > len(frame) - 1:
+                raise CanError("Single frame too short: expected {} byte(s), got {}".format(data_len, len(frame) - 1))
+            return frame[1:1 + data_len]
+
+        elif frame_type == FIRST_FRAME:
+            if len(frame) < 2:
+                raise CanError("First frame too short: {}".format(line))
+            data_len = ((pci & 0x0F) << 8) | frame[1]
+            data = bytearray(data_len)
+            chunk = min(len(frame) - 2, data_len)
+            data[0:chunk] = frame[2:2 + chunk]
+            pos = chunk
+            next_idx = 1
+
+        elif frame_type == CONSECUTIVE_FRAME:
+            if data is None:
+                raise CanError("Consecutive frame received before first frame")
+            idx = pci & 0x0F
+            if idx != next_idx:
+                raise CanError("Bad frame order: last_idx({}) idx({})".format((next_idx - 1) & 0x0F, idx))
+            chunk = min(len(frame) - 1, data_len - pos)
+            data[pos:pos + chunk] = frame[1:1 + chunk]
+            pos += chunk
+            next_idx = (idx + 1) & 0x0F
+
+        else:                   # Unexpected frame (i.e. flow control)
+            raise CanError('Unexpected frame')
+
+        if pos >= data_len:
+            return data
+
+    if data is None:
+        raise CanError('Error parsing CAN response: no frames')
+    raise CanError("Incomplete response: expected {} byte(s), got {}".format(data_len, pos))
@@ -0,0 +1,111 @@
+# Logging of the scripts through a queue: the loggers only put the records in a queue (QueueHandler)
+# and a listener thread (QueueListener) formats them and writes them to the console and the log file,
+# so logging never makes the polling loop wait for the SD card.
+#
+# Records are queued as they are, their message is built with its %-style arguments by the listener
+# thread (only the traceback of an exception is formatted at once). The log file is written in
+# batches: records are buffered and written when config['buffer'] of them are waiting, when a record
+# comes config['flush_interval'] seconds after the last write, at once for an ERROR and on exit.
+# The file is rotated at midnight keeping config['backup_count'] days, gzipped when config['compress'] is set.
+#
+# Levels are set by logger name, i.e. {"obdii": "INFO", "obdii.transport": "DEBUG", "obd": "WARNING"}:
+# every subsystem logs to a child of its script logger (obdii.transport, obdii.cache, gps.client...).
+
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+
+LOG_FORMAT = "%(asctime)s %(name)-10s %(levelname)-8s %(message)s"
+
+# Levels of the loggers not in config['levels']: python-OBD logs every byte read at DEBUG
+DEFAULT_LEVELS = {
+    'obd': 'INFO'
+}
+
+# Queue handler that leaves the formatting to the listener thread
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        if record.exc_info:
+            # The traceback is gone once the exception is handled
+            return super().prepare(record)
+        return record
+
+# Buffer of the records written to target in batches: capacity records, every flush_interval
+# seconds (checked when a record is added) or when a record of flush_level or higher is added
+class BufferedHandler(logging.handlers.MemoryHandler):
+    def __init__(self, capacity, flush_interval, target, flush_level=logging.ERROR):
+        super().__init__(capacity, flushLevel=flush_level, target=target)
+        self.flush_interval = float(flush_interval)
+        self.last_flush = time.monotonic()
+
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        super().flush()
+        self.last_flush = time.monotonic()
+
+# Names and compresses the rotated log files (obdii_data.log.2020-01-01.gz)
+def gzip_namer(name):
+    return name + '.gz'
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+# Log the records of loggers (names) to the console and to the file path, configured with
+# log_config (config['logging'] of the scripts). Returns the listener to pass to stop_logging.
+def setup_logging(path, loggers, log_config=None):
+    log_config = log_config or {}
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    console_handler = logging.StreamHandler() # sends output to stderr
+    console_handler.setFormatter(formatter)
+    console_handler.setLevel(log_config.get('console_level', 'DEBUG').upper())
+
+    # sends output to the log file rotating it at midnight and storing latest backup_count days
+    file_handler = logging.handlers.TimedRotatingFileHandler(path,
+                                                             when='midnight',
+                                                             backupCount=int(log_config.get('backup_count', 15)),
+                                                             delay=True)
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(log_config.get('file_level', 'INFO').upper())
+    if log_config.get('compress', True):
+        file_handler.namer = gzip_namer
+        file_handler.rotator = gzip_rotator
+    buffered_handler = BufferedHandler(int(log_config.get('buffer', 100)),
+                                       float(log_config.get('flush_interval', 5)),
+                                       file_handler)
+    buffered_handler.setLevel(file_handler.level)
+
+    log_queue = queue.Queue()
+    queue_handler = LazyQueueHandler(log_queue)
+    for name in loggers:
+        script_logger = logging.getLogger(name)
+        # Remove existing handlers (python-OBD adds its own)
+        for handler in script_logger.handlers[:]:
+            script_logger.removeHandler(handler)
+        script_logger.addHandler(queue_handler)
+        script_logger.setLevel(logging.DEBUG)
+    levels = dict(DEFAULT_LEVELS)
+    levels.update(log_config.get('levels', {}))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, console_handler, buffered_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+# Write the records still queued and buffered and close the log file
+def stop_logging(listener):
+    listener.stop()
+    for handler in listener.handlers:
+        target = getattr(handler, 'target', None)
+        handler.close()
+        if target is not None:
+            target.close()
@@ -0,0 +1,260 @@
+# Disk-backed store-and-forward queue of the MQTT messages.
+#
+# Messages are appended to a SQLite table as soon as they are built, so querying the car or the
+# GPS never waits for the broker. A background sender thread (or coroutine) drains the queue in batches while the
+# MQTT client is connected and deletes the messages once they have been sent. When there is no
+# connectivity (tunnels, garages...) messages stay on disk, even if the script is restarted.
+#
+# The queue is bounded: messages older than max_age seconds and the oldest ones above max_messages
+# are evicted when new messages are added.
+#
+# Messages are sent in the order they were queued. Only the first messages of a batch that were
+# sent one after the other are removed from the queue, the rest are sent again in the next batch,
+# so a retained topic never ends up with an older value than the last one queued.
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+class MessageQueue(object):
+    def __init__(self, path, max_messages=10000, max_age=7 * 24 * 3600, logger_name='queue'):
+        self.path = path
+        self.max_messages = int(max_messages) if max_messages else None
+        self.max_age = float(max_age) if max_age else None
+        self.logger = logging.getLogger(logger_name)
+        self.lock = threading.Lock()
+        self.not_empty = threading.Event()
+        self.on_put = None      # Called (from the thread that queued them) when messages are queued
+        self.evicted = 0
+        # Autocommit mode, transactions are explicit
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'created REAL NOT NULL, '
+                        'topic TEXT NOT NULL, '
+                        'payload BLOB, '
+                        'qos INTEGER NOT NULL, '
+                        'retain INTEGER NOT NULL)')
+        pending = len(self)
+        if pending:
+            self.logger.info("%s message(s) pending in queue %s", pending, path)
+            self.not_empty.set()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    # Append messages ({'topic', 'payload', 'qos', 'retain'} dicts) to the queue
+    def put(self, msgs):
+        if not msgs:
+            return
+        now = time.time()
+        rows = [(now, msg['topic'], msg['payload'], msg.get('qos', 0), 1 if msg.get('retain', False) else 0) for msg in msgs]
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany('INSERT INTO messages (created, topic, payload, qos, retain) VALUES (?, ?, ?, ?, ?)', rows)
+                self.evict(now)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        self.not_empty.set()
+        if self.on_put is not None:
+            self.on_put()
+
+    # Remove the messages that are too old and the oldest ones when the queue is full.
+    # Must be called with the lock held.
+    def evict(self, now):
+        evicted = 0
+        if self.max_age is not None:
+            evicted += self.db.execute('DELETE FROM messages WHERE created < ?', (now - self.max_age,)).rowcount
+        if self.max_messages is not None:
+            evicted += self.db.execute('DELETE FROM messages WHERE id <= '
+                                       '(SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?)', (self.max_messages,)).rowcount
+        if evicted > 0:
+            self.evicted += evicted
+            self.logger.warning("%s message(s) evicted from queue (%s so far)", evicted, self.evicted)
+
+    # Oldest messages of the queue as a list of (id, message) without removing them
+    def peek(self, limit):
+        with self.lock:
+            rows = self.db.execute('SELECT id, topic, payload, qos, retain FROM messages ORDER BY id LIMIT ?', (int(limit),)).fetchall()
+        return [(row[0], {'topic': row[1], 'payload': row[2], 'qos': row[3], 'retain': bool(row[4])}) for row in rows]
+
+    # Remove sent messages from the queue
+    def ack(self, ids):
+        if not ids:
+            return
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM messages WHERE id = ?', [(message_id,) for message_id in ids])
+            self.db.execute('COMMIT')
+
+    # Wait up to timeout seconds for new messages. Returns whether there may be messages to send.
+    def wait(self, timeout):
+        return self.not_empty.wait(timeout)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# Thread sending the queued messages with an MQTT client whose network loop is already running
+# (loop_start) and that sets client.connected_flag in its on_connect/on_disconnect callbacks.
+# Remove from the queue the first messages of a batch that were published one after the other.
+# results is a list of (id, MQTTMessageInfo). Returns how many were removed.
+def ack_published(queue, results):
+    sent = []
+    for message_id, result in results:
+        if not result.is_published():
+            break
+        sent.append(message_id)
+    queue.ack(sent)
+    return len(sent)
+
+class QueueSender(threading.Thread):
+    def __init__(self, queue, client, batch_size=50, publish_timeout=10, retry_interval=1):
+        threading.Thread.__init__(self, name='mqtt-queue-sender')
+        self.daemon = True
+        self.queue = queue
+        self.client = client
+        self.batch_size = int(batch_size)
+        self.publish_timeout = float(publish_timeout)
+        self.retry_interval = float(retry_interval)
+        self.running = True
+        self.sent = 0
+        self.metrics = None     # Records the seconds to publish each batch (see metrics.py)
+        self.logger = queue.logger
+
+    def stop(self):
+        self.running = False
+        self.queue.not_empty.set()
+        self.join()
+
+    def run(self):
+        while self.running:
+            try:
+                if not getattr(self.client, 'connected_flag', False):
+                    time.sleep(self.retry_interval)
+                    continue
+                # Cleared before reading so messages queued meanwhile wake up the next wait
+                self.queue.not_empty.clear()
+                batch = self.queue.peek(self.batch_size)
+                if not batch:
+                    self.queue.wait(self.retry_interval)
+                    continue
+                if self.send_batch(batch) < len(batch):
+                    time.sleep(self.retry_interval)
+            except Exception as err:
+                self.logger.error("Error sending queued messages: %s", err, exc_info=False)
+                time.sleep(self.retry_interval)
+
+    # Publish a batch of messages and remove the ones sent from the queue. Returns how many were sent.
+    def send_batch(self, batch):
+        start = time.perf_counter()
+        results = []
+        for message_id, msg in batch:
+            result = self.client.publish(topic=msg['topic'], payload=msg['payload'], qos=msg['qos'], retain=msg['retain'])
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            results.append((message_id, result))
+
+        deadline = time.time() + self.publish_timeout
+        while self.running and time.time() < deadline and not all(result.is_published() for message_id, result in results):
+            time.sleep(0.05)
+
+        sent = ack_published(self.queue, results)
+        self.sent += sent
+        if self.metrics is not None and results and sent == len(results):
+            self.metrics.observe('mqtt_publish', time.perf_counter() - start)
+        self.logger.debug("%s of %s queued message(s) sent", sent, len(batch))
+        return sent
+
+    # Wait up to timeout seconds for the queue to be empty. Returns the number of messages left.
+    def wait_until_empty(self, timeout):
+        deadline = time.time() + timeout
+        pending = len(self.queue)
+        while pending and time.time() < deadline:
+            time.sleep(0.1)
+            pending = len(self.queue)
+        return pending
+
+# Same as QueueSender as a coroutine of an asyncio event loop, for an MQTT client whose network loop
+# is run by the same event loop (see mqtt_asyncio.py). Publishing never blocks the loop: it waits for
+# the acknowledgements while the other coroutines run.
+class AsyncQueueSender(object):
+    def __init__(self, queue, client, loop, batch_size=50, publish_timeout=10, retry_interval=1):
+        self.queue = queue
+        self.client = client
+        self.loop = loop
+        self.batch_size = int(batch_size)
+        self.publish_timeout = float(publish_timeout)
+        self.retry_interval = float(retry_interval)
+        self.running = True
+        self.sent = 0
+        self.metrics = None     # Records the seconds to publish each batch (see metrics.py)
+        self.logger = queue.logger
+        self.wakeup = asyncio.Event()
+        queue.on_put = self.notify
+
+    # Wake up the sender when messages are queued (from any thread)
+    def notify(self):
+        try:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        except RuntimeError:
+            pass    # Event loop already closed
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while self.running:
+            try:
+                if not getattr(self.client, 'connected_flag', False):
+                    await asyncio.sleep(self.retry_interval)
+                    continue
+                # Cleared before reading so messages queued meanwhile wake up the next wait
+                self.wakeup.clear()
+                batch = self.queue.peek(self.batch_size)
+                if not batch:
+                    await self.wait(self.retry_interval)
+                    continue
+                if await self.send_batch(batch) < len(batch):
+                    await asyncio.sleep(self.retry_interval)
+            except Exception as err:
+                self.logger.error("Error sending queued messages: %s", err, exc_info=False)
+                await asyncio.sleep(self.retry_interval)
+
+    # Publish a batch of messages and remove the ones sent from the queue. Returns how many were sent.
+    async def send_batch(self, batch):
+        start = time.perf_counter()
+        results = []
+        for message_id, msg in batch:
+            result = self.client.publish(topic=msg['topic'], payload=msg['payload'], qos=msg['qos'], retain=msg['retain'])
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            results.append((message_id, result))
+
+        deadline = time.time() + self.publish_timeout
+        while self.running and time.time() < deadline and not all(result.is_published() for message_id, result in results):
+            await asyncio.sleep(0.01)
+
+        sent = ack_published(self.queue, results)
+        self.sent += sent
+        if self.metrics is not None and results and sent == len(results):
+            self.metrics.observe('mqtt_publish', time.perf_counter() - start)
+        self.logger.debug("%s of %s queued message(s) sent", sent, len(batch))
+        return sent
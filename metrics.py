@@ -0,0 +1,196 @@
+# Runtime metrics of the scripts, aggregated in the process: latency histograms (OBDII commands by
+# ECU and command, response decoding, MQTT publishing, polling groups, GPS fix age), counters
+# (retries, timeouts...) and the memory and CPU used by the process.
+#
+# Histograms count the values in fixed buckets (upper bounds in seconds), so recording a value is
+# a bisect and an increment. The percentiles reported are estimated from the buckets.
+# Values are cumulative since the script started, like Prometheus counters.
+#
+# The metrics are published to the metrics topic as a JSON object:
+#   {"timestamp", "uptime" (s), "rss" (MB), "cpu" (% since the last message),
+#    "<histogram>": {"<labels>": {"count", "mean", "max", "p50", "p95"}},
+#    "<counter>": {"<labels>": value}}
+# where <labels> are the label values joined by spaces (i.e. "7E4 2101"), or served in the Prometheus
+# text format by a local HTTP server (start_http_server).
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Upper bounds in seconds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Prefix of the Prometheus metric names
+PROMETHEUS_PREFIX = 'pioniq_'
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # The last one is above the last bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Estimated value below which a fraction q of the values are (linear inside the bucket)
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.max
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = min(self.buckets[index], self.max)
+                return lower + (upper - lower) * max(0.0, rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'max': round(self.max, 6),
+            'p50': round(self.quantile(0.5), 6) if self.count else None,
+            'p95': round(self.quantile(0.95), 6) if self.count else None
+        }
+
+# Resident memory of the process in bytes (max resident memory where /proc is not available)
+def resident_memory():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Metrics(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.histograms = {}    # Histogram by name and labels
+        self.counters = {}      # Value by name and labels
+        self.label_names = {}   # Label names by metric name
+        self.start = time.time()
+        self.last_cpu = (time.monotonic(), time.process_time())
+
+    def key(self, name, labels):
+        if name not in self.label_names:
+            self.label_names[name] = tuple(labels)
+        return name, tuple(str(labels[label]) for label in self.label_names[name])
+
+    # Record a value (seconds) in the histogram name of the labels (keyword arguments)
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self.key(name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            key = self.key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Message of the metrics topic (see above)
+    def message(self):
+        now = time.monotonic()
+        cpu = time.process_time()
+        last_now, last_cpu = self.last_cpu
+        self.last_cpu = (now, cpu)
+        rss = resident_memory()
+        message = {
+            'timestamp': int(round(time.time())),
+            'uptime': int(round(time.time() - self.start)),
+            'rss': round(rss / 1048576.0, 1) if rss is not None else None,
+            'cpu': round((cpu - last_cpu) / (now - last_now) * 100, 1) if now > last_now else None
+        }
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                message.setdefault(name, {})[' '.join(labels)] = histogram.summary()
+            for (name, labels), value in sorted(self.counters.items()):
+                message.setdefault(name, {})[' '.join(labels)] = value
+        return message
+
+    # Metrics in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        def label_string(name, labels, extra=()):
+            pairs = list(zip(self.label_names[name], labels)) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"')) for label, value in pairs) + '}'
+        with self.lock:
+            declared = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = PROMETHEUS_PREFIX + name + '_seconds'
+                if metric not in declared:
+                    declared.add(metric)
+                    lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(metric, label_string(name, labels, [('le', '+Inf' if bound == float('inf') else repr(bound))]), cumulative))
+                lines.append('{}_sum{} {!r}'.format(metric, label_string(name, labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(metric, label_string(name, labels), histogram.count))
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = PROMETHEUS_PREFIX + name + '_total'
+                if metric not in declared:
+                    declared.add(metric)
+                    lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{}{} {}'.format(metric, label_string(name, labels), value))
+        rss = resident_memory()
+        if rss is not None:
+            lines.append('# TYPE process_resident_memory_bytes gauge')
+            lines.append('process_resident_memory_bytes {}'.format(rss))
+        lines.append('# TYPE process_cpu_seconds_total counter')
+        lines.append('process_cpu_seconds_total {!r}'.format(time.process_time()))
+        lines.append('# TYPE process_start_time_seconds gauge')
+        lines.append('process_start_time_seconds {!r}'.format(self.start))
+        return '\n'.join(lines) + '\n'
+
+    # MQTT message of the metrics (not retained, not filtered by change detection)
+    def mqtt_message(self, topic):
+        return {'topic': topic, 'payload': json.dumps(self.message()), 'qos': 0, 'retain': False}
+
+# Serve the metrics in the Prometheus text format on http://host:port/metrics from a background thread.
+# Returns the server (call shutdown to stop it).
+def start_http_server(metrics, port, host='127.0.0.1'):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass    # Scrapes are not logged
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,85 @@
+# Network loop of a paho MQTT client run by an asyncio event loop instead of its own thread
+# (loop_start). The client socket is watched with loop.add_reader/add_writer through the paho socket
+# callbacks, keep alive pings are sent from a coroutine and the client reconnects with an increasing
+# delay when the connection is lost.
+#
+# Connecting (TCP and TLS handshake) is blocking in paho, it's done in the default executor so a
+# broker that can't be reached never stalls the event loop.
+
+import asyncio
+import logging
+import random
+import threading
+
+class AsyncMqttLoop(object):
+    def __init__(self, client, loop, min_delay=1, max_delay=120, misc_interval=1, logger_name='mqtt'):
+        self.client = client
+        self.loop = loop
+        self.min_delay = float(min_delay)
+        self.max_delay = float(max_delay)
+        self.misc_interval = float(misc_interval)
+        self.running = True
+        self.logger = logging.getLogger(logger_name)
+        self.thread = threading.get_ident()     # Event loop thread
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # Run function in the event loop thread (the socket callbacks are also called from the executor while connecting)
+    def call(self, function, *args):
+        if threading.get_ident() == self.thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call(self.loop.add_reader, sock, self.on_readable)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call(self.loop.remove_reader, sock)
+        self.call(self.loop.remove_writer, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call(self.loop.add_writer, sock, self.on_writable)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call(self.loop.remove_writer, sock)
+
+    def on_readable(self):
+        self.client.loop_read()
+        # TLS records already decrypted are not signaled by the socket
+        sock = self.client.socket()
+        while sock is not None and hasattr(sock, 'pending') and sock.pending():
+            self.client.loop_read()
+            sock = self.client.socket()
+
+    def on_writable(self):
+        self.client.loop_write()
+
+    # Connect (connect_async must have been called) and keep the connection alive until stop is called
+    async def run(self):
+        delay = self.min_delay
+        while self.running:
+            if self.client.socket() is None:
+                self.logger.debug("Connecting to MQTT server")
+                try:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    delay = self.min_delay
+                except (OSError, ValueError) as err:
+                    wait = random.uniform(delay / 2, delay)
+                    self.logger.warning("Could not connect to MQTT: %s. Retrying in %.1f second(s)...", err, wait)
+                    await asyncio.sleep(wait)
+                    delay = min(self.max_delay, delay * 2)
+                    continue
+            self.client.loop_misc()
+            await asyncio.sleep(self.misc_interval)
+
+    # Disconnect and wait up to timeout seconds for the DISCONNECT packet to be sent
+    async def stop(self, timeout=2):
+        self.running = False
+        if self.client.socket() is not None:
+            self.client.disconnect()
+            deadline = self.loop.time() + timeout
+            while self.client.socket() is not None and self.loop.time() < deadline:
+                await asyncio.sleep(0.05)
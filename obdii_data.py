@@ -1,40 +1,118 @@
 #!/usr/bin/python
 
-import paho.mqtt.publish as publish
 import paho.mqtt.client as mqtt
 import ssl
 import time
 import json
 import logging
-import logging.handlers
 import os
 import codecs
+import math
+import random
 
 import obd
+import serial
 
 from obd import OBDCommand, OBDStatus
 from obd.protocols import ECU
 from obd.decoders import raw_string
-from obd.utils import bytes_to_int
+
+import battery_cells
+from isotp_decoder import CanError, reassemble
+from message_queue import MessageQueue, QueueSender
+from change_filter import ChangeFilter
+from payload_encoding import PayloadEncoder, load_schemas
+from can_capture import CaptureWriter
+from scheduler import PollingScheduler, PollingTask
+from circuit_breaker import CircuitBreaker
+from vehicle_state import VehicleState
+from connection_cache import ConnectionCache
+from log_setup import setup_logging, stop_logging
+from metrics import Metrics, start_http_server
+from timeseries import TimeSeriesStore, DEFAULT_TOPICS
+from elm327_baudrate import BaudrateError, negotiate_baudrate, reset_baudrate
+from can_monitor import MONITOR_COMMAND, MonitorParser, decode_lines, filter_commands, monitor_port
+import signals
+from signals import load_signal_table
 
 class ConnectionError(Exception): pass
 
-class CanError(Exception): pass
-
-def bytes_to_int_signed(b):
-    '''Convert big-endian signed integer bytearray to int
-    int_from_bytes(b) == int.from_bytes(b, 'big', signed=True)'''
-    if not b: # special-case 0 to avoid b[0] raising
-        return 0
-    n = b[0] & 0x7f # skip sign bit
-    for by in b[1:]:
-        n = n * 256 + by
-    if b[0] & 0x80: # if sign bit is set, 2's complement
-        bits = 8*len(b)
-        offset = 2**(bits-1)
-        return n - offset
-    else:
-        return n
+# The ECU did not answer (i.e. asleep with the car off). Not retried.
+class NoDataError(CanError): pass
+
+# The ECU is skipped because it failed too many times in a row
+class EcuUnavailableError(CanError): pass
+
+logger = logging.getLogger('obdii')
+
+MAX_ATTEMPTS = 3
+
+connection = None
+
+mqtt_client = None
+message_queue = None
+queue_sender = None
+
+change_filter = ChangeFilter({})
+
+payload_encoder = PayloadEncoder({})
+
+# Recorder of the raw requests and responses (when capture is enabled)
+capture_writer = None
+
+# Local history of the information (created from config['store'] in main when enabled, see timeseries.py)
+store = None
+
+vehicle_vin = None
+
+# ELM327 CAN configuration (header, receive filter and timeout) currently set in the adapter
+adapter_state = {}
+
+# ECU selected with select_ecu, the one the queries are sent to
+current_ecu = None
+
+# Skips the ECUs that keep failing (created from config['retry'] in main)
+circuit_breaker = CircuitBreaker()
+
+# AT commands built at runtime (ATST, ATAT) by command
+at_commands = {}
+
+# Number of frames of the extended commands responses by ECU and command ("7E4 2101"), see framed_command
+response_frames = {}
+
+# Extended commands with the number of frames expected appended, by command string
+framed_commands = {}
+
+# Protocol, baud rate and timing that worked on the last connection (created from config['serial'] in main)
+connection_cache = None
+
+# Function returning the GPS location nearest to a timestamp, added to the published information (set by collector.py)
+location_provider = None
+
+# Non-blocking transport the commands are sent through instead of python-OBD once connected (set by collector.py, see elm327_transport.py)
+transport = None
+
+# Latency histograms and counters published to the metrics topic (see metrics.py)
+metrics = Metrics()
+
+# State of the car used to choose the polling profile in daemon mode (created from config['vehicle_state'] in main)
+vehicle_state = VehicleState()
+
+# Compiled decoders of the responses signals defined in signals.json
+signal_decoders = load_signal_table(os.path.dirname(os.path.realpath(__file__)) + '/signals.json')
+
+# Number of ISO-TP frames of a response of data_length bytes: a single frame holds up to 7 bytes,
+# a first frame 6 and each consecutive frame 7 more
+def frame_count(data_length):
+    return 1 if data_length <= 7 else 1 + int(math.ceil((data_length - 6) / 7.0))
+
+def response_key(ecu, command):
+    return "{} {}".format(ecu, command.decode().upper())
+
+# Number of frames of the responses with a length in the signal table
+def expected_response_frames():
+    return dict((response_key(decoder.ecu, decoder.pid.encode()), frame_count(decoder.length))
+                for decoder in signal_decoders.values() if decoder.ecu and decoder.pid and decoder.length)
 
 # CAN response decoder. This function returns a bytearray containing ONLY the data.
 # CAN response data format:
@@ -100,65 +178,29 @@ def bytes_to_int_signed(b):
 # 7EC         2                                 8           0000000003E8  00 -> + 6 bytes of data (total 61 bytes)
 #                                                                         |
 #                                                                         Not part of the data (as it's bigger than 03D = 61 bytes of data)
+#
+# Frames are reassembled by isotp_decoder.reassemble, which also supports 29-bit identifiers.
 def can_response(can_message):
-    data = None
-    data_len = 0
-    last_idx = 0
-    raw = can_message[0].raw().split('\n')
-    for line in raw:
-        if (len(line) != 19):
-            raise ValueError('Error parsing CAN response: {}. Invalid line length {}!=19. '.format(line,len(line)))
-
-        offset = 3
-        identifier = int(line[0:offset], 16)
-
-        frame_type = int(line[offset:offset+1], 16)
-
-        if frame_type == 0:     # Single frame
-            data_len = int(line[offset+1:offset+2], 16)
-            data = bytes.fromhex(line[offset+2:data_len*2+offset+2])
-            break
-
-        elif frame_type == 1:   # First frame
-            data_len = int(line[offset+1:offset+4], 16)
-            data = bytearray.fromhex(line[offset+4:])
-            last_idx = 0
-
-        elif frame_type == 2:   # Consecutive frame
-            idx = int(line[offset+1:offset+2], 16)
-            if (last_idx + 1) % 0x10 != idx:
-                raise CanError("Bad frame order: last_idx({}) idx({})".format(last_idx,idx))
-
-            frame_len = min(7, data_len - len(data))
-            data.extend(bytearray.fromhex(line[offset+2:frame_len*2+offset+2]))
-            last_idx = idx
-
-            if data_len == len(data):
-                break
-
-        else:                   # Unexpected frame
-            raise ValueError('Unexpected frame')
-    #logger.debug("Expected data length: {}".format(data_len))
+    start = time.perf_counter()
+    frames = can_message[0].frames
+    if frames and frames[0].raw.replace(' ', '') == 'NODATA':
+        raise NoDataError("NO DATA")
+    data = reassemble([frame.raw for frame in frames])
+    metrics.observe('decode_time', time.perf_counter() - start)
     return data
 
 # The same as can_response decoder but logging data in binary, decimal and hex for debugging purposes
 def log_can_response(can_message):
     raw = can_response(can_message)
+    if not logger.isEnabledFor(logging.DEBUG):
+        return raw
     for i in range(0, len(raw)):
-        logger.debug("Data[{}]:{} - {} - {}".format(i,'{0:08b}'.format(raw[i]),raw[i], hex(raw[i])))
+        logger.debug("Data[%s]:%s - %s - %s", i, '{0:08b}'.format(raw[i]), raw[i], hex(raw[i]))
     return raw
 
-# Extract VIN from raw can response
-def extract_vin(raw_can_response): 
-    vin_str = ""
-    for v in range(16, 33):
-        vin_str = vin_str + chr(bytes_to_int(raw_can_response.value[v:v+1]))
-    return vin_str
-
-# Extract gear stick position from raw can response
-def extract_gear(raw_can_response): 
+# Extract gear stick position from the gear bits of VMCU 2101 response
+def extract_gear(gear_bits): 
     gear_str = ""
-    gear_bits = raw_can_response.value[7]
     if gear_bits & 0x1: # 1st bit is 1
         gear_str = gear_str + "P" 
     if gear_bits & 0x2: # 2nd bit is 1
@@ -170,51 +212,560 @@ def extract_gear(raw_can_response):
 
     return gear_str
 
-def obd_connect():
+# OBDII commands used to query the car
+cmd_can_header_7e4 =  OBDCommand("ATSH7E4",
+                        "Set CAN module ID to 7E4 - BMS battery information",
+                        b"ATSH7E4",
+                        0,
+                        raw_string,
+                        ECU.ALL,
+                        False)
+
+cmd_can_header_7c6 =  OBDCommand("ATSH7C6",
+                        "Set CAN module ID to 7C6 - Odometer information",
+                        b"ATSH7C6",
+                        0,
+                        raw_string,
+                        ECU.ALL,
+                        False)
+
+cmd_can_header_7e2 =  OBDCommand("ATSH7E2",
+                        "Set CAN module ID to 7E2 - VMCU information",
+                        b"ATSH7E2",
+                        0,
+                        raw_string,
+                        ECU.ALL,
+                        False)
+
+cmd_can_header_7a0 =  OBDCommand("ATSH7A0",
+                        "Set CAN module ID to 7A0 - TPMS information",
+                        b"ATSH7A0",
+                        0,
+                        raw_string,
+                        ECU.ALL,
+                        False)
+
+cmd_can_header_7e6 =  OBDCommand("ATSH7E6",
+                        "Set CAN module ID to 7E6 - External temp information",
+                        b"ATSH7E6",
+                        0,
+                        raw_string,
+                        ECU.ALL,
+                        False)
+
+cmd_can_receive_address_7ec = OBDCommand("ATCRA7EC",
+                                    "Set the CAN receive address to 7EC",
+                                    b"ATCRA7EC",
+                                    0,
+                                    raw_string,
+                                    ECU.ALL,
+                                    False)
+
+cmd_can_receive_address_7ea = OBDCommand("ATCRA7EA",
+                                    "Set the CAN receive address to 7EA",
+                                    b"ATCRA7EA",
+                                    0,
+                                    raw_string,
+                                    ECU.ALL,
+                                    False)
+
+cmd_can_receive_address_7a8 = OBDCommand("ATCRA7A8",
+                                    "Set the CAN receive address to 7A8",
+                                    b"ATCRA7A8",
+                                    0,
+                                    raw_string,
+                                    ECU.ALL,
+                                    False)
+
+cmd_can_receive_address_7ee = OBDCommand("ATCRA7EE",
+                                    "Set the CAN receive address to 7EE",
+                                    b"ATCRA7EE",
+                                    0,
+                                    raw_string,
+                                    ECU.ALL,
+                                    False)
+
+cmd_can_filter_7ce = OBDCommand("ATCF7CE",
+                            "Set the CAN filter to 7CE",
+                            b"ATCF7CE",
+                            0,
+                            raw_string,
+                            ECU.ALL,
+                            False)
+
+cmd_bms_2101 = OBDCommand("2101",
+                    "Extended command - BMS Battery information",
+                    b"2101",
+                    0, #61
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_bms_2102 = OBDCommand("2102",
+                    "Extended command - BMS Battery information",
+                    b"2102",
+                    0, #38
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_bms_2103 = OBDCommand("2103",
+                    "Extended command - BMS Battery information",
+                    b"2103",
+                    0, #38
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_bms_2104 = OBDCommand("2104",
+                    "Extended command - BMS Battery information",
+                    b"2104",
+                    0, #38
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_bms_2105 = OBDCommand("2105",
+                    "Extended command - BMS Battery information",
+                    b"2105",
+                    0, #45
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_odometer = OBDCommand("22b002",
+                    "Extended command - Odometer information",
+                    b"22b002",
+                    0, #15
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_vin = OBDCommand("1A80",
+                    "Extended command - Vehicle Identification Number",
+                    b"1A80",
+                    0, #99
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_vmcu_2101 = OBDCommand("2101",
+                    "Extended command - VMCU information",
+                    b"2101",
+                    0, #22
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_tpms_22c00b = OBDCommand("22C00B",
+                    "Extended command - TPMS information",
+                    b"22C00B",
+                    0, #23
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+cmd_ext_temp = OBDCommand("2180",
+                    "Extended command - External temperature",
+                    b"2180",
+                    0, #25
+                    can_response,
+                    ECU.ALL,
+                    False)
+
+# ECUs: CAN header and the commands to set the CAN receive address/filter for their responses
+ECU_BMS      = ('7E4', cmd_can_header_7e4, (cmd_can_receive_address_7ec,))
+ECU_VMCU     = ('7E2', cmd_can_header_7e2, (cmd_can_receive_address_7ea,))
+ECU_ODOMETER = ('7C6', cmd_can_header_7c6, (cmd_can_receive_address_7ec, cmd_can_filter_7ce))
+ECU_TPMS     = ('7A0', cmd_can_header_7a0, (cmd_can_receive_address_7a8,))
+ECU_EXT_TEMP = ('7E6', cmd_can_header_7e6, (cmd_can_receive_address_7ee,))
+
+# Send the ATSH/ATCRA/ATCF commands needed to talk to the ECU, skipping the ones
+# that would not change the current adapter configuration (each one is a serial round-trip).
+# ATCRA resets the filter set by ATCF, so receive commands are tracked as a sequence and only
+# the commands following the already applied ones are sent.
+def select_ecu(ecu):
+    global current_ecu
+    name, header, receive_filter = ecu
+    if not circuit_breaker.allow(name):
+        raise EcuUnavailableError("ECU {} skipped for {:.0f} more second(s) after failing repeatedly".format(name, circuit_breaker.remaining_cooldown(name)))
+    current_ecu = name
+    if adapter_state.get('header') != header.command:
+        # Forget the state until the adapter confirms it, so a failure forces a resend next time
+        adapter_state.pop('header', None)
+        query_command(header)
+        adapter_state['header'] = header.command
+    else:
+        logger.debug("CAN header already set to %s", name)
+
+    wanted = tuple(cmd.command for cmd in receive_filter)
+    current = adapter_state.get('receive_filter', ())
+    if current == wanted:
+        logger.debug("CAN receive filter already set for %s", name)
+        return
+    # Reuse the current configuration if it's the beginning of the wanted one
+    start = len(current) if wanted[:len(current)] == current and current else 0
+    adapter_state.pop('receive_filter', None)
+    for cmd in receive_filter[start:]:
+        query_command(cmd)
+    adapter_state['receive_filter'] = wanted
+
+# python-OBD connection that doesn't query the car for its supported standard PIDs (only extended
+# commands are sent, always forced), used when the connection settings are known.
+class FastOBD(obd.OBD):
+    def _OBD__load_commands(self):
+        logger.debug("Supported commands not loaded (fast init)")
+
+# AT command built at runtime
+def at_command(command, description):
+    if command not in at_commands:
+        at_commands[command] = OBDCommand(command,
+                                          description,
+                                          command.encode(),
+                                          0,
+                                          raw_string,
+                                          ECU.ALL,
+                                          False)
+    return at_commands[command]
+
+# Send ATAT (adaptive timing) and ATST (timeout) values to the adapter
+def set_adapter_timing(adaptive_timing=None, timeout=None):
+    try:
+        if adaptive_timing is not None:
+            query_command(at_command("ATAT{}".format(adaptive_timing), "Set adaptive timing {}".format(adaptive_timing)))
+            adapter_state['adaptive_timing'] = adaptive_timing
+        if timeout is not None:
+            query_command(at_command("ATST{:02X}".format(timeout), "Set timeout to {} ms".format(timeout * 4)))
+            adapter_state['timeout'] = timeout
+    except (ValueError, CanError) as err:
+        logger.warning("Could not set adapter timing: %s", err)
+
+# Store the timing in effect the first time an extended command gets a valid response after connecting
+def save_adapter_timing():
+    if connection_cache is not None and not adapter_state.get('timing_saved'):
+        adapter_state['timing_saved'] = True
+        connection_cache.update(config['serial']['port'],
+                                adaptive_timing=adapter_state.get('adaptive_timing'),
+                                timeout=adapter_state.get('timeout'))
+
+# Connect with the protocol and baud rate of the cache, skipping the protocol detection
+def fast_connect(cached):
+    logger.info("Connecting with cached protocol %s at %s bauds", cached['protocol'], cached['baudrate'])
+    obd_connection = FastOBD(portstr=config['serial']['port'], baudrate=int(cached['baudrate']), protocol=cached['protocol'], fast=True, timeout=float(config['serial'].get('timeout', 30)))
+    if obd_connection.status() != OBDStatus.CAR_CONNECTED:
+        logger.warning("Fast init failed (%s), detecting the protocol", obd_connection.status())
+        obd_connection.close()
+        return None
+    return obd_connection
+
+# Connect detecting the protocol, retrying with exponential backoff
+def full_connect():
     connection_count = 0
     obd_connection = None
     while (obd_connection is None or obd_connection.status() != OBDStatus.CAR_CONNECTED) and connection_count < MAX_ATTEMPTS:
         connection_count += 1
         # Establish connection with OBDII dongle
-        obd_connection = obd.OBD(portstr=config['serial']['port'], baudrate=int(config['serial']['baudrate']), fast=False, timeout=30)
+        obd_connection = obd.OBD(portstr=config['serial']['port'], baudrate=int(config['serial']['baudrate']), fast=False, timeout=float(config['serial'].get('timeout', 30)))
         if (obd_connection is None or obd_connection.status() != OBDStatus.CAR_CONNECTED) and connection_count < MAX_ATTEMPTS:
-            logger.warning("{}. Retrying in {} second(s)...".format(obd_connection.status(), connection_count))
-            time.sleep(connection_count)
+            delay = retry_delay(connection_count)
+            logger.warning("%s. Retrying in %.2f second(s)...", obd_connection.status(), delay)
+            # Release the serial port before retrying (it stays open when only the adapter is connected)
+            obd_connection.close()
+            time.sleep(delay)
 
     if obd_connection.status() != OBDStatus.CAR_CONNECTED:
-        raise ConnectionError(obd_connection.status())
+        status = obd_connection.status()
+        obd_connection.close()
+        raise ConnectionError(status)
+    if connection_cache is not None:
+        connection_cache.update(config['serial']['port'],
+                                protocol=obd_connection.protocol_id(),
+                                baudrate=obd_connection.interface._ELM327__port.baudrate)
+    return obd_connection
+
+# Connect with the cached settings if there are (fast init), detecting them otherwise.
+# Returns the connection and whether the cached settings were used.
+def connect_car(cached):
+    obd_connection = None
+    if config['serial'].get('fast_init', True) and 'protocol' in cached and 'baudrate' in cached:
+        obd_connection = fast_connect(cached)
+    if obd_connection is not None:
+        return obd_connection, True
+    if cached.get('fast_baudrate'):
+        # The adapter could still be at the higher baud rate of the last connection
+        try:
+            reset_baudrate(config['serial']['port'], cached['fast_baudrate'])
+        except (serial.SerialException, OSError) as err:
+            logger.warning("Could not reset the adapter baud rate: %s", err)
+    return full_connect(), False
+
+# Switch the adapter to config['serial']['fast_baudrate'] (AT BRD). Rates the adapter doesn't
+# support are remembered in the cache and not tried again. Returns False if the adapter had to be reset.
+def switch_baudrate(obd_connection, cached):
+    baudrate = int(config['serial']['fast_baudrate'])
+    if cached.get('unsupported_baudrate') == baudrate:
+        logger.debug("Adapter does not support %s bauds, not trying again", baudrate)
+        return True
+    reset = False
+    try:
+        actual = negotiate_baudrate(obd_connection.interface, baudrate)
+    except ValueError as err:
+        logger.error("Invalid serial fast_baudrate: %s", err)
+        return True
+    except BaudrateError as err:
+        logger.warning("%s. Connecting again", err)
+        actual = None
+        reset = True
+    if connection_cache is not None:
+        connection_cache.update(config['serial']['port'],
+                                fast_baudrate=actual,
+                                unsupported_baudrate=None if actual else baudrate)
+    return not reset
+
+# Connect to the car: with the cached settings if there are (fast init), detecting them otherwise
+def obd_connect():
+    global connection
+    cached = connection_cache.get(config['serial']['port']) if connection_cache is not None else {}
+    obd_connection, fast_init = connect_car(cached)
+
+    # Higher baud rate for the responses (the adapter goes back to the normal one on every reset)
+    if config['serial'].get('fast_baudrate'):
+        if not switch_baudrate(obd_connection, cached):
+            obd_connection.close()
+            obd_connection, fast_init = connect_car(cached)
+
+    # The adapter has been reset while connecting
+    adapter_state.clear()
+    response_frames.clear()
+    response_frames.update(expected_response_frames())
+    response_frames.update(cached.get('response_frames', {}))
+    if capture_writer is not None:
+        capture_writer.attach(obd_connection.interface)
+    if transport is not None:
+        transport.attach(obd_connection.interface, capture_writer)
+
+    # ATAT and ATST values that worked with the cached settings, the configured ones otherwise
+    connection = obd_connection
+    if fast_init:
+        set_adapter_timing(cached.get('adaptive_timing'), cached.get('timeout'))
     else:
-        return obd_connection
-
+        set_adapter_timing(config['serial'].get('adaptive_timing'))
+    return obd_connection
+
+# Seconds to wait before the next attempt: exponential backoff with jitter (between half and the full delay)
+def retry_delay(attempt):
+    retry_config = config.get('retry', {})
+    delay = min(float(retry_config.get('max_delay', 2.0)), float(retry_config.get('base_delay', 0.25)) * (2 ** (attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+# Timeout to wait for the response of a command in seconds (config['timeouts'] by command, then by ECU, then default)
+def command_timeout(command):
+    timeouts = config.get('timeouts', {})
+    name = command.command.decode().upper()
+    for key in (name, current_ecu, 'default'):
+        if key is not None and key in timeouts:
+            return timeouts[key]
+    return None
+
+# Set the ELM327 response timeout (ATST, in 4 ms units) for a command if it's not already set
+def set_command_timeout(command):
+    timeout = command_timeout(command)
+    if timeout is None:
+        return
+    value = min(255, max(1, int(math.ceil(float(timeout) / 0.004))))
+    if adapter_state.get('timeout') == value:
+        return
+    adapter_state.pop('timeout', None)
+    query_command(at_command("ATST{:02X}".format(value), "Set timeout to {} ms".format(value * 4)))
+    adapter_state['timeout'] = value
+
+# The adapter waits for its timeout (ATST) after the last frame of a response, as it can't know
+# whether more frames are coming, unless the number of frames expected is sent after the command
+# (one hex digit, i.e. 21019). The command with the number of frames of its response, if it's known.
+def framed_command(command):
+    frames = response_frames.get(response_key(current_ecu, command.command))
+    if frames is None or frames > 0xF or not config['serial'].get('expected_frames', True):
+        return command
+    command_string = command.command + "{:X}".format(frames).encode()
+    if command_string not in framed_commands:
+        framed_commands[command_string] = OBDCommand(command.name,
+                                                     command.desc,
+                                                     command_string,
+                                                     command.bytes,
+                                                     command.decode,
+                                                     command.ecu,
+                                                     command.fast)
+    return framed_commands[command_string]
+
+# Store the number of frames of a response if it's not the expected one (the ECU software or the
+# signal table could be different), it's sent with the next queries of the command
+def learn_response_frames(command, response):
+    if not isinstance(response.value, (bytes, bytearray)):
+        return
+    key = response_key(current_ecu, command.command)
+    frames = frame_count(len(response.value))
+    if response_frames.get(key) == frames:
+        return
+    logger.debug("Response of %s has %s frame(s), %s expected", key, frames, response_frames.get(key))
+    response_frames[key] = frames
+    if connection_cache is not None:
+        learned = connection_cache.get(config['serial']['port']).get('response_frames', {})
+        learned[key] = frames
+        connection_cache.update(config['serial']['port'], response_frames=learned)
+
+# Send a command, retrying with exponential backoff when there's no valid response.
+# A NO DATA response (the ECU is not answering) is not retried.
+# Failures and successes of extended commands are reported to the circuit breaker of the current ECU.
+# The latency of each attempt, the retries, the responses without any frame (timeouts) and the
+# failures of extended commands are recorded in the metrics by ECU and command.
 def query_command(command):
+    extended = not command.command.upper().startswith(b"AT")
+    if extended:
+        set_command_timeout(command)
+        labels = {'ecu': current_ecu or '-', 'command': command.command.decode().upper()}
+    max_attempts = int(config.get('retry', {}).get('max_attempts', MAX_ATTEMPTS))
     command_count = 0
     cmd_response = None
-    exception = False
     valid_response = False
-    while not valid_response and command_count < MAX_ATTEMPTS:
+    no_data = False
+    while not valid_response and not no_data and command_count < max_attempts:
         command_count += 1
+        exception = False
+        cmd_response = None
+        sent_command = framed_command(command) if extended else command
+        start = time.perf_counter()
         try:
-            cmd_response = connection.query(command, force=True)
+            if transport is not None and transport.attached:
+                cmd_response = transport.query(sent_command)
+            else:
+                cmd_response = connection.query(sent_command, force=True)
+        except NoDataError:
+            no_data = True
+        except CanError as ex:
+            exception = True
+            logger.debug("Error querying %s: %s", sent_command, ex)
+            if sent_command is not command:
+                # Frames missing after the expected ones, wait for all of them the next time
+                logger.warning("Incomplete response of %s with %s expected frame(s)", command, sent_command.command[-1:].decode())
+                response_frames.pop(response_key(current_ecu, command.command), None)
         except Exception as ex:
             exception = True
-        valid_response = not(cmd_response is None or cmd_response.value == "?" or cmd_response.value == "NO DATA" or cmd_response.value == "" or cmd_response.value is None or exception)
-        if not valid_response and command_count < MAX_ATTEMPTS:
-            logger.warning("No valid response for {}. Retrying in {} second(s)...".format(command, command_count))
-            time.sleep(command_count)
+            logger.debug("Error querying %s: %s", sent_command, ex)
+        if extended:
+            metrics.observe('query_latency', time.perf_counter() - start, **labels)
+            if cmd_response is not None and not cmd_response.messages:
+                metrics.increment('query_timeouts', **labels)
+        if cmd_response is not None and cmd_response.value == "NO DATA":
+            no_data = True
+        valid_response = not(no_data or cmd_response is None or cmd_response.value == "?" or cmd_response.value == "" or cmd_response.value is None or exception)
+        if not valid_response and not no_data and command_count < max_attempts:
+            delay = retry_delay(command_count)
+            logger.warning("No valid response for %s. Retrying in %.2f second(s)...", command, delay)
+            if extended:
+                metrics.increment('query_retries', **labels)
+            time.sleep(delay)
 
     if not valid_response:
-        raise ValueError("No valid response for {}. Max attempts ({}) exceeded.".format(command, MAX_ATTEMPTS))
+        if extended:
+            metrics.increment('query_no_data' if no_data else 'query_failures', **labels)
+        if extended and current_ecu is not None:
+            circuit_breaker.record_failure(current_ecu)
+        if no_data:
+            raise NoDataError("NO DATA for {}".format(command))
+        raise ValueError("No valid response for {}. Max attempts ({}) exceeded.".format(command, max_attempts))
     else:
-        logger.info("Got response from command: {} ".format(command))
+        if extended and current_ecu is not None:
+            circuit_breaker.record_success(current_ecu)
+        if extended:
+            save_adapter_timing()
+            learn_response_frames(command, cmd_response)
+        logger.info("Got response from command: %s ", command)
         return cmd_response
 
+# Decode the signals of a response using the compiled signal table
+def decode_signals(name, data):
+    return signal_decoders[name].decode(data)
+
+# Minutes to complete 100% charge. Estimation based on current charge speed.
+def charge_time_estimation(battery_info):
+    battery_capacity = config['vehicle']['battery_capacity']
+    dcBatteryCurrent = battery_info['dcBatteryCurrent']
+    dcBatteryVoltage = battery_info['dcBatteryVoltage']
+    average_deterioration = (battery_info['dcBatteryCellMaxDeterioration'] + battery_info['dcBatteryCellMinDeterioration']) / 2.0
+    logger.debug("--------------------------------------------- average_deterioration: %s", average_deterioration)
+    lost_soh = 100 - average_deterioration
+    logger.debug("--------------------------------------------- lost_soh: %s", lost_soh)
+    lost_wh = ((battery_capacity * 1000) * lost_soh) / 100
+    logger.debug("--------------------------------------------- lost_wh: %s", lost_wh)
+    remaining_pct = 100 - (min(battery_info['socBms'], battery_info['socDisplay']))
+    logger.debug("--------------------------------------------- remaining_pct: %s", remaining_pct)
+    remaining_wh = (((battery_capacity * 1000) - lost_wh) * remaining_pct) / 100
+    logger.debug("--------------------------------------------- remaining_wh: %s", remaining_wh)
+    charge_power = abs((dcBatteryCurrent * dcBatteryVoltage))
+    logger.debug("--------------------------------------------- charge_power: %s", charge_power)
+    mins_to_complete = int((remaining_wh / charge_power) * 60)
+    logger.debug("--------------------------------------------- mins_to_complete: %s hours %s mins", int(mins_to_complete/60), mins_to_complete%60)
+    return mins_to_complete
+
+# Keys of the module temperatures (dcBatteryModuleTemp01-12) and cell voltages (dcBatteryCellVoltage01-96)
+MODULE_TEMPERATURE_KEYS = tuple("dcBatteryModuleTemp{:02d}".format(i+1) for i in range(12))
+CELL_VOLTAGE_KEYS = tuple("dcBatteryCellVoltage{:02d}".format(i+1) for i in range(96))
+
+# Build battery information from 2101 - 2105 responses data
+def decode_battery_information(data_2101, data_2102, data_2103, data_2104, data_2105):
+    bms_2101 = decode_signals('bms_2101', data_2101)
+    bms_2105 = decode_signals('bms_2105', data_2105)
+
+    # Extract status of health value from corresponding response
+    soh = bms_2105['soh']
+
+    # Only create battery status data if got a consistent Status Of Health (sometimes it's not consistent)
+    if (soh > 100):
+        raise ValueError("Got inconsistent data for battery Status Of Health: {}%".format(soh))
+
+    moduleTemps = bms_2101.pop('moduleTemperatures') + bms_2105.pop('moduleTemperatures')
+
+    # The 96 cell voltages are decoded in one operation per response
+    cellVoltages = battery_cells.concatenate([signal_decoders['bms_2102'].decode_array('cellVoltages', data_2102),
+                                              signal_decoders['bms_2103'].decode_array('cellVoltages', data_2103),
+                                              signal_decoders['bms_2104'].decode_array('cellVoltages', data_2104)])
+
+    battery_info = {
+        'timestamp': int(round(time.time()))
+    }
+    battery_info.update(bms_2101)
+    battery_info.update(bms_2105)
+
+    # Calculate time to 100% charge
+    battery_info['minsToCompleteCharge'] = charge_time_estimation(battery_info) if battery_info['charging'] == 1 else 0 # Mins
+    battery_info['dcBatteryPower'] = round(battery_info['dcBatteryCurrent'] * battery_info['dcBatteryVoltage'] / 1000.0, 3) # kW
+    battery_info['dcBatteryAvgTemperature'] = sum(moduleTemps) / len(moduleTemps) # C
+
+    # Pack diagnostics (min and max cell voltages are already given by the BMS)
+    battery_config = config.get('battery', {})
+    cells = battery_cells.summarize(cellVoltages, battery_config.get('min_cell_voltage'), battery_config.get('max_cell_voltage'))
+    battery_info['dcBatteryCellVoltageMean'] = round(cells['mean'], 3) # V
+    battery_info['dcBatteryCellVoltageStdDev'] = round(cells['stddev'], 4) # V
+    battery_info['dcBatteryCellVoltageImbalance'] = round(cells['imbalance'], 3) # V
+    battery_info['dcBatteryCellsOutOfRange'] = cells['out_of_range'] # Cell numbers (1-96)
+    modules = battery_cells.summarize(moduleTemps)
+    battery_info['dcBatteryModuleTempStdDev'] = round(modules['stddev'], 2) # C
+    battery_info['dcBatteryModuleTempSpread'] = modules['imbalance'] # C
+
+    if battery_config.get('compact_arrays', False):
+        # One array for all the module temperatures and another for all the cell voltages instead of a key for each one
+        battery_info['dcBatteryModuleTemps'] = [float(temp) for temp in moduleTemps]
+        battery_info['dcBatteryCellVoltages'] = battery_cells.to_list(cellVoltages)
+    else:
+        battery_info.update(zip(MODULE_TEMPERATURE_KEYS, map(float, moduleTemps)))
+        battery_info.update(zip(CELL_VOLTAGE_KEYS, battery_cells.to_list(cellVoltages)))
+
+    return battery_info
+
 def query_battery_information():
     logger.info("**** Querying battery information ****")
-    battery_capacity = config['vehicle']['battery_capacity']
-    # Set header to 7E4
-    query_command(cmd_can_header_7e4)
-    # Set the CAN receive address to 7EC
-    query_command(cmd_can_receive_address_7ec)
+    # Set header to 7E4 and the CAN receive address to 7EC
+    select_ecu(ECU_BMS)
 
     # 2101 - 2105 codes to get battery status information
     raw_2101 = query_command(cmd_bms_2101)
@@ -222,218 +773,87 @@ def query_battery_information():
     raw_2103 = query_command(cmd_bms_2103)
     raw_2104 = query_command(cmd_bms_2104)
     raw_2105 = query_command(cmd_bms_2105)
-    
-    # Extract status of health value from corresponding response
-    soh = bytes_to_int(raw_2105.value[27:29]) / 10.0
 
-    battery_info = {}
-    # Only create battery status data if got a consistent Status Of Health (sometimes it's not consistent)
-    if (soh <= 100):
-        chargingBits = raw_2101.value[11]
-        charging = 1 if chargingBits & 0x80 else 0 # 8th bit is 1
-
-        dcBatteryCurrent = bytes_to_int_signed(raw_2101.value[12:14]) / 10.0
-        dcBatteryVoltage = bytes_to_int(raw_2101.value[14:16]) / 10.0
-        
-        dcBatteryCellMaxDeterioration = bytes_to_int(raw_2105.value[27:29]) / 10.0
-        dcBatteryCellMinDeterioration = bytes_to_int(raw_2105.value[30:32]) / 10.0
-        socDisplay = int(raw_2105.value[33] / 2.0)
-        socBms = raw_2101.value[6] / 2.0
-        
-        mins_to_complete = 0
-        
-        # Calculate time to 100% charge
-        if charging == 1: 
-            average_deterioration = (dcBatteryCellMaxDeterioration + dcBatteryCellMinDeterioration) / 2.0
-            logger.debug("--------------------------------------------- average_deterioration: {}".format(average_deterioration))
-            lost_soh = 100 - average_deterioration
-            logger.debug("--------------------------------------------- lost_soh: {}".format(lost_soh))
-            lost_wh = ((battery_capacity * 1000) * lost_soh) / 100
-            logger.debug("--------------------------------------------- lost_wh: {}".format(lost_wh))
-            remaining_pct = 100 - (min(socBms,socDisplay))
-            logger.debug("--------------------------------------------- remaining_pct: {}".format(remaining_pct))
-            remaining_wh = (((battery_capacity * 1000) - lost_wh) * remaining_pct) / 100
-            logger.debug("--------------------------------------------- remaining_wh: {}".format(remaining_wh))
-            charge_power = abs((dcBatteryCurrent * dcBatteryVoltage))
-            logger.debug("--------------------------------------------- charge_power: {}".format(charge_power))
-            mins_to_complete = int((remaining_wh / charge_power) * 60)
-            logger.debug("--------------------------------------------- mins_to_complete: {} hours {} mins".format(int(mins_to_complete/60), mins_to_complete%60))
-
-        moduleTemps = [
-            bytes_to_int_signed(raw_2101.value[18:19]), #  0
-            bytes_to_int_signed(raw_2101.value[19:20]), #  1
-            bytes_to_int_signed(raw_2101.value[20:21]), #  2
-            bytes_to_int_signed(raw_2101.value[21:22]), #  3
-            bytes_to_int_signed(raw_2101.value[22:23]), #  4
-            bytes_to_int_signed(raw_2105.value[11:12]), #  5
-            bytes_to_int_signed(raw_2105.value[12:13]), #  6
-            bytes_to_int_signed(raw_2105.value[13:14]), #  7
-            bytes_to_int_signed(raw_2105.value[14:15]), #  8
-            bytes_to_int_signed(raw_2105.value[15:16]), #  9
-            bytes_to_int_signed(raw_2105.value[16:17]), # 10
-            bytes_to_int_signed(raw_2105.value[17:18])] # 11
-
-        cellVoltages = []
-        for cmd in [raw_2102, raw_2103, raw_2104]:
-            for byte in range(6,38):
-                cellVoltages.append(cmd.value[byte] / 50.0)
-
-        battery_info.update({
-            'timestamp':                       int(round(time.time())),
-
-            'socBms':                          socBms, # %
-            'socDisplay':                      socDisplay, # %
-            'soh':                             soh, # %
-
-            'bmsIgnition':                     1 if raw_2101.value[52] & 0x4 else 0, # 3rd bit is 1 
-            'bmsMainRelay':                    1 if chargingBits & 0x1 else 0, # 1st bit is 1 
-            'auxBatteryVoltage':               raw_2101.value[31] / 10.0, # V
-
-            'charging':                        charging,
-            'normalChargePort':                1 if chargingBits & 0x20 else 0, # 6th bit is 1
-            'rapidChargePort':                 1 if chargingBits & 0x40 else 0, # 7th bit is 1
-            'minsToCompleteCharge':            mins_to_complete, # Mins
-
-            'fanStatus':                       raw_2101.value[29], # Hz
-            'fanFeedback':                     raw_2101.value[30],
-
-            'cumulativeEnergyCharged':         bytes_to_int(raw_2101.value[40:44]) / 10.0, # kWh
-            'cumulativeEnergyDischarged':      bytes_to_int(raw_2101.value[44:48]) / 10.0, # kWh
-
-            'cumulativeChargeCurrent':         bytes_to_int(raw_2101.value[32:36]) / 10.0, # A
-            'cumulativeDischargeCurrent':      bytes_to_int(raw_2101.value[36:40]) / 10.0, # A
-
-            'cumulativeOperatingTime':         bytes_to_int(raw_2101.value[48:52]), # seconds 
-
-            'availableChargePower':            bytes_to_int(raw_2101.value[7:9]) / 100.0, # kW
-            'availableDischargePower':         bytes_to_int(raw_2101.value[9:11]) / 100.0, # kW
-
-            'dcBatteryCellVoltageDeviation':   raw_2105.value[22] / 50, # V 
-            'dcBatteryHeater1Temperature':     float(raw_2105.value[25]), # C 
-            'dcBatteryHeater2Temperature':     float(raw_2105.value[26]), # C 
-            'dcBatteryInletTemperature':       bytes_to_int_signed(raw_2101.value[22:23]), # C
-            'dcBatteryMaxTemperature':         bytes_to_int_signed(raw_2101.value[16:17]), # C
-            'dcBatteryMinTemperature':         bytes_to_int_signed(raw_2101.value[17:18]), # C
-            'dcBatteryCellMaxVoltage':         raw_2101.value[25] / 50, # V
-            'dcBatteryCellNoMaxVoltage':       raw_2101.value[26],
-            'dcBatteryCellMaxDeterioration':   dcBatteryCellMaxDeterioration, # %
-            'dcBatteryCellNoMaxDeterioration': int(raw_2105.value[29]),
-            'dcBatteryCellMinVoltage':         raw_2101.value[27] / 50, # V
-            'dcBatteryCellNoMinVoltage':       raw_2101.value[28],
-            'dcBatteryCellMinDeterioration':   dcBatteryCellMinDeterioration, # %
-            'dcBatteryCellNoMinDeterioration': int(raw_2105.value[32]),
-            'dcBatteryCurrent':                dcBatteryCurrent, # A
-            'dcBatteryPower':                  round(dcBatteryCurrent * dcBatteryVoltage / 1000.0, 3), # kW
-            'dcBatteryVoltage':                dcBatteryVoltage, # V
-            'dcBatteryAvgTemperature':         sum(moduleTemps) / len(moduleTemps), # C
-
-            'driveMotorSpeed':                 bytes_to_int_signed(raw_2101.value[55:57]) # RPM
-            })
-    
-        for i,temp in enumerate(moduleTemps):
-            key = "dcBatteryModuleTemp{:02d}".format(i+1)
-            battery_info[key] = float(temp)
-
-        for i,cvolt in enumerate(cellVoltages):
-            key = "dcBatteryCellVoltage{:02d}".format(i+1)
-            battery_info[key] = float(cvolt)
-
-        logger.info("**** Got battery information ****")
-    else:
-        raise ValueError("Got inconsistent data for battery Status Of Health: {}%".format(soh))
+    battery_info = decode_battery_information(raw_2101.value, raw_2102.value, raw_2103.value, raw_2104.value, raw_2105.value)
+    logger.info("**** Got battery information ****")
     return battery_info
 
 
 def query_odometer():
     logger.info("**** Querying for odometer ****")
     odometer_info = {}
-    # Set header to 7C6
-    query_command(cmd_can_header_7c6)
-    # Set the CAN receive address to 7EC
-    query_command(cmd_can_receive_address_7ec)
-    # Sets the ID filter to 7CE
-    query_command(cmd_can_filter_7ce)
+    # Set header to 7C6, the CAN receive address to 7EC and the ID filter to 7CE
+    select_ecu(ECU_ODOMETER)
     # Query odometer
     raw_odometer = query_command(cmd_odometer)
     # Only set odometer data if present. Not available when car engine is off
-    if 'raw_odometer' in locals() and raw_odometer is not None and raw_odometer.value is not None:
-        odometer_info.update({
-            'timestamp': int(round(time.time())),
-            'odometer': bytes_to_int(raw_odometer.value[9:12])
-        })
+    if raw_odometer is not None and raw_odometer.value is not None:
+        odometer_info['timestamp'] = int(round(time.time()))
+        odometer_info.update(decode_signals('odometer_22b002', raw_odometer.value))
         logger.info("**** Got odometer value ****")
     else:
         raise ValueError("Could not get odometer value")
     return odometer_info
 
 
+def query_vin():
+    global vehicle_vin
+    logger.info("**** Querying for VIN ****")
+    # Set header to 7E2 and the CAN receive address to 7EA
+    select_ecu(ECU_VMCU)
+    raw_vin = query_command(cmd_vin)
+    vin = decode_signals('vin_1a80', raw_vin.value)['vin']
+    if not vin:
+        raise ValueError("Could not get VIN")
+    # VIN never changes so it's kept to be added to every VMCU information
+    vehicle_vin = vin
+    logger.info("**** Got VIN ****")
+    return vin
+
+def decode_vmcu_information(data_2101):
+    vmcu_2101 = decode_signals('vmcu_2101', data_2101)
+    vmcu_info = {
+        'speed':             vmcu_2101['speed'], # kmh. Multiplied by 1.60934 to convert mph to kmh
+        'accel_pedal_depth': vmcu_2101['accel_pedal_depth'], # %
+        'brake_lamp':        vmcu_2101['brake_lamp'], # 1st bit is 1
+        'brakes_on':         vmcu_2101['brakes_on'] # 2nd bit is 0
+    }
+    # Add gear stick position to vmcu info
+    vmcu_info['gear'] = extract_gear(vmcu_2101['gearBits'])
+    return vmcu_info
+
 def query_vmcu_information():
     logger.info("**** Querying for VMCU information ****")
     vmcu_info = {
         'timestamp': int(round(time.time()))
     }
-    # Set header to 7E2
-    query_command(cmd_can_header_7e2)
-    # Set the CAN receive address to 7EA
-    query_command(cmd_can_receive_address_7ea)
+    # Set header to 7E2 and the CAN receive address to 7EA
+    select_ecu(ECU_VMCU)
     
-    # VIN
-    try:
-        raw_vin = query_command(cmd_vin)
-        vin = extract_vin(raw_vin)
-        # Add vin to vmcu info
-        if 'vin' in locals() and vin is not None :
-            vmcu_info['vin'] = vin
-        else :
-            logger.warning("Could not get VIN")
-    except Exception as err:
-        logger.error("Could not get VIN: {}".format(err), exc_info=False)
+    # Add vin to vmcu info
+    if vehicle_vin is not None:
+        vmcu_info['vin'] = vehicle_vin
+    else:
+        logger.warning("Could not get VIN")
 
     try:
         raw_2101 = query_command(cmd_vmcu_2101)
-        gear = extract_gear(raw_2101)
-        brakesBits = raw_2101.value[8]
-        # Add kmh to vmcu info
-        vmcu_info.update({
-            'speed':             (((raw_2101.value[16] * 256) + raw_2101.value[15]) / 100.0 ) * 1.60934, # kmh. Multiplied by 1.60934 to convert mph to kmh
-            'accel_pedal_depth': raw_2101.value[16] / 2, # %
-            'brake_lamp':        1 if brakesBits & 0x1 else 0, # 1st bit is 1
-            'brakes_on':         0 if brakesBits & 0x2 else 1 # 2nd bit is 0
-        })
-
-        # Add gear stick position to vmcu info
-        if 'gear' in locals() and gear is not None:
-            vmcu_info['gear'] = gear
-        else :
-            logger.warning("Could not get gear stick position")
+        vmcu_info.update(decode_vmcu_information(raw_2101.value))
     except Exception as err:
-        logger.error("Could not get VMCU information: {}".format(err), exc_info=False)
+        logger.error("Could not get VMCU information: %s", err, exc_info=False)
     return vmcu_info
 
 def query_tpms_information():
     logger.info("**** Querying for TPMS information ****")
     tpms_info = {}
-    # Set the CAN receive address to 7A8
-    query_command(cmd_can_receive_address_7a8)
-    # Set header to 7A0
-    query_command(cmd_can_header_7a0)
+    # Set header to 7A0 and the CAN receive address to 7A8
+    select_ecu(ECU_TPMS)
     # Query TPMS
     raw_tpms = query_command(cmd_tpms_22c00b)
-    if 'raw_tpms' in locals() and raw_tpms is not None and raw_tpms.value is not None:
-        tpms_info.update({
-            'timestamp': int(round(time.time())),
-            'tire_fl_pressure':    round((raw_tpms.value[7] * 0.2) / 14.504, 1), # bar - Front Left
-            'tire_fl_temperature': raw_tpms.value[8] - 55,  # C   - Front Left
-            
-            'tire_fr_pressure':    round((raw_tpms.value[11] * 0.2) / 14.504, 1), # bar - Front Right
-            'tire_fr_temperature': raw_tpms.value[12] - 55,  # C   - Front Right
-
-            'tire_bl_pressure':    round((raw_tpms.value[19] * 0.2) / 14.504, 1), # bar - Back Left
-            'tire_bl_temperature': raw_tpms.value[20] - 55,  # C   - Back Left
-
-            'tire_br_pressure':    round((raw_tpms.value[15] * 0.2) / 14.504, 1), # bar - Back Right
-            'tire_br_temperature': raw_tpms.value[16] - 55,  # C   - Back Right
-            })
+    if raw_tpms is not None and raw_tpms.value is not None:
+        tpms_info['timestamp'] = int(round(time.time()))
+        # Pressure in bar and temperature in C of each tire
+        tpms_info.update(decode_signals('tpms_22c00b', raw_tpms.value))
         logger.info("**** Got TPMS information ****")
     else:
         raise ValueError("Could not get TPMS information")
@@ -445,297 +865,549 @@ def query_external_temperature():
         'timestamp': int(round(time.time()))
     }
 
-    # Set header to 7E6
-    query_command(cmd_can_header_7e6)
-    # Set the CAN receive address to 7EC
-    query_command(cmd_can_receive_address_7ee)
+    # Set header to 7E6 and the CAN receive address to 7EE
+    select_ecu(ECU_EXT_TEMP)
     # Query external temeprature
     ext_temp = query_command(cmd_ext_temp)
     # Only set temperature data if present.
-    if 'ext_temp' in locals() and ext_temp is not None and ext_temp.value is not None:
+    if ext_temp is not None and ext_temp.value is not None:
         logger.info("**** Got external temperature value ****")
-        ext_temp_info['external_temperature'] = (ext_temp.value[14]-80) / 2.0 # C
+        ext_temp_info.update(decode_signals('ext_temp_2180', ext_temp.value)) # C
     else:
         raise ValueError("Could not get external temperature value")
     return ext_temp_info
 
-# Publish all messages to MQTT
-def publish_data_mqtt(msgs):
+# Responses of the signal table with a topic are not decoded by any of the query functions above.
+# They are queried and published as they are, so adding a PID is only a signals.json change.
+custom_commands = {}
+
+def custom_signal_groups():
+    monitored = set(config.get('monitor', {}).get('ids', {}).values())
+    return [name for name, decoder in sorted(signal_decoders.items()) if decoder.topic and not decoder.broadcast and name not in monitored]
+
+def query_custom_information(name):
+    decoder = signal_decoders[name]
+    logger.info("**** Querying for %s ****", name)
+    if name not in custom_commands:
+        header = int(decoder.ecu, 16)
+        custom_commands[name] = (
+            (decoder.ecu,
+             OBDCommand("ATSH" + decoder.ecu, "Set CAN module ID to " + decoder.ecu, ("ATSH" + decoder.ecu).encode(), 0, raw_string, ECU.ALL, False),
+             # ECUs answer on their CAN ID + 8
+             (OBDCommand("ATCRA{:03X}".format(header + 8), "Set the CAN receive address to {:03X}".format(header + 8), "ATCRA{:03X}".format(header + 8).encode(), 0, raw_string, ECU.ALL, False),)),
+            OBDCommand(decoder.pid, "Extended command - " + name, decoder.pid.encode(), 0, can_response, ECU.ALL, False))
+    ecu, command = custom_commands[name]
+    select_ecu(ecu)
+    response = query_command(command)
+    info = {
+        'timestamp': int(round(time.time()))
+    }
+    info.update(decoder.decode(response.value))
+    logger.info("**** Got %s ****", name)
+    return info
+
+# Signal decoders of the frames read in monitor mode by CAN ID: the responses of the signal table with
+# a broadcast CAN ID and the ones of config['monitor']['ids'] ({"<CAN ID>": "<signal table response>"})
+def broadcast_decoders():
+    decoders = dict((decoder.broadcast.upper(), decoder) for decoder in signal_decoders.values() if decoder.broadcast)
+    for can_id, name in config.get('monitor', {}).get('ids', {}).items():
+        decoders[can_id.upper()] = signal_decoders[name]
+    return decoders
+
+# Listen to the broadcast frames for config['monitor']['duration'] seconds (AT MA with a receive filter)
+# and return the MQTT messages of their samples, one per CAN ID.
+def query_broadcasts():
+    monitor_config = config.get('monitor', {})
+    decoders = broadcast_decoders()
+    duration = float(monitor_config.get('duration', 5))
+    logger.info("**** Monitoring %s for %s second(s) ****", ", ".join(sorted(decoders)), duration)
+    # The receive filter of the last ECU is replaced, it's set again by the next select_ecu
+    adapter_state.pop('receive_filter', None)
+    try:
+        for command in ['ATCAF0'] + filter_commands(sorted(decoders)):
+            query_command(at_command(command, "Set monitor filter " + command))
+        start = time.time()
+        if transport is not None and transport.attached:
+            lines = transport.monitor(MONITOR_COMMAND, duration)
+        else:
+            lines = monitor_port(connection.interface._ELM327__port, duration)
+            if capture_writer is not None:
+                capture_writer.record(MONITOR_COMMAND, [line for timestamp, line in lines])
+    finally:
+        query_command(at_command('ATCAF1', "Set CAN automatic formatting on"))
+
+    parser = MonitorParser(decoders, min_interval=monitor_config.get('min_interval', 0))
+    buffers = decode_lines(parser, lines, start)
+    logger.info("**** Got %s sample(s) from %s frame(s) (%s dropped, %s invalid, %s buffer full) ****", sum(len(buffer) for buffer in buffers.values()), parser.frames, parser.dropped, parser.errors, parser.overflows)
+    mqtt_msgs = []
+    for can_id, buffer in sorted(buffers.items()):
+        decoder = decoders[can_id]
+        mqtt_msgs.extend(topic_messages(decoder.topic or decoder.name, buffer.message()))
+    return mqtt_msgs
+
+#MQTT function for on_connect callback
+def on_connect(client, userdata, flags, rc):
+    if rc==0:
+        client.connected_flag=True #set flag
+        logger.info("Successfully connected to MQTT (session present: %s)", flags.get('session present', 0))
+    else:
+        logger.error("Not connected to MQTT. Bad connection Returned code=%s", rc)
+
+#MQTT function for on_disconnect callback
+def on_disconnect(client, userdata, rc):
+    client.connected_flag=False #clear flag
+    if rc != 0:
+        logger.warning("Unexpectedly disconnected from MQTT. Returned code=%s. Reconnecting...", rc)
+
+# Create the MQTT client used to publish all the messages, without connecting it.
+# As the session is not clean, the broker keeps it between connections.
+def mqtt_create_client():
+    mqtt.Client.connected_flag = False
+    # Create MQTT client
+    client = mqtt.Client(client_id=config['mqtt'].get('client_id', "battery-data-script"), clean_session=False, protocol=mqtt.MQTTv311, transport="tcp")
+    # Assign callback functions
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    # Set tls
+    client.tls_set(tls_version=ssl.PROTOCOL_TLS)
+    # Set user and password
+    client.username_pw_set(user, password)
+    # Backoff between reconnection attempts
+    client.reconnect_delay_set(min_delay=1, max_delay=120)
+    client.connect_async(broker_address, port, keepalive=int(config['mqtt'].get('keepalive', 60)))
+    return client
+
+# Create the MQTT client and start connecting to the broker. The client runs its network loop in
+# background and reconnects automatically when the connection is lost.
+# If wait is given, waits up to wait seconds for the connection to be established.
+def mqtt_connect(wait=None):
+    client = mqtt_create_client()
+    # Conect to MQTT server in background, the network loop keeps retrying until it succeeds
+    logger.debug("Connecting to MQTT server")
+    client.loop_start()
+    if wait:
+        wait_for_mqtt_connection(client, wait)
+    return client
+
+def wait_for_mqtt_connection(client, timeout):
+    deadline = time.time() + timeout
+    while not client.connected_flag and time.time() < deadline:
+        time.sleep(0.1)
+    return client.connected_flag
+
+def mqtt_disconnect(client):
+    client.disconnect()
+    client.loop_stop()
+
+# Open the disk-backed message queue
+def open_message_queue():
+    global message_queue
+    queue_config = config.get('queue', {})
+    message_queue = MessageQueue(queue_config.get('path', os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.queue.db'),
+                                 max_messages=queue_config.get('max_messages', 10000),
+                                 max_age=queue_config.get('max_age', 7 * 24 * 3600),
+                                 logger_name='obdii.queue')
+    return message_queue
+
+# Open the disk-backed message queue and start the thread that sends its messages to MQTT
+def start_message_queue(client):
+    global queue_sender
+    queue_config = config.get('queue', {})
+    open_message_queue()
+    queue_sender = QueueSender(message_queue, client,
+                               batch_size=queue_config.get('batch_size', 50),
+                               publish_timeout=queue_config.get('publish_timeout', 10))
+    queue_sender.metrics = metrics
+    queue_sender.start()
+
+def stop_message_queue():
+    if queue_sender is not None:
+        queue_sender.stop()
+        logger.info("%s message(s) sent to MQTT", queue_sender.sent)
+    if message_queue is not None:
+        message_queue.close()
+
+# Store all messages in the queue, they are sent to MQTT in background when the broker is reachable.
+# If timeout is given, waits up to timeout seconds for the queue to be sent.
+def publish_data_mqtt(msgs, timeout=None):
     try:
         logger.info("Publish messages to MQTT")
         for msg in msgs:
-            logger.info("{}".format(msg))
-
-        publish.multiple(msgs,
-                    hostname=broker_address,
-                    port=port,
-                    client_id="battery-data-script",
-                    keepalive=60,
-                    will=None,
-                    auth={'username':user, 'password':password},
-                    tls={'tls_version':ssl.PROTOCOL_TLS},
-                    protocol=mqtt.MQTTv311,
-                    transport="tcp")
-        logger.info("{} message(s) published to MQTT".format(len(msgs)))
+            logger.info("%s", msg)
+        message_queue.put(msgs)
+        if timeout:
+            pending = queue_sender.wait_until_empty(timeout)
+            if pending:
+                logger.warning("%s message(s) not sent after %s second(s), they are kept in queue", pending, timeout)
     except Exception as err:
-        logger.error("Error publishing to MQTT: {}".format(err), exc_info=False)
+        logger.error("Error publishing to MQTT: %s", err, exc_info=False)
 
-# main script
-if __name__ == '__main__':
-    logger = logging.getLogger('obdii')
-    
-    console_handler = logging.StreamHandler() # sends output to stderr
-    console_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
-    console_handler.setLevel(logging.DEBUG)
-    logger.addHandler(console_handler)
-    
-    file_handler = logging.handlers.TimedRotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.log',
-                                                    when='midnight',
-                                                    backupCount=15) # sends output to obdii_data.log file rotating it at midnight and storing latest 15 days
-    file_handler.setFormatter(logging.Formatter("%(asctime)s %(name)-10s %(levelname)-8s %(message)s"))
-    file_handler.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
-
-    logger.setLevel(logging.DEBUG)
-    
-    with open(os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.config.json') as config_file:
-        config = json.loads(config_file.read())
-    
-    broker_address = config['mqtt']['broker']
-    port = int(config['mqtt']['port'])
-    user = config['mqtt']['user']
-    password = config['mqtt']['password']
-    topic_prefix = config['mqtt']['topic_prefix']
-    
+# Build the state message used to know that the script is running
+def state_message():
+    state_info = {
+        'timestamp': int(round(time.time())),
+        'state': 'running'
+    }
+    if vehicle_state.state is not None:
+        state_info['vehicle_state'] = vehicle_state.state
+    return {'topic':topic_prefix + "state", 'payload':json.dumps(state_info), 'qos':0, 'retain':True}
+
+# MQTT messages of the information of a topic: none if it has not changed enough since it was last published
+def topic_messages(topic, data):
+    if store is not None:
+        # Every sample is kept locally, published or not
+        store.add(topic, data)
+    if not change_filter.should_publish(topic, data):
+        logger.info("%s not changed, not published", topic)
+        return []
+    if location_provider is not None and 'timestamp' in data:
+        # GPS fix nearest to the information (see collector.py)
+        location = location_provider(data['timestamp'])
+        if location is not None:
+            data = dict(data, location=location)
+            metrics.observe('gps_fix_age', abs(location['fix_age']))
+    return [{'topic':topic_prefix + topic, 'payload':payload_encoder.encode(topic, data), 'qos':0, 'retain':True}]
+
+# Query all the car information and return it as an array of MQTT messages
+def query_all_information():
     mqtt_msgs = []
-    
-    MAX_ATTEMPTS = 3
-    
-    try:
-        logger.info("=== Script start ===")
-        
-        # Add state data to messages array
-        state_info = {
-            'timestamp': int(round(time.time())),
-            'state': 'running'
-        }
-        mqtt_msgs.extend([{'topic':topic_prefix + "state", 'payload':json.dumps(state_info), 'qos':0, 'retain':True}])
-        
-        obd.logger.setLevel(obd.logging.DEBUG)
-        # Remove obd logger existing handlers
-        for handler in obd.logger.handlers[:]:
-            obd.logger.removeHandler(handler)
-         # Add handlers to obd logger
-        obd.logger.addHandler(console_handler)
-        obd.logger.addHandler(file_handler)
-    
-        connection = obd_connect()
 
-        cmd_can_header_7e4 =  OBDCommand("ATSH7E4",
-                                "Set CAN module ID to 7E4 - BMS battery information",
-                                b"ATSH7E4",
-                                0,
-                                raw_string,
-                                ECU.ALL,
-                                False)
-
-        cmd_can_header_7c6 =  OBDCommand("ATSH7C6",
-                                "Set CAN module ID to 7C6 - Odometer information",
-                                b"ATSH7C6",
-                                0,
-                                raw_string,
-                                ECU.ALL,
-                                False)
-
-        cmd_can_header_7e2 =  OBDCommand("ATSH7E2",
-                                "Set CAN module ID to 7E2 - VMCU information",
-                                b"ATSH7E2",
-                                0,
-                                raw_string,
-                                ECU.ALL,
-                                False)
-
-        cmd_can_header_7a0 =  OBDCommand("ATSH7A0",
-                                "Set CAN module ID to 7A0 - TPMS information",
-                                b"ATSH7A0",
-                                0,
-                                raw_string,
-                                ECU.ALL,
-                                False)
-
-        cmd_can_header_7e6 =  OBDCommand("ATSH7E6",
-                                "Set CAN module ID to 7E6 - External temp information",
-                                b"ATSH7E6",
-                                0,
-                                raw_string,
-                                ECU.ALL,
-                                False)
-
-        cmd_can_receive_address_7ec = OBDCommand("ATCRA7EC",
-                                            "Set the CAN receive address to 7EC",
-                                            b"ATCRA7EC",
-                                            0,
-                                            raw_string,
-                                            ECU.ALL,
-                                            False)
-
-        cmd_can_receive_address_7ea = OBDCommand("ATCRA7EA",
-                                            "Set the CAN receive address to 7EA",
-                                            b"ATCRA7EA",
-                                            0,
-                                            raw_string,
-                                            ECU.ALL,
-                                            False)
-
-        cmd_can_receive_address_7a8 = OBDCommand("ATCRA7A8",
-                                            "Set the CAN receive address to 7A8",
-                                            b"ATCRA7A8",
-                                            0,
-                                            raw_string,
-                                            ECU.ALL,
-                                            False)
-
-        cmd_can_receive_address_7ee = OBDCommand("ATCRA7EE",
-                                            "Set the CAN receive address to 7EE",
-                                            b"ATCRA7EE",
-                                            0,
-                                            raw_string,
-                                            ECU.ALL,
-                                            False)
-
-        cmd_can_filter_7ce = OBDCommand("ATCF7CE",
-                                    "Set the CAN filter to 7CE",
-                                    b"ATCF7CE",
-                                    0,
-                                    raw_string,
-                                    ECU.ALL,
-                                    False)
-
-        cmd_bms_2101 = OBDCommand("2101",
-                            "Extended command - BMS Battery information",
-                            b"2101",
-                            0, #61
-                            can_response,
-                            ECU.ALL,
-                            False)
-    
-        cmd_bms_2102 = OBDCommand("2102",
-                            "Extended command - BMS Battery information",
-                            b"2102",
-                            0, #38
-                            can_response,
-                            ECU.ALL,
-                            False)
-    
-        cmd_bms_2103 = OBDCommand("2103",
-                            "Extended command - BMS Battery information",
-                            b"2103",
-                            0, #38
-                            can_response,
-                            ECU.ALL,
-                            False)
-    
-        cmd_bms_2104 = OBDCommand("2104",
-                            "Extended command - BMS Battery information",
-                            b"2104",
-                            0, #38
-                            can_response,
-                            ECU.ALL,
-                            False)
-    
-        cmd_bms_2105 = OBDCommand("2105",
-                            "Extended command - BMS Battery information",
-                            b"2105",
-                            0, #45
-                            can_response,
-                            ECU.ALL,
-                            False)
-    
-        cmd_odometer = OBDCommand("22b002",
-                            "Extended command - Odometer information",
-                            b"22b002",
-                            0, #15
-                            can_response,
-                            ECU.ALL,
-                            False)
+    try:
+        # Add battery information to MQTT messages array
+        mqtt_msgs.extend(topic_messages("battery", query_battery_information()))
+    except (ValueError, CanError) as err:
+        logger.warning("**** Error querying battery information: %s ****", err, exc_info=False)
 
-        cmd_vin = OBDCommand("1A80",
-                            "Extended command - Vehicle Identification Number",
-                            b"1A80",
-                            0, #99
-                            can_response,
-                            ECU.ALL,
-                            False)
+    try:
+        # Get VIN (only once as it never changes)
+        if vehicle_vin is None:
+            query_vin()
+    except (ValueError, CanError) as err:
+        logger.error("Could not get VIN: %s", err, exc_info=False)
 
-        cmd_vmcu_2101 = OBDCommand("2101",
-                            "Extended command - VMCU information",
-                            b"2101",
-                            0, #22
-                            can_response,
-                            ECU.ALL,
-                            False)
+    try:
+        # Add VMCU information to MQTT messages array
+        mqtt_msgs.extend(topic_messages("vmcu", query_vmcu_information()))
+    except (ValueError, CanError) as err:
+        logger.warning("**** Error querying vmcu information: %s ****", err, exc_info=False)
 
-        cmd_tpms_22c00b = OBDCommand("22C00B",
-                            "Extended command - TPMS information",
-                            b"22C00B",
-                            0, #23
-                            can_response,
-                            ECU.ALL,
-                            False)
+    try:
+        # Add Odometer to MQTT messages array
+        mqtt_msgs.extend(topic_messages("odometer", query_odometer()))
+    except (ValueError, CanError) as err:
+        logger.warning("**** Error querying odometer: %s ****", err, exc_info=False)
 
-        cmd_ext_temp = OBDCommand("2180",
-                            "Extended command - External temperature",
-                            b"2180",
-                            0, #25
-                            can_response,
-                            ECU.ALL,
-                            False)
+    try:
+        # Add TPMS information to MQTT messages array
+        mqtt_msgs.extend(topic_messages("tpms", query_tpms_information()))
+    except (ValueError, CanError) as err:
+        logger.warning("**** Error querying tpms information: %s ****", err, exc_info=False)
 
-        # Print supported commands
-        # DTC = Diagnostic Trouble Codes
-        # MIL = Malfunction Indicator Lamp
-        logger.debug(connection.print_commands())
+    try:
+        # Add external temperture information to MQTT messages array
+        mqtt_msgs.extend(topic_messages("ext_temp", query_external_temperature()))
+    except (ValueError, CanError) as err:
+        logger.warning("**** Error querying tpms information: %s ****", err, exc_info=False)
 
+    for name in custom_signal_groups():
         try:
-            # Add battery information to MQTT messages array
-            mqtt_msgs.extend([{'topic':topic_prefix + "battery", 'payload':json.dumps(query_battery_information()), 'qos':0, 'retain':True}])
+            # Add information of the responses defined only in signals.json to MQTT messages array
+            mqtt_msgs.extend(topic_messages(signal_decoders[name].topic, query_custom_information(name)))
         except (ValueError, CanError) as err:
-            logger.warning("**** Error querying battery information: {} ****".format(err), exc_info=False)
+            logger.warning("**** Error querying %s: %s ****", name, err, exc_info=False)
 
-        try:
-            # Add VMCU information to MQTT messages array
-            mqtt_msgs.extend([{'topic':topic_prefix + "vmcu", 'payload':json.dumps(query_vmcu_information()), 'qos':0, 'retain':True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying vmcu information: {} ****".format(err), exc_info=False)
+    return mqtt_msgs
 
-        try:
-            # Add Odometer to MQTT messages array
-            mqtt_msgs.extend([{'topic':topic_prefix + "odometer", 'payload':json.dumps(query_odometer()), 'qos':0, 'retain':True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying odometer: {} ****".format(err), exc_info=False)
+# Single run: connect, query the car once, publish and exit (used when run from cron)
+def run_once():
+    global connection, mqtt_client
+    mqtt_msgs = []
+    # Connect to MQTT while querying the car
+    mqtt_client = mqtt_connect()
+    start_message_queue(mqtt_client)
+    try:
+        # Add state data to messages array
+        mqtt_msgs.append(state_message())
 
-        try:
-            # Add TPMS information to MQTT messages array
-            mqtt_msgs.extend([{'topic':topic_prefix + "tpms", 'payload':json.dumps(query_tpms_information()), 'qos':0, 'retain':True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying tpms information: {} ****".format(err), exc_info=False)
+        connection = obd_connect()
 
-        try:
-            # Add external temperture information to MQTT messages array
-            mqtt_msgs.extend([{'topic':topic_prefix + "ext_temp", 'payload':json.dumps(query_external_temperature()), 'qos':0, 'retain':True}])
-        except (ValueError, CanError) as err:
-            logger.warning("**** Error querying tpms information: {} ****".format(err), exc_info=False)
+        # Print supported commands
+        # DTC = Diagnostic Trouble Codes
+        # MIL = Malfunction Indicator Lamp
+        logger.debug(connection.print_commands())
+
+        mqtt_msgs.extend(query_all_information())
 
     except ConnectionError as err:
-        logger.error("OBDII connection error: {0}".format(err), exc_info=False)
+        logger.error("OBDII connection error: %s", err, exc_info=False)
     except ValueError as err:
-        logger.error("Error found: {0}".format(err), exc_info=False)
+        logger.error("Error found: %s", err, exc_info=False)
     except CanError as err:
-        logger.error("Error found reading CAN response: {0}".format(err), exc_info=False)
+        logger.error("Error found reading CAN response: %s", err, exc_info=False)
     except Exception as ex:
-        logger.error("Unexpected error: {}".format(ex), exc_info=False)
+        logger.error("Unexpected error: %s", ex, exc_info=False)
     finally:
-        publish_data_mqtt(mqtt_msgs)
-        if 'connection' in locals() and connection is not None:
+        publish_data_mqtt(mqtt_msgs, timeout=int(config['mqtt'].get('publish_timeout', 30)))
+        stop_message_queue()
+        mqtt_disconnect(mqtt_client)
+        if connection is not None:
             connection.close()
+
+# Build a polling function that queries the information and returns it as an array of MQTT messages
+def polling_function(topic, query_function):
+    def poll():
+        return topic_messages(topic, query_function())
+    return poll
+
+# VIN is only stored to be added to VMCU information, nothing is published
+def poll_vin():
+    query_vin()
+    return []
+
+# Battery information also updates the vehicle state (the BMS not answering means the car is asleep)
+def query_battery_state():
+    try:
+        battery_info = query_battery_information()
+    except (NoDataError, EcuUnavailableError):
+        vehicle_state.no_response()
+        raise
+    vehicle_state.update_battery(battery_info)
+    return battery_info
+
+# VMCU information also updates the vehicle state (speed and gear)
+def query_vmcu_state():
+    vmcu_info = query_vmcu_information()
+    vehicle_state.update_vmcu(vmcu_info)
+    return vmcu_info
+
+# Query groups that can be polled independently in daemon mode, in default priority order
+def polling_groups():
+    return [
+        ('state',    None,            lambda: [state_message()]),
+        ('battery',  ECU_BMS[0],      polling_function("battery", query_battery_state)),         # BMS 2101 - 2105
+        ('vin',      ECU_VMCU[0],     poll_vin),                                                 # 1A80
+        ('vmcu',     ECU_VMCU[0],     polling_function("vmcu", query_vmcu_state)),               # VMCU 2101
+        ('odometer', ECU_ODOMETER[0], polling_function("odometer", query_odometer)),             # 22B002
+        ('tpms',     ECU_TPMS[0],     polling_function("tpms", query_tpms_information)),         # 22C00B
+        ('ext_temp', ECU_EXT_TEMP[0], polling_function("ext_temp", query_external_temperature))  # 2180
+    ] + [(name, signal_decoders[name].ecu, polling_function(signal_decoders[name].topic, lambda name=name: query_custom_information(name)))
+         for name in custom_signal_groups()] + \
+        ([('monitor', None, query_broadcasts)] if broadcast_decoders() else []) + \
+        ([('metrics', None, lambda: [metrics.mqtt_message(topic_prefix + "metrics")])] if config.get('metrics', {}).get('enabled', False) else [])
+
+# Polling settings of a group from config['polling'] section, overridden by the profile of the vehicle state if there's one.
+# Groups not in the profile are not polled in that state (except state and metrics, that don't query the car).
+# Groups not configured are queried every config['service']['interval'] seconds (VIN only once).
+def polling_settings(name, priority, state=None):
+    group_config = config.get('polling', {}).get(name, {})
+    profile = config.get('vehicle_state', {}).get('profiles', {}).get(state) if state is not None else None
+    if profile is not None:
+        if name not in profile and name not in ('state', 'metrics'):
+            group_config = dict(group_config, enabled=False)
+        else:
+            group_config = dict(group_config, **profile.get(name, {}))
+    return {
+        'interval': group_config.get('interval', 0 if name == 'vin' else float(config['service'].get('interval', 60))),
+        'priority': group_config.get('priority', priority),
+        'deadline': group_config.get('deadline'),
+        'enabled':  group_config.get('enabled', True)
+    }
+
+# Create the polling scheduler from config['polling'] section
+def create_scheduler():
+    scheduler = PollingScheduler()
+    scheduler.on_run = lambda task, duration, failed: metrics.observe('group_duration', duration, group=task.name)
+    for priority, (name, ecu, function) in enumerate(polling_groups()):
+        settings = polling_settings(name, priority)
+        task = scheduler.add_task(PollingTask(name,
+                                              function,
+                                              settings['interval'],
+                                              priority=settings['priority'],
+                                              deadline=settings['deadline'],
+                                              ecu=ecu))
+        task.enabled = settings['enabled']
+        if task.enabled:
+            logger.info("Polling %s every %s second(s) with priority %s", name, task.interval, task.priority)
+        else:
+            logger.info("Polling of %s disabled", name)
+    return scheduler
+
+# Switch the polling settings of every group to the profile of a vehicle state
+def apply_polling_profile(scheduler, state):
+    tasks = dict((task.name, task) for task in scheduler.tasks)
+    for priority, (name, ecu, function) in enumerate(polling_groups()):
+        if name in tasks:
+            scheduler.reconfigure(tasks[name], **polling_settings(name, priority, state))
+    polled = ["{} ({}s)".format(task.name, task.interval) for task in scheduler.tasks if task.enabled]
+    logger.info("Polling profile %s: %s", state, ", ".join(polled) if polled else "nothing")
+
+# Close the OBDII connection (and detach the transport from it)
+def close_connection():
+    global connection
+    if transport is not None:
+        transport.detach()
+    if connection is not None:
+        connection.close()
+        connection = None
+
+# One step of the daemon: connect to the car if the link is down and run the due polling tasks.
+# Returns the seconds to wait before the next step, None if there is nothing to poll.
+# status keeps the number of cycles run and the state of the polling profile in use.
+def poll_car(scheduler, status):
+    global connection
+    try:
+        if connection is None or connection.status() != OBDStatus.CAR_CONNECTED:
+            if connection is not None:
+                logger.warning("OBDII link lost (%s). Reconnecting...", connection.status())
+                close_connection()
+            connection = obd_connect()
+    except ConnectionError as err:
+        reconnect_delay = float(config['service'].get('reconnect_delay', 10))
+        logger.error("OBDII connection error: %s. Retrying in %s second(s)...", err, reconnect_delay, exc_info=False)
+        connection = None
+        publish_data_mqtt([state_message()])
+        return reconnect_delay
+
+    cycle_start = time.time()
+    mqtt_msgs = []
+    for task, msgs in scheduler.run_pending():
+        mqtt_msgs.extend(msgs)
+    if vehicle_state.state != status['profile_state']:
+        # Poll faster while driving or charging and as little as possible while parked or asleep
+        status['profile_state'] = vehicle_state.state
+        apply_polling_profile(scheduler, status['profile_state'])
+        mqtt_msgs.append(state_message())
+    if mqtt_msgs:
+        publish_data_mqtt(mqtt_msgs)
+        status['cycles'] += 1
+        metrics.observe('cycle_time', time.time() - cycle_start)
+        logger.info("Cycle %s took %.2f second(s)", status['cycles'], time.time() - cycle_start)
+
+    wait = scheduler.time_to_next()
+    if wait is None:
+        logger.warning("Nothing to poll")
+    return wait
+
+def log_polling_summary(scheduler, status):
+    logger.info("%s cycle(s) run", status['cycles'])
+    for task in scheduler.tasks:
+        logger.info("Polling %s: %s run(s), %s error(s), %s missed deadline(s)", task.name, task.runs, task.errors, task.missed_deadlines)
+
+# Serve the metrics in the Prometheus text format if config['metrics']['port'] is set. Returns the HTTP server.
+def start_metrics_server():
+    metrics_config = config.get('metrics', {})
+    if not metrics_config.get('port'):
+        return None
+    try:
+        server = start_http_server(metrics, metrics_config['port'], metrics_config.get('host', '127.0.0.1'))
+    except OSError as err:
+        logger.error("Could not serve the metrics on port %s: %s", metrics_config['port'], err)
+        return None
+    logger.info("Serving metrics on http://%s:%s/metrics", metrics_config.get('host', '127.0.0.1'), metrics_config['port'])
+    return server
+
+# Daemon: keep OBDII and MQTT connections open and query each group of commands at its own rate.
+# OBDII connection is only reestablished when the link drops.
+def run_daemon():
+    global mqtt_client
+    scheduler = create_scheduler()
+    mqtt_client = mqtt_connect()
+    start_message_queue(mqtt_client)
+    metrics_server = start_metrics_server()
+    status = {'cycles': 0, 'profile_state': None}
+    try:
+        while True:
+            wait = poll_car(scheduler, status)
+            if wait is None:
+                break
+            if wait > 0:
+                time.sleep(wait)
+    finally:
+        log_polling_summary(scheduler, status)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        stop_message_queue()
+        mqtt_disconnect(mqtt_client)
+        close_connection()
+
+# Set the module settings from a config (obdii_data.config.json contents)
+def configure(new_config):
+    global config, broker_address, port, user, password, topic_prefix, change_filter, payload_encoder, connection_cache, vehicle_state, circuit_breaker, capture_writer, store
+    config = new_config
+    broker_address = config['mqtt']['broker']
+    port = int(config['mqtt']['port'])
+    user = config['mqtt']['user']
+    password = config['mqtt']['password']
+    topic_prefix = config['mqtt']['topic_prefix']
+    
+    # Decode cell voltages with NumPy
+    if signals.use_numpy(config.get('battery', {}).get('numpy', False)):
+        logger.info("Using NumPy to decode battery cells")
+
+    # Publish only the information that changed (or every heartbeat seconds)
+    change_filter = ChangeFilter(config.get('publishing', {}))
+
+    # Payload encoding of each topic (JSON by default)
+    payload_encoder = PayloadEncoder(config.get('payloads', {}), load_schemas(os.path.dirname(os.path.realpath(__file__)) + '/payload_schemas.json'))
+
+    # Protocol, baud rate and timing of the last connection, to connect faster the next time
+    if config['serial'].get('fast_init', True):
+        connection_cache = ConnectionCache(config['serial'].get('cache', os.path.dirname(os.path.realpath(__file__)) + '/obdii_connection.cache.json'))
+
+    # Vehicle state used to switch polling profiles in daemon mode
+    vehicle_state_config = config.get('vehicle_state', {})
+    vehicle_state = VehicleState(hold=vehicle_state_config.get('hold', 120),
+                                 sleep_after=vehicle_state_config.get('sleep_after', 3))
+
+    # Stop querying the ECUs that fail repeatedly for a while
+    circuit_breaker = CircuitBreaker(failure_threshold=config.get('retry', {}).get('failure_threshold', 3),
+                                     cooldown=config.get('retry', {}).get('cooldown', 300))
+
+    # Record raw requests and responses to be able to decode them again (see replay_capture.py)
+    capture_config = config.get('capture', {})
+    if capture_config.get('enabled', False):
+        capture_writer = CaptureWriter(capture_config.get('path', os.path.dirname(os.path.realpath(__file__)) + '/captures/obdii_capture.bin'),
+                                       max_bytes=capture_config.get('max_bytes', 10 * 1024 * 1024),
+                                       backup_count=capture_config.get('backup_count', 10))
+        logger.info("Capturing raw responses to %s", capture_writer.path)
+
+    # Keep the history of the information in a local time-series database (see timeseries.py)
+    store_config = config.get('store', {})
+    if store_config.get('enabled', False):
+        store = TimeSeriesStore(store_config.get('path', os.path.dirname(os.path.realpath(__file__)) + '/timeseries.db'),
+                                topics=store_config.get('topics', DEFAULT_TOPICS),
+                                retention=store_config.get('retention'),
+                                max_mb=store_config.get('max_mb', 500),
+                                logger_name='obdii.store')
+        logger.info("Storing %s history to %s", ", ".join(sorted(store.topics)) if store.topics is not None else "all", store.path)
+
+# main script
+if __name__ == '__main__':
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.config.json') as config_file:
+        config = json.loads(config_file.read())
+
+    # Logs of the script and python-OBD written to obdii_data.log by a background thread
+    log_listener = setup_logging(os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.log', ['obdii', 'obd'], config.get('logging'))
+
+    configure(config)
+
+    try:
+        logger.info("=== Script start ===")
+
+        if config.get('service', {}).get('daemon', False):
+            logger.info("Running in daemon mode")
+            run_daemon()
+        else:
+            run_once()
+    except (KeyboardInterrupt, SystemExit):
+        # when you press ctrl+c
+        pass
+    finally:
+        if capture_writer is not None:
+            logger.info("%s raw response(s) captured", capture_writer.records)
+            capture_writer.close()
+        if store is not None:
+            logger.info("%s sample(s) stored", store.samples)
+            store.close()
         logger.info("===  Script end  ===")
+        stop_logging(log_listener)
@@ -0,0 +1,184 @@
+#! /usr/bin/python
+
+# Encoding of the MQTT payloads.
+#
+# Each topic can be published as JSON (default), MessagePack or CBOR. Long key names usually cost
+# more bytes than the values, so a topic can also use a key table (payload_schemas.json): keys are
+# replaced by their index in the table and the payload becomes [schema id, schema version, {index: value}].
+# Keys not found in the table are kept as they are. Key tables are versioned: add keys at the end of
+# a new version and keep the old versions, so consumers can still decode old (i.e. queued) payloads.
+#
+# With a key table and a binary encoding, the arrays listed in the table "arrays" (cell voltages and
+# module temperatures) can be packed as raw bytes: each value is multiplied by "scale" and stored
+# with the struct "type" code (i.e. cell voltages are stored as the byte returned by the BMS).
+#
+# Consumer side: PayloadDecoder(load_schemas(path)).decode(payload, encoding) returns the original
+# dict. From the command line: python payload_encoding.py <json|msgpack|cbor> [payload file]
+
+import json
+import struct
+import sys
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+ENCODINGS = ('json', 'msgpack', 'cbor')
+
+class PayloadError(ValueError): pass
+
+def dumps(encoding, value):
+    if encoding == 'json':
+        return json.dumps(value)
+    if encoding == 'msgpack':
+        return msgpack.packb(value, use_bin_type=True)
+    if encoding == 'cbor':
+        return cbor2.dumps(value)
+    raise PayloadError("Unknown encoding: {}".format(encoding))
+
+def loads(encoding, payload):
+    if encoding == 'json':
+        return json.loads(payload)
+    if encoding == 'msgpack':
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    if encoding == 'cbor':
+        return cbor2.loads(payload)
+    raise PayloadError("Unknown encoding: {}".format(encoding))
+
+# Raise PayloadError if the library of an encoding is not installed
+def check_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise PayloadError("Unknown encoding: {}. Valid encodings: {}".format(encoding, ', '.join(ENCODINGS)))
+    if encoding == 'msgpack' and msgpack is None:
+        raise PayloadError("msgpack encoding requires msgpack: pip install msgpack")
+    if encoding == 'cbor' and cbor2 is None:
+        raise PayloadError("cbor encoding requires cbor2: pip install cbor2")
+
+# One version of the key table of a topic
+class PayloadSchema(object):
+    def __init__(self, name, schema_id, version, definition):
+        self.name = name
+        self.id = int(schema_id)
+        self.version = int(version)
+        self.keys = list(definition['keys'])
+        self.indexes = dict((key, index) for index, key in enumerate(self.keys))
+        self.arrays = {}
+        for key, array in definition.get('arrays', {}).items():
+            self.arrays[key] = (array.get('type', 'f'), float(array.get('scale', 1)))
+        self.structs = {}
+
+    def array_struct(self, code, count):
+        if (code, count) not in self.structs:
+            self.structs[(code, count)] = struct.Struct('<{}{}'.format(count, code))
+        return self.structs[(code, count)]
+
+    def pack_array(self, key, values):
+        code, scale = self.arrays[key]
+        if code in 'efd':
+            return self.array_struct(code, len(values)).pack(*[value * scale for value in values])
+        return self.array_struct(code, len(values)).pack(*[int(round(value * scale)) for value in values])
+
+    def unpack_array(self, key, packed):
+        code, scale = self.arrays[key]
+        size = struct.calcsize('<' + code)
+        return [value / scale for value in self.array_struct(code, len(packed) // size).unpack(packed)]
+
+    def compact(self, data, pack_arrays=False):
+        values = {}
+        for key, value in data.items():
+            if pack_arrays and key in self.arrays and isinstance(value, list):
+                try:
+                    value = self.pack_array(key, value)
+                except struct.error:
+                    pass        # Values out of the packed type range are sent as a list
+            values[self.indexes.get(key, key)] = value
+        return [self.id, self.version, values]
+
+    def expand(self, values):
+        data = {}
+        for key, value in values.items():
+            if isinstance(key, str) and key.isdigit():      # JSON object keys are always strings
+                key = int(key)
+            if isinstance(key, int):
+                if key >= len(self.keys):
+                    raise PayloadError("Key index {} not in {} schema version {}".format(key, self.name, self.version))
+                key = self.keys[key]
+            if isinstance(value, (bytes, bytearray)) and key in self.arrays:
+                value = self.unpack_array(key, value)
+            data[key] = value
+        return data
+
+# Load the key tables: {name: {version: PayloadSchema}}
+def load_schemas(path):
+    with open(path) as schemas_file:
+        table = json.loads(schemas_file.read())
+    schemas = {}
+    for name, definition in table.items():
+        schemas[name] = dict((int(version), PayloadSchema(name, definition['id'], version, version_definition))
+                             for version, version_definition in definition['versions'].items())
+    return schemas
+
+# Encoder of the payload of every topic.
+# config: {topic: {"encoding": "json|msgpack|cbor", "schema": true|"name", "pack_arrays": true}}
+class PayloadEncoder(object):
+    def __init__(self, config, schemas=None):
+        self.topics = {}
+        for topic, topic_config in config.items():
+            encoding = topic_config.get('encoding', 'json')
+            check_encoding(encoding)
+            schema = None
+            schema_name = topic_config.get('schema', False)
+            if schema_name:
+                if schema_name is True:
+                    schema_name = topic
+                if not schemas or schema_name not in schemas:
+                    raise PayloadError("No key table for {}".format(schema_name))
+                versions = schemas[schema_name]
+                schema = versions[max(versions)]
+            pack_arrays = bool(topic_config.get('pack_arrays', False)) and schema is not None and encoding != 'json'
+            self.topics[topic] = (encoding, schema, pack_arrays)
+
+    def encode(self, topic, data):
+        if topic not in self.topics:
+            return json.dumps(data)
+        encoding, schema, pack_arrays = self.topics[topic]
+        if schema is not None:
+            data = schema.compact(data, pack_arrays)
+        return dumps(encoding, data)
+
+# Decoder of the payloads for the consumers
+class PayloadDecoder(object):
+    def __init__(self, schemas=None):
+        self.schemas = {}
+        for versions in (schemas or {}).values():
+            for schema in versions.values():
+                self.schemas[(schema.id, schema.version)] = schema
+
+    def decode(self, payload, encoding='json'):
+        check_encoding(encoding)
+        value = loads(encoding, payload)
+        if isinstance(value, list) and len(value) == 3 and isinstance(value[2], dict):
+            schema = self.schemas.get((value[0], value[1]))
+            if schema is None:
+                raise PayloadError("Unknown schema {} version {}".format(value[0], value[1]))
+            return schema.expand(value[2])
+        return value
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python payload_encoding.py <json|msgpack|cbor> [payload file]")
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'rb') as payload_file:
+            payload = payload_file.read()
+    else:
+        payload = sys.stdin.buffer.read()
+    decoder = PayloadDecoder(load_schemas(os.path.dirname(os.path.realpath(__file__)) + '/payload_schemas.json'))
+    print(json.dumps(decoder.decode(payload, sys.argv[1]), indent=3))
@@ -0,0 +1,125 @@
+#! /usr/bin/python
+
+# Replay of the raw responses captured by obdii_data.py (see capture section of its config file).
+#
+# The responses are decoded again with the current signal definitions, at full speed and always in
+# the same way: each group of responses (i.e. BMS 2101 - 2105) is reassembled with can_response and
+# decoded with the same function used by the query_* functions, as soon as its last response is
+# read. The CAN header of each response is the last one set with ATSH in the capture.
+#
+# Every decoded group is printed as a JSON line: {"timestamp": capture time, "topic": topic, "data": {...}}.
+# Groups that can't be decoded are printed with the error and their raw frames: {"timestamp", "topic", "error", "frames"}.
+#
+# Usage: python replay_capture.py [--config obdii_data.config.json] [--errors] <capture file> [<capture file>...]
+#        With a single capture path, its rotated files (<path>.N ... <path>.1) are replayed first.
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import obdii_data
+from can_capture import capture_files, is_frame, read_capture
+from isotp_decoder import CanError
+
+# Topics of the responses decoded directly with the signal table
+SIGNAL_TOPICS = {
+    'vin_1a80':        'vin',
+    'odometer_22b002': 'odometer',
+    'tpms_22c00b':     'tpms',
+    'ext_temp_2180':   'ext_temp'
+}
+
+class ReplayFrame(object):
+    def __init__(self, raw):
+        self.raw = raw
+
+class ReplayMessage(object):
+    def __init__(self, lines):
+        self.frames = [ReplayFrame(line) for line in lines]
+
+# Groups of responses decoded together: (topic, CAN header, commands, decode function)
+def replay_groups():
+    groups = [
+        ('battery', obdii_data.ECU_BMS[0],  ('2101', '2102', '2103', '2104', '2105'), obdii_data.decode_battery_information),
+        ('vmcu',    obdii_data.ECU_VMCU[0], ('2101',),                                obdii_data.decode_vmcu_information)
+    ]
+    for name, decoder in sorted(obdii_data.signal_decoders.items()):
+        if name.startswith('bms_210') or name == 'vmcu_2101' or not decoder.ecu or not decoder.pid:
+            continue
+        groups.append((SIGNAL_TOPICS.get(name, decoder.topic or name), decoder.ecu.upper(), (decoder.pid.upper(),),
+                       lambda data, name=name: obdii_data.decode_signals(name, data)))
+    return groups
+
+def is_can_response(lines):
+    return any(is_frame(line) for line in lines)
+
+class Replayer(object):
+    def __init__(self, groups):
+        self.groups = groups
+        self.header = None
+        self.responses = {}
+        self.decoded = 0
+        self.errors = 0
+
+    # Process a record, returns the list of results of the groups it completes
+    def feed(self, timestamp, command, lines):
+        command = command.upper().replace(' ', '')
+        if command.startswith('ATSH'):
+            self.header = command[4:]
+            return []
+        if command.startswith('AT'):
+            return []
+        if len(command) & 1:
+            command = command[:-1]      # Number of frames expected (i.e. 21019)
+        self.responses[(self.header, command)] = lines
+        if not is_can_response(lines):
+            # NO DATA and similar responses are retried, wait for the retry
+            return []
+        results = []
+        for topic, header, commands, decode in self.groups:
+            if header != self.header or commands[-1] != command:
+                continue
+            if not all((header, group_command) in self.responses for group_command in commands):
+                continue
+            frames = dict((group_command, self.responses.pop((header, group_command))) for group_command in commands)
+            try:
+                data = [obdii_data.can_response([ReplayMessage(frames[group_command])]) for group_command in commands]
+                info = decode(*data)
+                if 'timestamp' in info:
+                    info['timestamp'] = int(round(timestamp))      # Capture time, not replay time
+                results.append({'timestamp': timestamp, 'topic': topic, 'data': info})
+                self.decoded += 1
+            except (ValueError, CanError) as err:
+                results.append({'timestamp': timestamp, 'topic': topic, 'error': str(err), 'frames': frames})
+                self.errors += 1
+        return results
+
+def default_config():
+    return {'vehicle': {'battery_capacity': 28}}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode again the raw responses captured by obdii_data.py')
+    parser.add_argument('--config', default=os.path.dirname(os.path.realpath(__file__)) + '/obdii_data.config.json', help='obdii_data config file (battery and vehicle sections are used)')
+    parser.add_argument('--errors', action='store_true', help='only print the groups that could not be decoded')
+    parser.add_argument('captures', nargs='+', help='capture files')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if os.path.exists(args.config):
+        with open(args.config) as config_file:
+            obdii_data.config = json.loads(config_file.read())
+    else:
+        obdii_data.config = default_config()
+
+    files = capture_files(args.captures[0]) if len(args.captures) == 1 else args.captures
+    replayer = Replayer(replay_groups())
+    records = 0
+    for path in files:
+        for timestamp, command, lines in read_capture(path):
+            records += 1
+            for result in replayer.feed(timestamp, command, lines):
+                if not args.errors or 'error' in result:
+                    print(json.dumps(result))
+    sys.stderr.write("{} record(s) replayed from {} file(s): {} group(s) decoded, {} error(s)\n".format(records, len(files), replayer.decoded, replayer.errors))
@@ -0,0 +1,150 @@
+# Polling scheduler used to query each group of OBDII commands at its own rate.
+#
+# Every task has an interval (seconds between runs) and a priority (lower value = higher priority).
+# When several tasks are due at the same time the one with the highest priority runs first, so
+# fast changing signals (i.e. speed or battery current) get most of the serial bandwidth.
+# A task with interval 0 is run only once (it is retried until it succeeds).
+#
+# Tasks can be tagged with the ECU they query. All the due tasks of an ECU are run one after
+# the other so CAN header switches (ATSH/ATCRA round-trips) happen as rarely as possible.
+#
+# A task misses its deadline when it starts later than its due time plus its deadline
+# (by default the task interval). Missed deadlines are logged and counted per task.
+#
+# Tasks can be reconfigured while running (i.e. polling profiles of the vehicle state).
+
+import logging
+import math
+import time
+
+logger = logging.getLogger('obdii.scheduler')
+
+class PollingTask(object):
+    def __init__(self, name, function, interval, priority=0, deadline=None, retry_interval=60, ecu=None):
+        self.name = name
+        self.function = function
+        self.ecu = ecu
+        self.interval = float(interval)
+        self.priority = int(priority)
+        self.deadline = float(deadline) if deadline is not None else self.interval
+        self.retry_interval = float(retry_interval)
+        self.next_due = 0.0
+        self.enabled = True
+        self.runs = 0
+        self.errors = 0
+        self.missed_deadlines = 0
+        self.last_duration = 0.0
+
+    def __repr__(self):
+        return "PollingTask({}, interval={}, priority={})".format(self.name, self.interval, self.priority)
+
+class PollingScheduler(object):
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.tasks = []
+        self.last_ecu = None
+        self.on_run = None      # Called with (task, seconds, failed) after each run
+
+    def add_task(self, task):
+        task.next_due = self.clock()
+        self.tasks.append(task)
+        return task
+
+    def due_tasks(self, now=None):
+        if now is None:
+            now = self.clock()
+        return [task for task in self.tasks if task.enabled and task.next_due <= now]
+
+    # Pick the next task to run among the due ones: highest priority first, then the ones on the
+    # ECU the adapter is already set to, then the most overdue.
+    # When batch_ecu is set, due tasks on that ECU (or not using any ECU) go first whatever their priority.
+    def select_task(self, due, batch_ecu=None):
+        if batch_ecu is not None:
+            same_ecu = [task for task in due if task.ecu is None or task.ecu == batch_ecu]
+            if same_ecu:
+                due = same_ecu
+        return min(due, key=lambda task: (task.priority, task.ecu != self.last_ecu, task.next_due))
+
+    # Run every due task once (highest priority first) and return the list of their results.
+    # Tasks that raise an exception are logged and rescheduled, their result is not returned.
+    def run_pending(self):
+        results = []
+        already_run = set()
+        batch_ecu = None
+        while True:
+            due = [task for task in self.due_tasks() if id(task) not in already_run]
+            if not due:
+                break
+            task = self.select_task(due, batch_ecu)
+            already_run.add(id(task))
+            if task.ecu is not None:
+                batch_ecu = task.ecu
+                self.last_ecu = task.ecu
+            result = self.run_task(task)
+            if result is not None:
+                results.append((task, result))
+        return results
+
+    def run_task(self, task):
+        start = self.clock()
+        lateness = start - task.next_due
+        if task.interval > 0 and lateness > task.deadline:
+            task.missed_deadlines += 1
+            logger.warning("Deadline missed for %s: started %.2f second(s) late (%s missed so far)", task.name, lateness, task.missed_deadlines)
+
+        result = None
+        failed = False
+        try:
+            result = task.function()
+            task.runs += 1
+        except Exception as err:
+            failed = True
+            task.errors += 1
+            logger.warning("**** Error querying %s: %s ****", task.name, err, exc_info=False)
+
+        end = self.clock()
+        task.last_duration = end - start
+        logger.debug("Task %s took %.3f second(s)", task.name, task.last_duration)
+        if self.on_run is not None:
+            self.on_run(task, task.last_duration, failed)
+        self.reschedule(task, end, failed)
+        return result
+
+    def reschedule(self, task, now, failed):
+        if task.interval <= 0:
+            # Run once tasks are disabled after their first successful run
+            if failed:
+                task.next_due = now + task.retry_interval
+            else:
+                task.enabled = False
+            return
+        task.next_due += task.interval
+        if task.next_due <= now:
+            # Skip the slots we are already late for instead of running the task several times in a row
+            skipped = int(math.ceil((now - task.next_due) / task.interval))
+            task.next_due += skipped * task.interval
+            if task.next_due <= now:
+                task.next_due += task.interval
+
+    # Change the settings of a task (i.e. when the polling profile changes). A task enabled again is
+    # due at once and a task due later than its new interval is brought forward, so a faster rate
+    # applies at once. Run once tasks that already succeeded stay disabled.
+    def reconfigure(self, task, interval, priority=None, deadline=None, enabled=True):
+        now = self.clock()
+        was_enabled = task.enabled
+        task.interval = float(interval)
+        if priority is not None:
+            task.priority = int(priority)
+        task.deadline = float(deadline) if deadline is not None else task.interval
+        task.enabled = enabled and not (task.interval <= 0 and task.runs > 0)
+        if task.enabled and not was_enabled:
+            task.next_due = now
+        elif task.enabled and task.next_due > now + task.interval:
+            task.next_due = now + task.interval
+
+    # Seconds until the next task is due (0 if a task is already due, None if there are no tasks)
+    def time_to_next(self):
+        enabled = [task.next_due for task in self.tasks if task.enabled]
+        if not enabled:
+            return None
+        return max(0.0, min(enabled) - self.clock())
@@ -0,0 +1,298 @@
+# Declarative signal definitions for the OBDII extended commands responses.
+#
+# The signal table is a JSON file with one entry per response (i.e. "bms_2101"):
+#
+# {
+#     "bms_2101": {
+#         "ecu":    "7E4",         CAN header of the ECU to query
+#         "pid":    "2101",        Command sent to the ECU
+#         "length": 61,            [OPTIONAL] Expected response data length in bytes
+#         "topic":  "battery",     [OPTIONAL] Only for responses not decoded by a built-in query function: MQTT topic to publish the signals to
+#         "broadcast": "5F0",      [OPTIONAL] CAN ID of a frame the ECU broadcasts by itself, read in monitor mode (see can_monitor.py)
+#                                  instead of queried with ecu/pid. Signal offsets are from the first data byte of the frame.
+#         "signals": [
+#             {
+#                 "name":    "socBms",   Key of the signal in the decoded information
+#                 "start":   6,          Byte offset of the signal in the response data
+#                 "width":   1,          [OPTIONAL] Width in bytes (default 1)
+#                 "signed":  false,      [OPTIONAL] Two's complement value (default false)
+#                 "endian":  "big",      [OPTIONAL] "big" or "little" (default "big")
+#                 "count":   1,          [OPTIONAL] Number of consecutive values, decoded as a list when > 1
+#                 "mask":    128,        [OPTIONAL] Bit mask. The signal is 1 if any bit of the mask is set, 0 otherwise
+#                 "invert":  false,      [OPTIONAL] Invert a masked signal
+#                 "add":     0,          [OPTIONAL] Value added to the raw value
+#                 "divisor": 2.0,        [OPTIONAL] Value the raw value is divided by
+#                 "scale":   1.0,        [OPTIONAL] Value the raw value is multiplied by (after divisor)
+#                 "round":   1,          [OPTIONAL] Number of decimals to round the value to
+#                 "type":    "float",    [OPTIONAL] Convert the value to "int", "float" or "string" (latin-1 characters)
+#                 "unit":    "%"         [OPTIONAL] Unit of the value, for documentation purposes
+#             }
+#         ]
+#     }
+# }
+#
+# The table is compiled once: the fields of a response are laid out in as few struct.Struct
+# unpackers as possible (fields that overlap another one go to an additional unpacker), so all
+# the signals of a response are read with one unpack_from call without slicing the data.
+#
+# Array signals (count > 1) can also be decoded in one operation with decode_array, as a list or
+# as a NumPy array when NumPy is installed and enabled with use_numpy(True). For arrays as small
+# as the 32 cells of a response NumPy call overhead is usually bigger than the gain.
+
+import json
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+numpy_enabled = False
+
+# Decode arrays as NumPy arrays (if NumPy is installed). Returns whether NumPy is used.
+def use_numpy(enabled):
+    global numpy_enabled
+    numpy_enabled = bool(enabled) and numpy is not None
+    return numpy_enabled
+
+STRUCT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+class SignalError(ValueError): pass
+
+class Signal(object):
+    def __init__(self, definition):
+        try:
+            self.name = definition['name']
+            self.start = int(definition['start'])
+        except KeyError as err:
+            raise SignalError("Signal without {}: {}".format(err, definition))
+        self.width = int(definition.get('width', 1))
+        self.signed = bool(definition.get('signed', False))
+        self.endian = definition.get('endian', 'big')
+        self.count = int(definition.get('count', 1))
+        self.mask = definition.get('mask')
+        self.invert = bool(definition.get('invert', False))
+        self.add = definition.get('add')
+        self.divisor = definition.get('divisor')
+        self.scale = definition.get('scale')
+        self.round = definition.get('round')
+        self.type = definition.get('type')
+        self.unit = definition.get('unit')
+        if self.endian not in ('big', 'little'):
+            raise SignalError("Invalid endian for {}: {}".format(self.name, self.endian))
+        if self.type not in (None, 'int', 'float', 'string'):
+            raise SignalError("Invalid type for {}: {}".format(self.name, self.type))
+        self.convert = self.build_converter()
+
+    @property
+    def end(self):
+        return self.start + self.width * self.count
+
+    # Fields read by the unpackers: (start, width, signed, endian, count)
+    @property
+    def field(self):
+        if self.type == 'string':
+            return (self.start, self.width * self.count, False, 'string', 1)
+        return (self.start, self.width, self.signed, self.endian, self.count)
+
+    # Build the function that converts a raw value, with only the steps this signal needs
+    def build_converter(self):
+        steps = []
+        if self.type == 'string':
+            steps.append(lambda v: v.decode('latin-1'))
+        if self.mask is not None:
+            mask = int(self.mask)
+            if self.invert:
+                steps.append(lambda v: 0 if v & mask else 1)
+            else:
+                steps.append(lambda v: 1 if v & mask else 0)
+        if self.add:
+            add = self.add
+            steps.append(lambda v: v + add)
+        if self.divisor is not None:
+            divisor = self.divisor
+            steps.append(lambda v: v / divisor)
+        if self.scale is not None:
+            scale = self.scale
+            steps.append(lambda v: v * scale)
+        if self.round is not None:
+            decimals = int(self.round)
+            steps.append(lambda v: round(v, decimals))
+        if self.type == 'int':
+            steps.append(int)
+        elif self.type == 'float':
+            steps.append(float)
+
+        if not steps:
+            return None
+        if len(steps) == 1:
+            return steps[0]
+        def convert(value):
+            for step in steps:
+                value = step(value)
+            return value
+        return convert
+
+# Struct format code of a field
+def field_code(field):
+    start, width, signed, endian, count = field
+    if endian == 'string':
+        return '{}s'.format(width)
+    if width in STRUCT_CODES:
+        code = STRUCT_CODES[width]
+        code = code.lower() if signed else code
+        return code if count == 1 else '{}{}'.format(count, code)
+    # Widths without a struct code (i.e. 3 bytes) are read as bytes and converted afterwards
+    return ''.join(['{}s'.format(width)] * count)
+
+# Unpacker of a set of non overlapping fields of the same byte order
+class Unpacker(object):
+    def __init__(self, endian):
+        self.endian = endian
+        self.fields = []
+        self.end = 0
+
+    def fits(self, field):
+        return field[0] >= self.end
+
+    def add(self, field):
+        self.fields.append(field)
+        start, width, signed, endian, count = field
+        self.end = start + (width * count)
+
+    def compile(self):
+        fmt = '>' if self.endian == 'big' else '<'
+        position = 0
+        index = 0
+        indexes = {}
+        for field in self.fields:
+            start, width, signed, endian, count = field
+            if start > position:
+                fmt += '{}x'.format(start - position)
+            fmt += field_code(field)
+            indexes[field] = index
+            index += 1 if endian == 'string' else count
+            position = start + width * count
+        self.struct = struct.Struct(fmt)
+        self.indexes = indexes
+        return self
+
+# Compiled decoder of all the signals of a response
+class ResponseDecoder(object):
+    def __init__(self, name, definition):
+        self.name = name
+        self.ecu = definition.get('ecu')
+        self.pid = definition.get('pid')
+        self.length = definition.get('length')
+        self.topic = definition.get('topic')
+        self.broadcast = definition.get('broadcast')
+        self.signals = [Signal(signal) for signal in definition.get('signals', [])]
+        self.signals_by_name = dict((signal.name, signal) for signal in self.signals)
+        self.array_decoders = {}
+        self.compile()
+
+    def compile(self):
+        # Lay out the fields in unpackers: the first one (per byte order) that has room for them
+        unpackers = []
+        fields = sorted(set(signal.field for signal in self.signals))
+        for field in fields:
+            # Strings have no byte order, they're read by the big endian unpackers
+            endian = 'little' if field[3] == 'little' else 'big'
+            for unpacker in unpackers:
+                if unpacker.endian == endian and unpacker.fits(field):
+                    break
+            else:
+                unpacker = Unpacker(endian)
+                unpackers.append(unpacker)
+            unpacker.add(field)
+        self.unpackers = [unpacker.compile() for unpacker in unpackers]
+        self.min_length = max([unpacker.struct.size for unpacker in self.unpackers] or [0])
+
+        # Precompute where to find each signal: (name, unpacker index, value index, count, byte order if it has to be converted from bytes, signed, converter)
+        self.plan = []
+        for signal in self.signals:
+            field = signal.field
+            for u, unpacker in enumerate(self.unpackers):
+                if field in unpacker.indexes:
+                    from_bytes = field[3] != 'string' and signal.width not in STRUCT_CODES
+                    self.plan.append((signal.name, u, unpacker.indexes[field], signal.count, from_bytes and signal.endian, signal.signed, signal.convert))
+                    break
+
+    def decode(self, data):
+        if len(data) < self.min_length:
+            raise ValueError("Response {} too short: {} byte(s), at least {} expected".format(self.name, len(data), self.min_length))
+        values = [unpacker.struct.unpack_from(data) for unpacker in self.unpackers]
+        decoded = {}
+        for name, u, index, count, from_bytes, signed, convert in self.plan:
+            if count == 1:
+                value = values[u][index]
+                if from_bytes:
+                    value = int.from_bytes(value, from_bytes, signed=signed)
+                decoded[name] = convert(value) if convert else value
+            else:
+                items = values[u][index:index + count]
+                if from_bytes:
+                    items = [int.from_bytes(item, from_bytes, signed=signed) for item in items]
+                decoded[name] = [convert(item) for item in items] if convert else list(items)
+        return decoded
+
+    # Decode an array signal in one operation (without a function call per value).
+    # Returns a NumPy float array when NumPy is available, a list otherwise.
+    def decode_array(self, name, data):
+        key = (name, numpy_enabled)
+        if key not in self.array_decoders:
+            self.array_decoders[key] = self.compile_array(self.signals_by_name[name], numpy_enabled)
+        return self.array_decoders[key](data)
+
+    def compile_array(self, signal, with_numpy):
+        end = signal.end
+        if signal.mask is not None or signal.type == 'string' or signal.width not in STRUCT_CODES:
+            # Not a plain numeric array, use the generic decoder
+            name = signal.name
+            return lambda data: self.decode(data)[name]
+
+        add = signal.add or 0
+        divisor = signal.divisor if signal.divisor is not None else 1
+        scale = signal.scale if signal.scale is not None else 1
+        decimals = signal.round
+
+        def check(data):
+            if len(data) < end:
+                raise ValueError("Response {} too short: {} byte(s), at least {} expected".format(self.name, len(data), end))
+
+        if with_numpy:
+            dtype = numpy.dtype('{}{}{}'.format('>' if signal.endian == 'big' else '<', 'i' if signal.signed else 'u', signal.width))
+            def decode_numpy(data):
+                check(data)
+                values = numpy.frombuffer(data, dtype=dtype, count=signal.count, offset=signal.start).astype(numpy.float64)
+                if add:
+                    values += add
+                if divisor != 1:
+                    values /= divisor
+                if scale != 1:
+                    values *= scale
+                if decimals is not None:
+                    values = numpy.round(values, int(decimals))
+                return values
+            return decode_numpy
+
+        code = STRUCT_CODES[signal.width]
+        unpacker = struct.Struct('{}{}{}'.format('>' if signal.endian == 'big' else '<', signal.count, code.lower() if signal.signed else code))
+        def decode_list(data):
+            check(data)
+            values = unpacker.unpack_from(data, signal.start)
+            if add or divisor != 1 or scale != 1:
+                values = [((value + add) / divisor) * scale for value in values]
+            if decimals is not None:
+                values = [round(value, int(decimals)) for value in values]
+            return list(values)
+        return decode_list
+
+# Load and compile the signal table from a JSON file
+def load_signal_table(path):
+    with open(path) as signals_file:
+        table = json.loads(signals_file.read())
+    return compile_signal_table(table)
+
+def compile_signal_table(table):
+    return dict((name, ResponseDecoder(name, definition)) for name, definition in table.items())
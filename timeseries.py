@@ -0,0 +1,346 @@
+#! /usr/bin/python
+
+# Local time-series store of the information published (battery, VMCU, TPMS, location...), so the
+# history is kept on the Pi whether the broker is reachable or not.
+#
+# Samples are stored in a SQLite database in WAL mode, one row per numeric signal of each sample
+# (series id, timestamp, value) at 1 second resolution (the last value of a second is kept). Every
+# sample also updates its minute and hour rollups (count, sum, min and max) in the same transaction,
+# so downsampled data is always up to date and there are no batch jobs. Rollups count every sample
+# added, including the ones replaced in the raw data by a later value of the same second (i.e. the
+# frames of monitor mode), so their count and mean may not match the raw samples kept.
+#
+# Each resolution is kept for its retention period (seconds) and the database is kept under a size
+# budget (max_mb, the WAL file included): when it's bigger, the oldest samples are deleted, raw ones
+# first, then minutes and hours. Freed pages are returned to the file system (incremental auto vacuum).
+#
+# Lists of the columnar messages of monitor mode ({"times": [...], "<signal>": [...]}) are stored as
+# one sample per time, other lists and nested objects are not stored.
+#
+# Usage: python timeseries.py [--db PATH] topics
+#        python timeseries.py [--db PATH] query TOPIC [--signals S1,S2] [--start T] [--end T] [--resolution raw|minute|hour]
+#        python timeseries.py [--db PATH] serve [--host HOST] [--port PORT]
+#        Times are Linux epoch seconds or seconds before now when negative (i.e. --start -3600).
+#        The HTTP server answers GET /topics and GET /query?topic=battery&signals=socBms&start=-3600 with JSON.
+
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger('timeseries')
+
+DEFAULT_PATH = os.path.dirname(os.path.realpath(__file__)) + '/timeseries.db'
+
+DEFAULT_TOPICS = ('battery', 'vmcu', 'tpms', 'location')
+
+# Seconds of each resolution
+RESOLUTIONS = {
+    'raw': 1,
+    'minute': 60,
+    'hour': 3600
+}
+
+# Seconds each resolution is kept by default
+DEFAULT_RETENTION = {
+    'raw': 2 * 24 * 3600,
+    'minute': 90 * 24 * 3600,
+    'hour': 5 * 365 * 24 * 3600
+}
+
+# Keys of the information that are not signals
+TIME_KEYS = ('timestamp', 'last_update', 'times', 'samples')
+
+# Max points returned by a query with automatic resolution
+MAX_POINTS = 2000
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value)
+
+# (timestamp, {signal: value}) of the samples of an information
+def samples_of(data, now=None):
+    timestamp = data.get('timestamp', data.get('last_update'))
+    if not is_number(timestamp):
+        timestamp = now if now is not None else time.time()
+    values = {}
+    columns = {}
+    times = data.get('times')
+    for key, value in data.items():
+        if key in TIME_KEYS:
+            continue
+        if isinstance(value, bool):
+            value = int(value)
+        if is_number(value):
+            values[key] = float(value)
+        elif isinstance(times, list) and isinstance(value, list) and len(value) == len(times):
+            columns[key] = value
+    if not columns:
+        return [(int(timestamp), values)] if values else []
+    samples = []
+    for index, offset in enumerate(times):
+        sample = dict(values)
+        sample.update((key, float(column[index])) for key, column in columns.items() if is_number(column[index]))
+        samples.append((int(timestamp + offset), sample))
+    return samples
+
+# Time argument: epoch seconds, or seconds before now when negative
+def parse_time(value, now):
+    if value is None or value == '':
+        return None
+    value = float(value)
+    return int(now + value) if value < 0 else int(value)
+
+class TimeSeriesStore(object):
+    def __init__(self, path=DEFAULT_PATH, topics=DEFAULT_TOPICS, retention=None, max_mb=500, prune_interval=600, logger_name='timeseries'):
+        self.path = path
+        self.logger = logging.getLogger(logger_name)
+        self.topics = set(topics) if topics is not None else None    # None stores every topic
+        self.retention = dict(DEFAULT_RETENTION, **(retention or {}))
+        self.max_bytes = int(float(max_mb) * 1048576) if max_mb else None
+        self.prune_interval = float(prune_interval)
+        self.next_prune = time.monotonic() + self.prune_interval
+        self.lock = threading.Lock()
+        self.series = {}        # Series id by (topic, signal)
+        self.samples = 0
+        # Autocommit mode, transactions are explicit
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')      # Only applied when the database is created
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS series ('
+                        'id INTEGER PRIMARY KEY, '
+                        'topic TEXT NOT NULL, '
+                        'signal TEXT NOT NULL, '
+                        'UNIQUE (topic, signal))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS samples ('
+                        'series INTEGER NOT NULL, '
+                        'ts INTEGER NOT NULL, '
+                        'value REAL NOT NULL, '
+                        'PRIMARY KEY (series, ts)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS rollups ('
+                        'resolution INTEGER NOT NULL, '
+                        'series INTEGER NOT NULL, '
+                        'ts INTEGER NOT NULL, '
+                        'count INTEGER NOT NULL, '
+                        'sum REAL NOT NULL, '
+                        'min REAL NOT NULL, '
+                        'max REAL NOT NULL, '
+                        'PRIMARY KEY (resolution, series, ts)) WITHOUT ROWID')
+        for series_id, topic, signal in self.db.execute('SELECT id, topic, signal FROM series'):
+            self.series[(topic, signal)] = series_id
+
+    def series_id(self, topic, signal):
+        key = (topic, signal)
+        if key not in self.series:
+            self.db.execute('INSERT OR IGNORE INTO series (topic, signal) VALUES (?, ?)', key)
+            self.series[key] = self.db.execute('SELECT id FROM series WHERE topic = ? AND signal = ?', key).fetchone()[0]
+        return self.series[key]
+
+    # Store the numeric signals of an information of a topic (as published)
+    def add(self, topic, data):
+        if self.topics is not None and topic not in self.topics:
+            return
+        samples = samples_of(data)
+        if not samples:
+            return
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                rows = [(self.series_id(topic, signal), timestamp, value) for timestamp, values in samples for signal, value in values.items()]
+                self.db.executemany('INSERT INTO samples (series, ts, value) VALUES (?, ?, ?) '
+                                    'ON CONFLICT (series, ts) DO UPDATE SET value = excluded.value', rows)
+                for name in ('minute', 'hour'):
+                    seconds = RESOLUTIONS[name]
+                    self.db.executemany('INSERT INTO rollups (resolution, series, ts, count, sum, min, max) VALUES (?, ?, ?, 1, ?, ?, ?) '
+                                        'ON CONFLICT (resolution, series, ts) DO UPDATE SET count = count + 1, sum = sum + excluded.sum, '
+                                        'min = min(min, excluded.min), max = max(max, excluded.max)',
+                                        [(seconds, series, ts - ts % seconds, value, value, value) for series, ts, value in rows])
+                self.db.execute('COMMIT')
+            except sqlite3.Error:
+                self.db.execute('ROLLBACK')
+                raise
+            self.samples += len(samples)
+        if time.monotonic() >= self.next_prune:
+            self.prune()
+
+    # Delete the samples older than their retention and the oldest ones while over the size budget
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        self.next_prune = time.monotonic() + self.prune_interval
+        with self.lock:
+            deleted = self.db.execute('DELETE FROM samples WHERE ts < ?', (now - self.retention['raw'],)).rowcount
+            for name in ('minute', 'hour'):
+                deleted += self.db.execute('DELETE FROM rollups WHERE resolution = ? AND ts < ?', (RESOLUTIONS[name], now - self.retention[name])).rowcount
+            if self.max_bytes:
+                for name in ('raw', 'minute', 'hour'):
+                    while self.used_bytes() > self.max_bytes:
+                        count = self.delete_oldest(name)
+                        if not count:
+                            break
+                        deleted += count
+            if deleted:
+                # Run to completion (execute only frees the first page)
+                self.db.executescript('PRAGMA incremental_vacuum')
+        if deleted:
+            self.logger.info("%s old sample(s) deleted from %s", deleted, self.path)
+        return deleted
+
+    # Bytes used on disk: pages in use and the WAL file, truncated first (it's only left when a reader still uses it)
+    def used_bytes(self):
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        page_size = self.db.execute('PRAGMA page_size').fetchone()[0]
+        page_count = self.db.execute('PRAGMA page_count').fetchone()[0]
+        free_pages = self.db.execute('PRAGMA freelist_count').fetchone()[0]
+        try:
+            wal_bytes = os.path.getsize(self.path + '-wal')
+        except OSError:
+            wal_bytes = 0
+        return (page_count - free_pages) * page_size + wal_bytes
+
+    # Delete the oldest tenth (at least an hour) of the samples of a resolution. Returns how many were deleted.
+    def delete_oldest(self, name):
+        if name == 'raw':
+            table, condition, params = 'samples', '', ()
+        else:
+            table, condition, params = 'rollups', 'resolution = ? AND ', (RESOLUTIONS[name],)
+        oldest, newest = self.db.execute('SELECT MIN(ts), MAX(ts) FROM {} WHERE {}1'.format(table, condition), params).fetchone()
+        if oldest is None:
+            return 0
+        until = oldest + max(3600, (newest - oldest) // 10)
+        return self.db.execute('DELETE FROM {} WHERE {}ts < ?'.format(table, condition), params + (until,)).rowcount
+
+    # Signals stored of each topic: {"<topic>": ["<signal>", ...]}
+    def topics_signals(self):
+        with self.lock:
+            rows = self.db.execute('SELECT topic, signal FROM series ORDER BY topic, signal').fetchall()
+        topics = {}
+        for topic, signal in rows:
+            topics.setdefault(topic, []).append(signal)
+        return topics
+
+    # Finest resolution kept for the whole time range with at most max_points points
+    def auto_resolution(self, start, end, now, max_points=MAX_POINTS):
+        for name in ('raw', 'minute', 'hour'):
+            if start >= now - self.retention[name] and (end - start) / RESOLUTIONS[name] <= max_points:
+                return name
+        return 'hour'
+
+    # Samples of signals (all the signals of the topic by default) between start and end (epoch seconds).
+    # Returns {"topic", "resolution", "start", "end", "series": {"<signal>": [[ts, value], ...]}} with raw
+    # samples and [[ts, mean, min, max, count], ...] with minute and hour rollups.
+    def query(self, topic, signals=None, start=None, end=None, resolution=None):
+        now = time.time()
+        end = int(now) if end is None else int(end)
+        start = end - 3600 if start is None else int(start)
+        if resolution is None or resolution == 'auto':
+            resolution = self.auto_resolution(start, end, now)
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown resolution {}, it must be one of: {}".format(resolution, ", ".join(RESOLUTIONS)))
+        with self.lock:
+            # Read from the table, the series may have been created by the script writing to the database
+            ids = dict(self.db.execute('SELECT signal, id FROM series WHERE topic = ? ORDER BY signal', (topic,)))
+            wanted = list(ids.items()) if signals is None else [(signal, ids.get(signal)) for signal in signals]
+            series = {}
+            for signal, series_id in wanted:
+                if series_id is None:
+                    series[signal] = []
+                elif resolution == 'raw':
+                    series[signal] = [list(row) for row in self.db.execute(
+                        'SELECT ts, value FROM samples WHERE series = ? AND ts BETWEEN ? AND ? ORDER BY ts', (series_id, start, end))]
+                else:
+                    seconds = RESOLUTIONS[resolution]
+                    series[signal] = [[ts, round(total / count, 6), low, high, count] for ts, total, low, high, count in self.db.execute(
+                        'SELECT ts, sum, min, max, count FROM rollups WHERE resolution = ? AND series = ? AND ts BETWEEN ? AND ? ORDER BY ts',
+                        (seconds, series_id, start - start % seconds, end))]
+        return {'topic': topic, 'resolution': resolution, 'start': start, 'end': end, 'series': series}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# Serve the queries of a store on http://host:port until interrupted (GET /topics and GET /query)
+def serve(store, port=8080, host='127.0.0.1'):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+            try:
+                if url.path == '/topics':
+                    result = store.topics_signals()
+                elif url.path == '/query' and params.get('topic'):
+                    now = time.time()
+                    result = store.query(params['topic'],
+                                         signals=params['signals'].split(',') if params.get('signals') else None,
+                                         start=parse_time(params.get('start'), now),
+                                         end=parse_time(params.get('end'), now),
+                                         resolution=params.get('resolution'))
+                else:
+                    self.send_error(404, "Use /topics or /query?topic=<topic>")
+                    return
+            except ValueError as err:
+                self.send_error(400, str(err))
+                return
+            body = json.dumps(result).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            # Dashboards served from other hosts of the car WiFi
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+    server = ThreadingHTTPServer((host, int(port)), QueryHandler)
+    server.daemon_threads = True
+    logger.info("Serving %s on http://%s:%s", store.path, host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the local time-series store')
+    parser.add_argument('--db', default=DEFAULT_PATH, help='time-series database (store.path of the config files)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('topics', help='list the topics and signals stored')
+    query_parser = commands.add_parser('query', help='print the samples of a topic as JSON')
+    query_parser.add_argument('topic')
+    query_parser.add_argument('--signals', default=None, help='comma separated signals (all by default)')
+    query_parser.add_argument('--start', default='-3600', help='start time, epoch seconds or seconds before now when negative')
+    query_parser.add_argument('--end', default=None, help='end time (now by default)')
+    query_parser.add_argument('--resolution', default=None, choices=sorted(RESOLUTIONS), help='resolution (the finest one kept with at most {} points by default)'.format(MAX_POINTS))
+    serve_parser = commands.add_parser('serve', help='serve the queries over HTTP')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on (0.0.0.0 for the car WiFi)')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)-10s %(levelname)-8s %(message)s")
+    if not os.path.exists(args.db):
+        sys.exit("No time-series database at {}".format(args.db))
+    store = TimeSeriesStore(args.db, prune_interval=float('inf'))
+    try:
+        if args.command == 'topics':
+            print(json.dumps(store.topics_signals(), indent=4))
+        elif args.command == 'query':
+            now = time.time()
+            print(json.dumps(store.query(args.topic,
+                                         signals=args.signals.split(',') if args.signals else None,
+                                         start=parse_time(args.start, now),
+                                         end=parse_time(args.end, now),
+                                         resolution=args.resolution)))
+        else:
+            serve(store, args.port, args.host)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
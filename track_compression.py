@@ -0,0 +1,153 @@
+# Compression of the GPS track before it's uploaded.
+#
+# Locations closer than min_distance meters to the previous one are dropped. The rest go through a
+# streaming version of Douglas-Peucker (opening window): the points received since the last kept
+# point are dropped while they all are within tolerance meters of the segment from the last kept
+# point to the newest one and their speed is within speed_deadband of the last kept point speed.
+# When a point falls out, the point before the newest one is kept and becomes the start of the next
+# segment. Straight lines at constant speed end up as just their two ends.
+#
+# Kept points are published in batches, every max_latency seconds or max_points points, as:
+#   {"timestamp": time of the first point,
+#    "points": number of points,
+#    "polyline": latitudes and longitudes as an encoded polyline (Google algorithm, 5 decimals),
+#    "times": seconds from timestamp of each point,
+#    "speeds": speed of each point in m/s}
+# The last point of a batch is the first one of the next batch, so batches can be joined.
+
+import math
+import time
+
+from gps_client import EARTH_RADIUS, distance
+
+# (latitude, longitude, timestamp, speed) of a track point
+LATITUDE, LONGITUDE, TIME, SPEED = range(4)
+
+# Distance in meters from point to the segment from start to end (local flat projection around start)
+def segment_distance(start, end, point):
+    scale = math.cos(math.radians(start[LATITUDE]))
+    to_xy = lambda p: (math.radians(p[LONGITUDE] - start[LONGITUDE]) * scale * EARTH_RADIUS,
+                       math.radians(p[LATITUDE] - start[LATITUDE]) * EARTH_RADIUS)
+    ex, ey = to_xy(end)
+    px, py = to_xy(point)
+    length = ex * ex + ey * ey
+    t = 0.0 if length == 0 else max(0.0, min(1.0, (px * ex + py * ey) / length))
+    return math.hypot(px - t * ex, py - t * ey)
+
+def encode_value(value):
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+# Encoded polyline of a list of (latitude, longitude)
+def encode_polyline(coordinates, precision=5):
+    factor = 10 ** precision
+    result = []
+    previous = (0, 0)
+    for latitude, longitude in coordinates:
+        current = (int(round(latitude * factor)), int(round(longitude * factor)))
+        result.append(encode_value(current[0] - previous[0]))
+        result.append(encode_value(current[1] - previous[1]))
+        previous = current
+    return ''.join(result)
+
+# List of (latitude, longitude) of an encoded polyline
+def decode_polyline(polyline, precision=5):
+    factor = float(10 ** precision)
+    values = []
+    value = shift = 0
+    for char in polyline:
+        byte = ord(char) - 63
+        value |= (byte & 0x1F) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    coordinates = []
+    latitude = longitude = 0
+    for i in range(0, len(values) - 1, 2):
+        latitude += values[i]
+        longitude += values[i + 1]
+        coordinates.append((latitude / factor, longitude / factor))
+    return coordinates
+
+class TrackCompressor(object):
+    def __init__(self, tolerance=5, min_distance=5, speed_deadband=None, max_points=200, max_latency=60, max_window=100, clock=time.monotonic):
+        self.tolerance = float(tolerance)
+        self.min_distance = float(min_distance)
+        self.speed_deadband = float(speed_deadband) if speed_deadband is not None else None
+        self.max_points = int(max_points)
+        self.max_latency = float(max_latency)
+        self.max_window = int(max_window)
+        self.clock = clock
+        self.points = []            # Kept points of the current batch
+        self.window = []            # Points received since the last kept point
+        self.published = 0          # Points at the start of the batch that were already published (0 or 1)
+        self.batch_start = None     # When the first new point of the batch was received
+        self.received = 0
+        self.kept = 0
+
+    # Whether all the points of the window can be dropped if point is kept after the last kept point
+    def fits(self, point):
+        anchor = self.points[-1]
+        for candidate in self.window:
+            if segment_distance(anchor, point, candidate) > self.tolerance:
+                return False
+            if self.speed_deadband is not None and candidate[SPEED] is not None and anchor[SPEED] is not None \
+                    and abs(candidate[SPEED] - anchor[SPEED]) > self.speed_deadband:
+                return False
+        return True
+
+    def keep(self, point):
+        self.points.append(point)
+        self.kept += 1
+
+    def add(self, latitude, longitude, timestamp, speed=None):
+        point = (latitude, longitude, timestamp, speed)
+        self.received += 1
+        if self.batch_start is None:
+            self.batch_start = self.clock()
+        if not self.points:
+            self.keep(point)
+            return
+        last = self.window[-1] if self.window else self.points[-1]
+        if distance(last[LATITUDE], last[LONGITUDE], latitude, longitude) < self.min_distance:
+            return
+        if self.window and (len(self.window) >= self.max_window or not self.fits(point)):
+            self.keep(self.window[-1])
+            self.window = []
+        self.window.append(point)
+
+    # Points not published yet
+    def pending(self):
+        return len(self.points) - self.published + (1 if self.window else 0)
+
+    # Whether a batch has to be published now
+    def due(self):
+        return self.pending() > 0 and (len(self.points) >= self.max_points or self.clock() - self.batch_start >= self.max_latency)
+
+    # Batch with the points not published yet (the newest point included), None if there are none
+    def flush(self):
+        if self.pending() <= 0:
+            return None
+        points = self.points + self.window[-1:]
+        start = points[0][TIME]
+        batch = {
+            'timestamp': int(start),
+            'points': len(points),
+            'polyline': encode_polyline([(point[LATITUDE], point[LONGITUDE]) for point in points]),
+            'times': [round(point[TIME] - int(start), 1) for point in points]
+        }
+        if any(point[SPEED] is not None for point in points):
+            batch['speeds'] = [None if point[SPEED] is None else round(point[SPEED], 1) for point in points]
+        if self.window:
+            self.kept += 1
+        self.points = points[-1:]
+        self.window = []
+        self.published = 1
+        self.batch_start = None
+        return batch
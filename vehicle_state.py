@@ -0,0 +1,85 @@
+# State of the car (sleeping, parked, driving or charging) guessed from the OBDII information, used
+# to switch the polling profile in daemon mode.
+#
+# - charging: BMS charging flag is set
+# - driving:  BMS ignition is on, the car is moving or the gear is not P
+# - parked:   BMS answers but none of the above
+# - sleeping: BMS did not answer sleep_after times in a row (ECUs are off)
+#
+# Switching to a more active state is done at once so fast changing information is not missed.
+# Going back to parked waits until the car looks parked for hold seconds (i.e. stopped at a traffic
+# light with the ignition briefly off, or a charging session paused by the charger).
+
+import logging
+import time
+
+logger = logging.getLogger('obdii.state')
+
+SLEEPING = 'sleeping'
+PARKED = 'parked'
+DRIVING = 'driving'
+CHARGING = 'charging'
+
+STATES = (SLEEPING, PARKED, DRIVING, CHARGING)
+
+class VehicleState(object):
+    def __init__(self, hold=120, sleep_after=3, clock=time.monotonic):
+        self.hold = float(hold)
+        self.sleep_after = int(sleep_after)
+        self.clock = clock
+        self.state = None           # Unknown until the first information is read
+        self.since = clock()
+        self.battery = {}
+        self.vmcu = {}
+        self.failures = 0
+        self.parked_since = None
+
+    # Most active state shown by the last battery and VMCU information
+    def classify(self):
+        if self.battery.get('charging'):
+            return CHARGING
+        if self.battery.get('bmsIgnition') or self.vmcu.get('speed', 0) > 0 or self.vmcu.get('gear', 'P') not in ('', 'P'):
+            return DRIVING
+        return PARKED
+
+    # Update the state with the information of BMS 2101 - 2105. Returns True if the state changed.
+    def update_battery(self, battery_info):
+        self.battery = battery_info
+        self.failures = 0
+        return self.update()
+
+    # Update the state with the information of VMCU 2101. Returns True if the state changed.
+    def update_vmcu(self, vmcu_info):
+        self.vmcu = vmcu_info
+        return self.update()
+
+    # The BMS did not answer. Returns True if the state changed.
+    def no_response(self):
+        self.failures += 1
+        if self.sleep_after > 0 and self.failures >= self.sleep_after and self.state != SLEEPING:
+            self.battery = {}
+            self.vmcu = {}
+            return self.change(SLEEPING)
+        return False
+
+    def update(self):
+        state = self.classify()
+        if state != PARKED or self.state in (None, SLEEPING, PARKED):
+            self.parked_since = None
+            return self.change(state)
+        # From driving or charging to parked
+        now = self.clock()
+        if self.parked_since is None:
+            self.parked_since = now
+        if now - self.parked_since >= self.hold:
+            self.parked_since = None
+            return self.change(PARKED)
+        return False
+
+    def change(self, state):
+        if state == self.state:
+            return False
+        logger.info("Vehicle state changed from %s to %s after %.0f second(s)", self.state, state, self.clock() - self.since)
+        self.state = state
+        self.since = self.clock()
+        return True